@@ -0,0 +1,139 @@
+"""قياس محول الصور: الزمن والحجم الناتج لكل إعداد على مجموعة صور محلية
+
+بدون --corpus تُنشأ صور اصطناعية شبيهة بالصور الفوتوغرافية (تدرجات مع
+ضجيج) بعدة أبعاد، وصورة PNG شفافة. التحويل يعمل في نفس العملية لقياس
+تكلفة Pillow وحدها دون مجموعة العمليات.
+
+الاستخدام:
+    python benchmarks/bench_images.py
+    python benchmarks/bench_images.py --corpus ~/photos --repeat 5 --json
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 40000000))
+
+# الاسم -> خيارات optimize_image_job (None = السلوك السابق: جودة 95 دون تصغير)
+CONFIGS = {
+    'legacy_q95': None,
+    'jpg_q85': {'format': 'jpg', 'quality': 85},
+    'jpg_300kb': {'format': 'jpg', 'target_bytes': 300 * 1024},
+    'jpg_1280': {'format': 'jpg', 'max_side': 1280, 'quality': 85},
+    'jpg_1280_nodraft': {'format': 'jpg', 'max_side': 1280, 'quality': 85, 'draft': False},
+    'webp_q80': {'format': 'webp', 'quality': 80},
+    'webp_300kb': {'format': 'webp', 'target_bytes': 300 * 1024},
+}
+
+
+def build_corpus(directory):
+    from PIL import Image
+    paths = []
+    for width, height in ((4000, 3000), (2000, 1500), (1280, 960)):
+        gradient = Image.linear_gradient('L').resize((width, height))
+        radial = Image.radial_gradient('L').resize((width, height))
+        noise = Image.effect_noise((width, height), 24)
+        image = Image.merge('RGB', (gradient, radial, Image.blend(gradient, noise, 0.5)))
+        path = os.path.join(directory, f'photo_{width}x{height}.jpg')
+        image.save(path, quality=92)
+        paths.append(path)
+    overlay = Image.radial_gradient('L').resize((1600, 1200))
+    image = Image.merge('RGBA', (overlay, overlay.transpose(Image.FLIP_LEFT_RIGHT),
+                                 Image.effect_noise((1600, 1200), 32), overlay))
+    path = os.path.join(directory, 'transparent_1600x1200.png')
+    image.save(path)
+    paths.append(path)
+    return paths
+
+
+def legacy_convert(jobs, src_path, dst_path):
+    """التحويل كما كان قبل خط المعالجة الجديد"""
+    with jobs.open_image_guarded(src_path, MAX_PIXELS) as image:
+        image = image.convert('RGB')
+        image.save(dst_path, 'JPEG', quality=95, optimize=True)
+    return {'bytes': os.path.getsize(dst_path), 'target_met': True}
+
+
+def nodraft_convert(jobs, src_path, dst_path, options):
+    """نفس خط المعالجة مع فك الترميز الكامل قبل التصغير (للمقارنة مع draft)"""
+    from PIL import Image, ImageOps
+    with jobs.open_image_guarded(src_path, MAX_PIXELS) as source:
+        image = ImageOps.exif_transpose(source).convert('RGB')
+    image.thumbnail((options['max_side'], options['max_side']), Image.LANCZOS)
+    data = jobs.encode_image(image, 'JPEG', options['quality'])
+    with open(dst_path, 'wb') as f:
+        f.write(data)
+    return {'bytes': len(data), 'target_met': True}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', help='مجلد صور (jpg, png, webp)')
+    parser.add_argument('--repeat', type=int, default=3, help='عدد مرات تحويل كل صورة بكل إعداد')
+    parser.add_argument('--config', action='append', choices=list(CONFIGS), help='إعداد محدد (يمكن تكراره)')
+    parser.add_argument('--json', action='store_true', help='إخراج النتائج بصيغة JSON')
+    args = parser.parse_args()
+
+    # image_jobs وحدها تكفي: هي ما تشغّله عمليات العمال دون استيراد البوت
+    sys.path.insert(0, ROOT)
+    import image_jobs as jobs
+
+    work_dir = tempfile.mkdtemp(prefix='bench_images_')
+    if args.corpus:
+        sources = sorted(os.path.join(args.corpus, name) for name in os.listdir(args.corpus)
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+    else:
+        sources = build_corpus(work_dir)
+    if not sources:
+        print("لا توجد صور في المجلد")
+        return
+
+    source_bytes = sum(os.path.getsize(path) for path in sources)
+    report = {'images': len(sources), 'source_bytes': source_bytes, 'configs': {}}
+    for name in args.config or list(CONFIGS):
+        options = CONFIGS[name]
+        timings, output_bytes, missed = [], 0, 0
+        for path in sources:
+            extension = '.webp' if options and options.get('format') == 'webp' else '.jpg'
+            dst_path = os.path.join(work_dir, f'out{extension}')
+            for run in range(args.repeat):
+                started = time.perf_counter()
+                if options is None:
+                    result = legacy_convert(jobs, path, dst_path)
+                elif options.get('draft') is False:
+                    result = nodraft_convert(jobs, path, dst_path, options)
+                else:
+                    result = jobs.optimize_image_job(path, dst_path, MAX_PIXELS, options)
+                timings.append(time.perf_counter() - started)
+                if run == 0:
+                    output_bytes += result['bytes']
+                    missed += not result['target_met']
+        report['configs'][name] = {
+            'p50_ms': round(statistics.median(timings) * 1000, 1),
+            'max_ms': round(max(timings) * 1000, 1),
+            'output_bytes': output_bytes,
+            'saved_pct': round(100 * (source_bytes - output_bytes) / source_bytes, 1),
+            'target_missed': missed,
+        }
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print(f"{report['images']} images, {source_bytes / 1024:.0f} KiB source, repeat={args.repeat}")
+    for name, row in report['configs'].items():
+        print(f"  {name:<18} p50={row['p50_ms']:>7}ms max={row['max_ms']:>7}ms "
+              f"out={row['output_bytes'] / 1024:>8.0f} KiB saved={row['saved_pct']:>6}% missed={row['target_missed']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""قياس زمن استيراد bot.py والتأكد من عدم تحميل الوحدات الثقيلة مبكراً
+
+الاستخدام:
+    python benchmarks/bench_import.py --runs 5 --max-ms 1500
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# PIL.Image غير مدرج: telebot يستورده عند استيراده، فلا يمكن تأجيله
+HEAVY_MODULES = ['yt_dlp', 'psutil']
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import bot
+elapsed = (time.perf_counter() - started) * 1000
+print(json.dumps({'ms': elapsed, 'loaded': [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def run_once():
+    env = dict(os.environ)
+    env.setdefault('BOT_TOKEN', '123456:benchmark')
+    result = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env,
+                            capture_output=True, text=True, timeout=120)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr[-2000:])
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='الحد الأقصى المسموح لوسيط زمن الاستيراد')
+    args = parser.parse_args()
+
+    samples = [run_once() for _ in range(args.runs)]
+    timings = [sample['ms'] for sample in samples]
+    loaded = sorted({name for sample in samples for name in sample['loaded']})
+    median = statistics.median(timings)
+
+    print(f"import bot: median {median:.0f} ms, min {min(timings):.0f} ms, max {max(timings):.0f} ms")
+    failed = False
+    if loaded:
+        print(f"❌ وحدات ثقيلة حُمّلت عند الاستيراد: {', '.join(loaded)}")
+        failed = True
+    if args.max_ms is not None and median > args.max_ms:
+        print(f"❌ زمن الاستيراد أعلى من الحد ({args.max_ms:.0f} ms)")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""قياس تكلفة تجهيز YoutubeDL لكل مهمة: نسخة جديدة مقابل نسخة من المجمع
+
+بدون --url يُقاس الإنشاء والإعداد فقط (دون شبكة)؛ مع --url تُضاف عملية
+استخراج كاملة لنفس الرابط في الحالتين.
+
+الاستخدام:
+    python benchmarks/bench_ydl_pool.py --jobs 50
+    python benchmarks/bench_ydl_pool.py --profile search --url "ytsearch1:test"
+    python benchmarks/bench_ydl_pool.py --fake   # بديل yt_dlp المحلي
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))] if values else 0
+
+
+def summarize(values):
+    return {
+        'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+        'mean_ms': round(statistics.mean(values) * 1000, 2) if values else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=30, help='عدد المهام في كل حالة')
+    parser.add_argument('--profile', default='video', choices=['video', 'fast', 'audio', 'probe', 'search'])
+    parser.add_argument('--url', help='رابط لاستخراجه في كل مهمة (يتطلب شبكة)')
+    parser.add_argument('--fake', action='store_true', help='استخدام بديل yt_dlp في fake_backends')
+    parser.add_argument('--json', action='store_true', help='إخراج النتائج بصيغة JSON')
+    args = parser.parse_args()
+
+    os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+    os.environ.setdefault('LAZY_WARMUP', '0')
+    if args.fake:
+        sys.path.insert(0, os.path.join(HERE, 'fake_backends'))
+    sys.path.insert(0, ROOT)
+    import bot as bot_module
+
+    # استيراد yt_dlp نفسه ليس جزءاً من تكلفة المهمة
+    bot_module.yt_dlp.load()
+    work_dir = tempfile.mkdtemp(prefix='bench_ydl_')
+    outtmpl = bot_module.job_outtmpl(work_dir)
+    hooks = {'progress_hooks': [lambda d: None], 'postprocessor_hooks': [lambda d: None]}
+
+    def job(ydl):
+        if args.url:
+            ydl.extract_info(args.url, download=False)
+
+    fresh = []
+    for _ in range(args.jobs):
+        started = time.perf_counter()
+        opts = bot_module.ydl_profile_opts(args.profile)
+        opts.update(outtmpl=outtmpl, **hooks)
+        with bot_module.yt_dlp.YoutubeDL(opts) as ydl:
+            job(ydl)
+        fresh.append(time.perf_counter() - started)
+
+    pool = bot_module.YoutubeDLPool(max_idle=1)
+    warm_started = time.perf_counter()
+    pool.warm([args.profile])
+    warm_s = time.perf_counter() - warm_started
+    pooled = []
+    for _ in range(args.jobs):
+        started = time.perf_counter()
+        with pool.checkout(args.profile, outtmpl=outtmpl, **hooks) as ydl:
+            job(ydl)
+        pooled.append(time.perf_counter() - started)
+    pool.close()
+    os.rmdir(work_dir)
+
+    report = {
+        'profile': args.profile,
+        'jobs': args.jobs,
+        'url': args.url,
+        'fresh': summarize(fresh),
+        'pooled': summarize(pooled),
+        'pool_warm_ms': round(warm_s * 1000, 2),
+        'instances_created': pool.created,
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print(f"profile={args.profile} jobs={args.jobs}" + (f" url={args.url}" if args.url else " (setup only)"))
+    for name in ('fresh', 'pooled'):
+        row = report[name]
+        print(f"  {name:<7} p50={row['p50_ms']}ms p99={row['p99_ms']}ms mean={row['mean_ms']}ms")
+    print(f"  pool warm-up {report['pool_warm_ms']}ms, instances created: {report['instances_created']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""بديل محلي لـ yt_dlp يخدم ملفات وسائط محلية لقياس الأداء دون اتصال
+
+يُفعّل بإضافة benchmarks/fake_backends إلى بداية sys.path قبل استيراد البوت.
+الإعدادات عبر متغيرات البيئة:
+    FAKE_YTDLP_MEDIA_DIR  مجلد يحتوي video.mp4 و audio.mp3 و audio.m4a
+    FAKE_YTDLP_LATENCY    زمن الاستخراج المحاكى بالثواني (افتراضياً 0)
+    FAKE_YTDLP_BANDWIDTH  سرعة التنزيل المحاكاة بالبايت/ثانية (0 = بلا حد)
+"""
+import os
+import shutil
+import time
+
+from . import utils
+
+__version__ = 'fake'
+
+MEDIA_DIR = os.environ.get('FAKE_YTDLP_MEDIA_DIR', '')
+LATENCY = float(os.environ.get('FAKE_YTDLP_LATENCY', 0))
+BANDWIDTH = float(os.environ.get('FAKE_YTDLP_BANDWIDTH', 0))
+
+
+def _video_id(url):
+    return url.rstrip('/').rsplit('=', 1)[-1].rsplit('/', 1)[-1][:32] or 'media'
+
+
+class YoutubeDL:
+    def __init__(self, params=None):
+        self.params = dict(params or {})
+        self._progress_hooks = list(self.params.get('progress_hooks', []))
+        self._postprocessor_hooks = list(self.params.get('postprocessor_hooks', []))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def close(self):
+        pass
+
+    def add_progress_hook(self, hook):
+        self._progress_hooks.append(hook)
+
+    def add_postprocessor_hook(self, hook):
+        self._postprocessor_hooks.append(hook)
+
+    def _wants_audio(self):
+        return any(pp.get('key') == 'FFmpegExtractAudio' for pp in self.params.get('postprocessors', []))
+
+    def _source(self, audio):
+        name = 'audio.mp3' if audio and self._wants_audio() else ('audio.m4a' if audio else 'video.mp4')
+        return os.path.join(MEDIA_DIR, name)
+
+    def extract_info(self, url, download=True, **kwargs):
+        if LATENCY:
+            time.sleep(LATENCY)
+        if url.startswith('ytsearch'):
+            query = url.split(':', 1)[-1]
+            entries = [{'id': f'search{i}', 'title': f'{query} #{i}', 'duration': 180,
+                        'url': f'https://www.youtube.com/watch?v=search{i}'} for i in range(5)]
+            return {'_type': 'playlist', 'entries': entries}
+        audio = 'audio' in str(self.params.get('format', ''))
+        source = self._source(audio)
+        info = {
+            'id': _video_id(url),
+            'title': f'Benchmark {_video_id(url)}',
+            'duration': 60,
+            'ext': os.path.splitext(source)[1][1:],
+            'filesize_approx': os.path.getsize(source) if os.path.exists(source) else None,
+            'webpage_url': url,
+            'extractor_key': 'Youtube',
+        }
+        if download:
+            self.process_ie_result(info, download=True)
+        return info
+
+    def prepare_filename(self, info):
+        template = self.params.get('outtmpl', '%(title)s.%(ext)s')
+        if isinstance(template, dict):
+            template = template.get('default')
+        return template % info
+
+    def process_ie_result(self, info, download=True, **kwargs):
+        if not download:
+            return info
+        audio = 'audio' in str(self.params.get('format', ''))
+        source = self._source(audio)
+        target = self.prepare_filename(info)
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        size = os.path.getsize(source)
+        # download_ranges: تنزيل جزء من الملف يتناسب مع طول المقطع
+        section = next(iter(self.params['download_ranges'](info, self)), {}) if self.params.get('download_ranges') else {}
+        if section.get('end_time') is not None and info.get('duration'):
+            fraction = (section['end_time'] - section.get('start_time', 0)) / info['duration']
+            size = max(2048, int(size * min(1.0, fraction)))
+            info = dict(info, section_start=section.get('start_time', 0), section_end=section['end_time'])
+        started = time.time()
+        if BANDWIDTH:
+            time.sleep(size / BANDWIDTH)
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            dst.write(src.read(size))
+        for hook in self._progress_hooks:
+            hook({'status': 'finished', 'filename': target, 'total_bytes': size,
+                  'elapsed': time.time() - started, 'info_dict': info})
+        if self._wants_audio():
+            for status in ('started', 'finished'):
+                for hook in self._postprocessor_hooks:
+                    hook({'status': status, 'postprocessor': 'FFmpegExtractAudio', 'info_dict': info})
+        return info
+
+    def download(self, urls):
+        for url in urls:
+            self.extract_info(url, download=True)
+        return 0
@@ -0,0 +1,28 @@
+"""أصناف الأخطاء التي يعتمد عليها البوت من yt_dlp.utils"""
+
+
+class YoutubeDLError(Exception):
+    pass
+
+
+class ExtractorError(YoutubeDLError):
+    pass
+
+
+class DownloadError(YoutubeDLError):
+    def __init__(self, msg, exc_info=None):
+        super().__init__(msg)
+        self.exc_info = exc_info
+
+
+class download_range_func:
+    """نسخة مبسطة: المقاطع الزمنية فقط دون الفصول"""
+
+    def __init__(self, chapters, ranges, from_info=False):
+        self.chapters, self.ranges, self.from_info = chapters, ranges, from_info
+
+    def __call__(self, info_dict, ydl):
+        for start, end in self.ranges or []:
+            yield {'start_time': start, 'end_time': end}
+        if not self.ranges:
+            yield {}
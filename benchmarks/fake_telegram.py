@@ -0,0 +1,130 @@
+"""خادم محلي يحاكي Telegram Bot API لقياس الأداء دون اتصال
+
+يسجل كل طلب لكل محادثة ويخدم الملفات المحلية عبر getFile وروابط /file/.
+"""
+import http.server
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+MENU_TEXT = "🎛️ اختر الإجراء التالي:"
+
+
+class FakeTelegramState:
+    def __init__(self, files):
+        self.files = files  # file_id -> مسار محلي
+        self.lock = threading.Condition()
+        self.message_id = 0
+        self.messages = {}  # chat_id -> عدد الرسائل
+        self.menus = {}  # chat_id -> قائمة أوقات رسائل القائمة
+        self.uploads = {}  # chat_id -> [(method, bytes)]
+        self.uploaded_bytes = 0
+
+    def record(self, method, chat_id, text=None, upload_bytes=0):
+        with self.lock:
+            self.message_id += 1
+            if chat_id is not None:
+                self.messages[chat_id] = self.messages.get(chat_id, 0) + 1
+                if text == MENU_TEXT:
+                    self.menus.setdefault(chat_id, []).append(time.perf_counter())
+                if upload_bytes:
+                    self.uploads.setdefault(chat_id, []).append((method, upload_bytes))
+                    self.uploaded_bytes += upload_bytes
+            self.lock.notify_all()
+            return self.message_id
+
+    def wait(self, predicate, timeout):
+        with self.lock:
+            return self.lock.wait_for(predicate, timeout=timeout)
+
+
+class FakeTelegramHandler(http.server.BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, result, status=200):
+        body = json.dumps({'ok': status == 200, 'result': result}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _params(self):
+        parsed = urllib.parse.urlsplit(self.path)
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            params.update({k: v[-1] for k, v in urllib.parse.parse_qs(body.decode('utf-8')).items()})
+        elif content_type.startswith('application/json') and body:
+            params.update(json.loads(body))
+        return parsed.path, params, len(body) if content_type.startswith('multipart/') else 0
+
+    def _serve_file(self, file_path):
+        local = self.state.files.get(os.path.basename(file_path))
+        if not local or not os.path.exists(local):
+            self.send_error(404)
+            return
+        with open(local, 'rb') as f:
+            data = f.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith('/file/'):
+            self._serve_file(urllib.parse.urlsplit(self.path).path)
+            return
+        self.do_POST()
+
+    def do_POST(self):
+        path, params, upload_bytes = self._params()
+        method = path.rsplit('/', 1)[-1]
+        chat_id = int(params['chat_id']) if str(params.get('chat_id', '')).lstrip('-').isdigit() else None
+
+        if method == 'getMe':
+            self._reply({'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'})
+        elif method == 'getFile':
+            file_id = params.get('file_id')
+            local = self.state.files.get(file_id)
+            if not local:
+                self._reply('file not found', status=400)
+                return
+            self._reply({'file_id': file_id, 'file_unique_id': file_id,
+                         'file_size': os.path.getsize(local), 'file_path': f'documents/{file_id}'})
+        elif method in ('sendChatAction', 'answerInlineQuery', 'deleteWebhook'):
+            self._reply(True)
+        elif method.startswith('send') or method.startswith('edit'):
+            message_id = self.state.record(method, chat_id, params.get('text'), upload_bytes)
+            message = {'message_id': message_id, 'date': int(time.time()),
+                       'chat': {'id': chat_id or 0, 'type': 'private'}}
+            if params.get('text'):
+                message['text'] = params['text']
+            kind = method[4:].lower()
+            if kind in ('video', 'audio', 'voice', 'document'):
+                # معرف ملف ثابت لكل رسالة حتى يمكن إعادة الإرسال به لاحقاً
+                media = {'file_id': params.get(kind) if isinstance(params.get(kind), str) else f'fake_{kind}_{message_id}',
+                         'file_unique_id': f'fake_{message_id}', 'duration': 0, 'width': 0, 'height': 0}
+                message[kind] = media
+            self._reply(message)
+        elif method == 'getUpdates':
+            self._reply([])
+        else:
+            self._reply(True)
+
+
+def start_fake_telegram(files, host='127.0.0.1', port=0):
+    """تشغيل الخادم في خيط خلفي وإرجاع (server, state)"""
+    state = FakeTelegramState(files)
+    handler = type('Handler', (FakeTelegramHandler,), {'state': state})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
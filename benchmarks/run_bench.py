@@ -0,0 +1,227 @@
+"""تشغيل حمل على معالجات البوت دون اتصال بـ Telegram أو YouTube
+
+يعيد تشغيل التحديثات المسجلة في updates.json على bot.process_new_updates
+مع خادم Telegram محلي (fake_telegram.py) وبديل yt_dlp يخدم ملفات محلية،
+ثم يطبع عدد المهام في الثانية وزمن p50/p99 وذروة الذاكرة والقرص.
+
+الاستخدام:
+    python benchmarks/run_bench.py --jobs 50 --concurrency 8
+    python benchmarks/run_bench.py --scenario download_video --scenario image_to_pdf
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+
+def prepare_corpus(directory):
+    """إنشاء ملفات وسائط صغيرة للاختبار (باستخدام FFmpeg إن وجد)"""
+    ffmpeg = shutil.which('ffmpeg')
+    outputs = {
+        'video.mp4': ['-f', 'lavfi', '-i', 'testsrc=duration=10:size=640x360:rate=25',
+                      '-f', 'lavfi', '-i', 'sine=duration=10', '-shortest', '-c:v', 'libx264', '-c:a', 'aac'],
+        'audio.mp3': ['-f', 'lavfi', '-i', 'sine=duration=60', '-c:a', 'libmp3lame'],
+        'audio.m4a': ['-f', 'lavfi', '-i', 'sine=duration=60', '-c:a', 'aac'],
+    }
+    for name, args in outputs.items():
+        path = os.path.join(directory, name)
+        if ffmpeg:
+            subprocess.run([ffmpeg, '-y', '-loglevel', 'error'] + args + [path], check=False)
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(os.urandom(2 * 1024 * 1024))
+
+    from PIL import Image
+    image = Image.effect_noise((2000, 1500), 64).convert('RGB')
+    image.save(os.path.join(directory, 'image.jpg'), quality=90)
+    return {
+        'bench_image': os.path.join(directory, 'image.jpg'),
+        'bench_video': os.path.join(directory, 'video.mp4'),
+    }
+
+
+def build_update(update_id, chat_id, fragment, n):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'},
+    }
+    for key, value in fragment.items():
+        message[key] = value.replace('{n}', str(n)) if isinstance(value, str) else value
+    return {'update_id': update_id, 'message': message}
+
+
+class Sampler(threading.Thread):
+    """أخذ عينات دورية للذاكرة (مع العمليات الفرعية) وحجم المجلد المؤقت"""
+
+    def __init__(self, temp_dir, interval=0.1):
+        super().__init__(daemon=True)
+        import psutil
+        self.process = psutil.Process()
+        self.temp_dir = temp_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            try:
+                rss = self.process.memory_info().rss
+                rss += sum(child.memory_info().rss for child in self.process.children(recursive=True))
+                self.peak_rss = max(self.peak_rss, rss)
+            except Exception:
+                pass
+            disk = 0
+            for root, _, files in os.walk(self.temp_dir):
+                for filename in files:
+                    try:
+                        disk += os.path.getsize(os.path.join(root, filename))
+                    except OSError:
+                        pass
+            self.peak_disk = max(self.peak_disk, disk)
+            time.sleep(self.interval)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))] if values else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=20, help='عدد المهام الكلي')
+    parser.add_argument('--concurrency', type=int, default=4, help='عدد المحادثات المتزامنة')
+    parser.add_argument('--scenario', action='append', help='سيناريو من updates.json (يمكن تكراره)')
+    parser.add_argument('--timeout', type=float, default=300, help='المهلة القصوى لكل مهمة')
+    parser.add_argument('--json', action='store_true', help='إخراج النتائج بصيغة JSON')
+    args = parser.parse_args()
+
+    with open(os.path.join(HERE, 'updates.json'), encoding='utf-8') as f:
+        scenarios = json.load(f)
+    names = args.scenario or list(scenarios)
+
+    corpus_dir = tempfile.mkdtemp(prefix='bot_bench_')
+    files = prepare_corpus(corpus_dir)
+
+    from fake_telegram import start_fake_telegram
+    server, state = start_fake_telegram(files)
+    port = server.server_address[1]
+
+    os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+    os.environ['FAKE_YTDLP_MEDIA_DIR'] = corpus_dir
+    # مخزن الوسائط وذاكرة المعرفات فارغان في كل تشغيل حتى لا تتحول التنزيلات إلى إصابات
+    os.environ.setdefault('MEDIA_STORE_DIR', os.path.join(corpus_dir, 'store'))
+    os.environ.setdefault('FILE_ID_CACHE_DB', os.path.join(corpus_dir, 'file_ids.db'))
+    os.environ.setdefault('USAGE_DB', os.path.join(corpus_dir, 'usage.db'))
+    os.environ.setdefault('LAZY_WARMUP', '0')
+    sys.path.insert(0, os.path.join(HERE, 'fake_backends'))
+    sys.path.insert(0, ROOT)
+
+    import telebot
+    telebot.apihelper.API_URL = f"http://127.0.0.1:{port}/bot{{0}}/{{1}}"
+    telebot.apihelper.FILE_URL = f"http://127.0.0.1:{port}/file/bot{{0}}/{{1}}"
+    import bot as bot_module
+    bot_module.image_service.start()
+    needs_ffmpeg = [name for name in ('video_to_mp3', 'download_clip') if name in names]
+    if not bot_module.FFMPEG_AVAILABLE and needs_ffmpeg:
+        print(f"⚠️ FFmpeg غير متاح - تخطي سيناريو {', '.join(needs_ffmpeg)}")
+        names = [name for name in names if name not in needs_ffmpeg]
+
+    sampler = Sampler(bot_module.TEMP_DIR)
+    sampler.start()
+
+    latencies = {name: [] for name in names}
+    failures = []
+    update_ids = iter(range(1, 10 ** 9))
+    id_lock = threading.Lock()
+    job_queue = list(range(args.jobs))
+    queue_lock = threading.Lock()
+
+    def run_job(n):
+        name = names[n % len(names)]
+        chat_id = 100000 + n
+        steps = scenarios[name]
+        for index, fragment in enumerate(steps):
+            with id_lock:
+                update_id = next(update_ids)
+            before = state.messages.get(chat_id, 0)
+            menus_before = len(state.menus.get(chat_id, []))
+            started = time.perf_counter()
+            update = telebot.types.Update.de_json(build_update(update_id, chat_id, fragment, n))
+            bot_module.bot.process_new_updates([update])
+            if index < len(steps) - 1:
+                # انتظار رد البوت قبل إرسال الخطوة التالية حتى تتحدث حالة المستخدم
+                state.wait(lambda: state.messages.get(chat_id, 0) > before, args.timeout)
+                time.sleep(0.05)
+                continue
+            done = state.wait(lambda: len(state.menus.get(chat_id, [])) > menus_before, args.timeout)
+            if done:
+                latencies[name].append(state.menus[chat_id][menus_before] - started)
+            else:
+                failures.append(name)
+
+    def worker():
+        while True:
+            with queue_lock:
+                if not job_queue:
+                    return
+                n = job_queue.pop(0)
+            run_job(n)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    sampler.running = False
+
+    completed = sum(len(values) for values in latencies.values())
+    report = {
+        'jobs': args.jobs,
+        'completed': completed,
+        'failed': len(failures),
+        'elapsed_s': round(elapsed, 3),
+        'jobs_per_s': round(completed / elapsed, 3) if elapsed else 0,
+        'peak_rss_mb': round(sampler.peak_rss / (1024 * 1024), 1),
+        'peak_disk_mb': round(sampler.peak_disk / (1024 * 1024), 1),
+        'uploaded_mb': round(state.uploaded_bytes / (1024 * 1024), 1),
+        'scenarios': {
+            name: {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 0.5) * 1000),
+                'p99_ms': round(percentile(values, 0.99) * 1000),
+                'mean_ms': round(statistics.mean(values) * 1000) if values else 0,
+            } for name, values in latencies.items()
+        },
+    }
+
+    bot_module.image_service.shutdown()
+    server.shutdown()
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print(f"jobs: {completed}/{args.jobs} completed, {len(failures)} failed in {elapsed:.1f}s "
+          f"({report['jobs_per_s']} jobs/s)")
+    print(f"peak RSS: {report['peak_rss_mb']} MB, peak temp disk: {report['peak_disk_mb']} MB, "
+          f"uploaded: {report['uploaded_mb']} MB")
+    for name, row in report['scenarios'].items():
+        print(f"  {name:<16} n={row['count']:<4} p50={row['p50_ms']}ms p99={row['p99_ms']}ms mean={row['mean_ms']}ms")
+
+
+if __name__ == '__main__':
+    main()
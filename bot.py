@@ -12,6 +12,27 @@ import glob
 import requests
 import json
 import random
+import multiprocessing
+import concurrent.futures
+import heapq
+import itertools
+import importlib
+import contextlib
+import http.server
+import hashlib
+import hmac
+import ipaddress
+import uuid
+import io
+import collections
+import struct
+import sqlite3
+import zlib
+import signal
+import traceback
+import tracemalloc
+import logging.handlers
+import pickle
 
 # ========== إعدادات السحابة المتقدمة ==========
 logging.basicConfig(
@@ -26,46 +47,59 @@ logger = logging.getLogger(__name__)
 
 print("🚀 بدء تشغيل بوت الوسائط المتقدم على Railway...")
 
-# ========== تثبيت الحزم المطلوبة ==========
-def install_required_packages():
-    """تثبيت جميع الحزم المطلوبة"""
-    packages = [
-        'pyTelegramBotAPI',
-        'yt-dlp', 
-        'pillow',
-        'requests',
-        'psutil'
-    ]
-    
-    for package in packages:
-        try:
-            if package == 'pyTelegramBotAPI':
-                import telebot
-                print("✅ telebot - مثبت بالفعل")
-            elif package == 'yt-dlp':
-                import yt_dlp
-                print("✅ yt-dlp - مثبت بالفعل")
-            elif package == 'pillow':
-                from PIL import Image
-                print("✅ pillow - مثبت بالفعل")
-            elif package == 'requests':
-                import requests
-                print("✅ requests - مثبت بالفعل")
-            elif package == 'psutil':
-                import psutil
-                print("✅ psutil - مثبت بالفعل")
-        except ImportError:
-            print(f"📦 جاري تثبيت {package}...")
-            subprocess.check_call([sys.executable, "-m", "pip", "install", package])
-
-install_required_packages()
-
 # ========== استيراد المكتبات ==========
 import telebot
 from telebot import types
-import yt_dlp
-from PIL import Image, ImageFilter, ImageEnhance
-import psutil
+
+import image_jobs
+from image_jobs import (ImageProcessingError, IMAGE_DEFAULT_QUALITY, IMAGE_MIN_QUALITY, IMAGE_MAX_QUALITY,
+                        IMAGE_OUTPUT_FORMATS)
+
+class LazyModule:
+    """وحدة ثقيلة تُستورد عند أول استخدام فعلي لها"""
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.__dict__['_module'] is not None
+
+    def load(self):
+        if self.__dict__['_module'] is None:
+            with self._lock:
+                if self.__dict__['_module'] is None:
+                    started = time.perf_counter()
+                    self.__dict__['_module'] = importlib.import_module(self._name)
+                    logger.info(f"📦 تم تحميل {self._name} في {(time.perf_counter() - started) * 1000:.0f} ms")
+        return self.__dict__['_module']
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.load(), attr, value)
+
+# yt_dlp وحده يستورد مئات وحدات الاستخراج، لذا لا يُحمّل إلا عند أول تنزيل
+# Pillow ليس هنا: telebot يستورد PIL.Image بنفسه، ومعالجة الصور تعمل في image_jobs.py
+yt_dlp = LazyModule('yt_dlp')
+psutil = LazyModule('psutil')
+
+HEAVY_MODULES = [yt_dlp, psutil]
+LAZY_WARMUP = os.environ.get('LAZY_WARMUP', '1') == '1'
+
+def warm_up_heavy_modules(delay=5):
+    """تحميل الوحدات الثقيلة في الخلفية بعد بدء الاستطلاع"""
+    def warm_up():
+        time.sleep(delay)
+        for module in HEAVY_MODULES:
+            try:
+                module.load()
+            except Exception as e:
+                logger.error(f"فشل التحميل المسبق للوحدة: {e}")
+    threading.Thread(target=warm_up, daemon=True).start()
 
 # ========== التهيئة ==========
 API_TOKEN = os.environ.get('BOT_TOKEN')
@@ -75,6 +109,13 @@ if not API_TOKEN:
 
 print(f"✅ تم تحميل توكن البوت بنجاح")
 
+# خادم Bot API محلي (اختياري): يرفع حد الملفات إلى 2000 ميجابايت ويسمح بتمرير المسارات مباشرة
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', '').rstrip('/')
+LOCAL_BOT_API = bool(TELEGRAM_API_URL) and os.environ.get('TELEGRAM_LOCAL_MODE', '1') == '1'
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+
 bot = telebot.TeleBot(API_TOKEN, parse_mode='HTML')
 
 # المجلد المؤقت للسحابة
@@ -83,63 +124,1240 @@ os.makedirs(TEMP_DIR, exist_ok=True)
 
 CLOUD_DEPLOYMENT = 'RAILWAY_ENVIRONMENT' in os.environ
 
+# رقم الجزء عند التشغيل كعملية عامل (python bot.py --worker N)، وإلا None
+WORKER_SHARD = int(sys.argv[sys.argv.index('--worker') + 1]) if '--worker' in sys.argv else None
+
 print(f"🌐 النشر السحابي: {CLOUD_DEPLOYMENT}")
+print(f"📡 خادم Bot API: {TELEGRAM_API_URL + (' (محلي)' if LOCAL_BOT_API else '') if TELEGRAM_API_URL else 'العام'}")
 print(f"📁 المجلد المؤقت: {TEMP_DIR}")
 
 # ========== إدارة المستخدمين ==========
 user_states = {}
 user_sessions = {}
 
-# ========== إعداد FFmpeg المحسن ==========
-def setup_environment():
-    """إعداد البيئة بما في ذلك FFmpeg مع تحسينات السحابة"""
-    try:
-        # في Railway، حاول تثبيت ffmpeg تلقائياً
-        if CLOUD_DEPLOYMENT:
-            print("🔧 جاري التحقق من FFmpeg في بيئة Railway...")
+# ========== المقاييس ==========
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))  # 0 = تعطيل نقطة /metrics
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+# تقارير /debug/<name> تكشف الروابط والمسارات وعمليات البوت، فتُخدم لعناوين loopback فقط
+# مهما كان METRICS_HOST، ولغيرها فقط مع ترويسة X-Debug-Token تطابق DEBUG_TOKEN (فارغ = محلي فقط)
+DEBUG_TOKEN = os.environ.get('DEBUG_TOKEN', '')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+class Metric:
+    """مقياس بصيغة Prometheus مع دعم التسميات (labels)"""
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values = {}
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, function=None):
+        super().__init__(name, documentation)
+        self._function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self._function is not None:
+            # قيم تُحسب لحظة القراءة: رقم واحد أو قاموس {((اسم، قيمة)، ...): الرقم}
             try:
-                # محاولة تثبيت ffmpeg باستخدام apt
-                result = subprocess.run(['apt-get', 'update'], capture_output=True, text=True)
-                result = subprocess.run(['apt-get', 'install', '-y', 'ffmpeg'], capture_output=True, text=True)
-                if result.returncode == 0:
-                    print("✅ تم تثبيت FFmpeg بنجاح في Railway")
+                result = self._function()
             except Exception as e:
-                print(f"⚠️ لا يمكن تثبيت FFmpeg تلقائياً: {e}")
+                logger.error(f"خطأ في حساب المقياس {self.name}: {e}")
+                return []
+            if isinstance(result, dict):
+                return [(self.name, tuple(sorted(labels)), value) for labels, value in result.items()]
+            return [(self.name, (), result)]
+        return super().samples()
 
-        # التحقق من وجود FFmpeg
-        result = subprocess.run(['which', 'ffmpeg'], capture_output=True, text=True)
-        if result.returncode == 0:
-            # اختبار FFmpeg
-            test_result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, timeout=10)
-            if test_result.returncode == 0:
-                print("✅ FFmpeg متاح ويعمل بشكل صحيح")
+class Histogram(Metric):
+    metric_type = 'histogram'
+    DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.setdefault(key, {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][index] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def summary(self):
+        """{التسميات: (العدد، المتوسط)} لعرضها في /status"""
+        with self._lock:
+            return {key: (state['count'], state['sum'] / state['count'])
+                    for key, state in self._values.items() if state['count']}
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, state in self._values.items():
+                for bound, count in zip(self.buckets, state['counts']):
+                    samples.append((f"{self.name}_bucket", key + (('le', str(bound)),), count))
+                samples.append((f"{self.name}_bucket", key + (('le', '+Inf'),), state['count']))
+                samples.append((f"{self.name}_sum", key, state['sum']))
+                samples.append((f"{self.name}_count", key, state['count']))
+        return samples
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation):
+        return self.register(Counter(name, documentation))
+
+    def gauge(self, name, documentation, function=None):
+        return self.register(Gauge(name, documentation, function))
+
+    def histogram(self, name, documentation, buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, buckets))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+metrics = MetricsRegistry()
+
+STAGE_DURATION = metrics.histogram('bot_stage_duration_seconds', 'مدة كل مرحلة (extract, download, postprocess, upload)')
+STAGE_ERRORS = metrics.counter('bot_stage_errors_total', 'عدد الأخطاء في كل مرحلة')
+JOBS_TOTAL = metrics.counter('bot_jobs_total', 'عدد المهام المنتهية حسب النوع والحالة')
+JOBS_IN_FLIGHT = metrics.gauge('bot_jobs_in_flight', 'عدد المهام الجارية حالياً')
+BYTES_TOTAL = metrics.counter('bot_bytes_total', 'البايتات المنقولة حسب الاتجاه (download, upload)')
+CACHE_HITS = metrics.counter('bot_cache_hits_total', 'عدد مرات الإصابة في الذاكرة المؤقتة')
+CACHE_MISSES = metrics.counter('bot_cache_misses_total', 'عدد مرات عدم الإصابة في الذاكرة المؤقتة')
+QUOTA_REJECTIONS = metrics.counter('bot_quota_rejections_total', 'المهام المرفوضة لتجاوز الحصة حسب المورد')
+
+def _directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                total += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                pass
+    return total
+
+metrics.gauge('bot_process_rss_bytes', 'الذاكرة المقيمة لعملية البوت',
+              lambda: psutil.Process().memory_info().rss)
+metrics.gauge('bot_temp_dir_bytes', 'حجم الملفات في المجلد المؤقت',
+              lambda: _directory_size(TEMP_DIR))
+metrics.gauge('bot_disk_free_bytes', 'المساحة الحرة على قرص المجلد المؤقت',
+              lambda: psutil.disk_usage(TEMP_DIR).free)
+metrics.gauge('bot_ffmpeg_active_processes', 'عدد عمليات FFmpeg الجارية',
+              lambda: transcode_executor.active_count)
+def _queue_depths():
+    depths = {(('queue', 'transcode'),): transcode_executor.waiting_count}
+    for lane, count in download_scheduler.waiting_by_lane().items():
+        depths[(('queue', f'download_{lane}'),)] = count
+    return depths
+
+metrics.gauge('bot_queue_depth', 'عدد المهام المنتظرة في كل طابور', _queue_depths)
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """نقطة HTTP محلية تعرض المقاييس بصيغة Prometheus وتقارير التشخيص في /debug/<name>"""
+
+    def do_GET(self):
+        parsed = urllib.parse.urlsplit(self.path)
+        if parsed.path == '/metrics':
+            self._reply(metrics.render(), 'text/plain; version=0.0.4; charset=utf-8')
+            return
+        name = parsed.path[len('/debug/'):] if parsed.path.startswith('/debug/') else None
+        if name is not None and not self._debug_allowed():
+            self.send_error(403)
+            return
+        if name not in DEBUG_REPORTS:
+            self.send_error(404)
+            return
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+        try:
+            report = DEBUG_REPORTS[name](params)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self._reply(report + '\n', 'text/plain; charset=utf-8')
+
+    def _debug_allowed(self):
+        try:
+            if ipaddress.ip_address(self.client_address[0]).is_loopback:
                 return True
-            else:
-                print("⚠️ FFmpeg موجود لكن لا يعمل بشكل صحيح")
-                return False
-        else:
-            print("🔧 جاري البحث عن FFmpeg في المسارات البديلة...")
-            # البحث في مسارات بديلة
-            possible_paths = [
-                '/usr/bin/ffmpeg',
-                '/usr/local/bin/ffmpeg',
-                '/app/bin/ffmpeg',
-                '/opt/bin/ffmpeg'
-            ]
-            for path in possible_paths:
-                if os.path.exists(path):
-                    print(f"✅ تم العثور على FFmpeg في: {path}")
-                    # إضافة إلى PATH
-                    os.environ["PATH"] = os.path.dirname(path) + os.pathsep + os.environ["PATH"]
-                    return True
-            
-            print("⚠️ FFmpeg غير موجود، سيتم استخدام الميزات الأساسية فقط")
-            return False
+        except ValueError:
+            pass
+        token = self.headers.get('X-Debug-Token', '')
+        return bool(DEBUG_TOKEN) and hmac.compare_digest(token.encode('utf-8'), DEBUG_TOKEN.encode('utf-8'))
+
+    def _reply(self, text, content_type):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """تشغيل خادم المقاييس في خيط خلفي"""
+    server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    access = "محلياً أو بـ X-Debug-Token" if DEBUG_TOKEN else "محلياً فقط"
+    logger.info(f"📈 نقطة المقاييس متاحة على http://{host}:{port}/metrics (والتشخيص على /debug/... {access})")
+    return server
+
+# ========== تتبع المهام ==========
+TRACE_FILE = os.environ.get('TRACE_FILE', '/tmp/bot_traces.jsonl')
+TRACE_MAX_BYTES = int(os.environ.get('TRACE_MAX_BYTES', 10 * 1024 * 1024))
+TRACE_BACKUP_COUNT = int(os.environ.get('TRACE_BACKUP_COUNT', 3))
+
+def process_trace_file(path, shard=None):
+    """ملف التتبع لهذه العملية: لكل عامل ملفه (bot_traces.w0.jsonl)
+
+    كل عملية تدوّر ملفها بنفسها، فملف مشترك بين العمليات يفقد أسطراً أو
+    يخلطها عند التدوير. trace_report.py يقرأ ملفات العمال مع الملف الرئيسي.
+    """
+    if shard is None:
+        return path
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.w{shard}{ext}"
+
+trace_logger = logging.getLogger('bot.trace')
+trace_logger.setLevel(logging.INFO)
+trace_logger.propagate = False
+try:
+    _trace_handler = logging.handlers.RotatingFileHandler(
+        process_trace_file(TRACE_FILE, WORKER_SHARD), maxBytes=TRACE_MAX_BYTES,
+        backupCount=TRACE_BACKUP_COUNT, encoding='utf-8')
+    _trace_handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_logger.addHandler(_trace_handler)
+except OSError as e:
+    logger.error(f"تعذر فتح ملف التتبع: {e}")
+
+_trace_context = threading.local()
+# مكدس تتبع كل خيط (معرف الخيط -> المكدس) حتى يعرض تفريغ الخيوط مهمة كل منها
+_thread_traces = {}
+
+def url_hash(url):
+    """معرف قصير للرابط لا يكشف محتواه في السجلات"""
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()[:12] if url else None
+
+class JobTrace:
+    """تتبع مهمة واحدة: أحداث بصيغة JSON لكل مرحلة مع معرف المهمة"""
+
+    def __init__(self, kind, chat_id, url=None, job_id=None, parent_id=None):
+        self.job_id = job_id or uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.chat_id = chat_id
+        self.url_hash = url_hash(url)
+        self.parent_id = parent_id
+        self.started = time.perf_counter()
+        self.stage = None
+        self.retries = 0
+        self.error_class = None
+
+    def emit(self, event, **fields):
+        record = {
+            'ts': round(time.time(), 3),
+            'event': event,
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'chat_id': self.chat_id,
+            'url_hash': self.url_hash,
+            'parent_id': self.parent_id,
+        }
+        record.update(fields)
+        trace_logger.info(json.dumps({k: v for k, v in record.items() if v is not None}, ensure_ascii=False))
+
+def current_trace():
+    stack = getattr(_trace_context, 'stack', None)
+    return stack[-1] if stack else None
+
+def start_job_trace(kind, chat_id, url=None, job_id=None):
+    """بدء تتبع مهمة في الخيط الحالي (المهام المتداخلة ترتبط بالمهمة الأم)"""
+    parent = current_trace()
+    if job_id is None and parent is None:
+        # المهام الموزعة تحمل معرفاً ثابتاً يبقى نفسه بعد الاستئناف
+        job_id = getattr(_trace_context, 'job_id', None)
+    trace = JobTrace(kind, chat_id, url, job_id, parent.job_id if parent else None)
+    if not hasattr(_trace_context, 'stack'):
+        _trace_context.stack = []
+    _thread_traces[threading.get_ident()] = _trace_context.stack
+    _trace_context.stack.append(trace)
+    trace.emit('job_start')
+    return trace
+
+def finish_job_trace(trace, status):
+    trace.emit('job_end', status=status,
+               duration_ms=round((time.perf_counter() - trace.started) * 1000),
+               retries=trace.retries or None, error_class=trace.error_class)
+    stack = getattr(_trace_context, 'stack', [])
+    if trace in stack:
+        stack.remove(trace)
+    if not stack:
+        _thread_traces.pop(threading.get_ident(), None)
+
+def record_stage(stage, duration, status='ok', **fields):
+    """تسجيل مرحلة منتهية في المقاييس وفي تتبع المهمة الحالية"""
+    STAGE_DURATION.observe(duration, stage=stage)
+    if status != 'ok':
+        STAGE_ERRORS.inc(stage=stage)
+    trace = current_trace()
+    if trace is not None:
+        trace.emit('stage_end', stage=stage, status=status, duration_ms=round(duration * 1000), **fields)
+
+@contextlib.contextmanager
+def stage_timer(stage, **fields):
+    """قياس مدة مرحلة وتسجيلها؛ يمكن إضافة حقول (مثل bytes) إلى القاموس المُعاد"""
+    trace = current_trace()
+    if trace is not None:
+        trace.stage = stage
+        trace.emit('stage_start', stage=stage)
+    started = time.perf_counter()
+    span = dict(fields)
+    try:
+        yield span
     except Exception as e:
-        print(f"❌ خطأ في إعداد البيئة: {e}")
+        span['error_class'] = type(e).__name__
+        record_stage(stage, time.perf_counter() - started, 'error', **span)
+        raise
+    else:
+        record_stage(stage, time.perf_counter() - started, **span)
+    finally:
+        if trace is not None:
+            trace.stage = None
+
+# ========== محاسبة الاستخدام والحصص ==========
+USAGE_DB = os.environ.get('USAGE_DB', '/tmp/telegram_bot_usage.db')
+USAGE_FLUSH_SECONDS = float(os.environ.get('USAGE_FLUSH_SECONDS', 10))
+USAGE_RETENTION_DAYS = int(os.environ.get('USAGE_RETENTION_DAYS', 30))
+
+# حصص لكل محادثة داخل نافذة منزلقة (0 = بلا حد)
+QUOTA_WINDOW_MINUTES = int(os.environ.get('QUOTA_WINDOW_MINUTES', 60))
+QUOTA_BYTES = int(os.environ.get('QUOTA_BYTES', 4 * 1024 ** 3))  # تنزيل + رفع
+QUOTA_CPU_SECONDS = int(os.environ.get('QUOTA_CPU_SECONDS', 1800))
+QUOTA_JOBS = int(os.environ.get('QUOTA_JOBS', 60))
+
+# معرفات المشرفين مفصولة بفواصل: أوامر الإدارة ولا تُطبق عليهم الحصص
+ADMIN_IDS = {int(x) for x in os.environ.get('ADMIN_IDS', '').replace(' ', '').split(',') if x.lstrip('-').isdigit()}
+
+QUOTA_LABELS = {'bytes': 'حجم البيانات', 'cpu_seconds': 'وقت المعالجة', 'jobs': 'عدد المهام'}
+
+class QuotaExceeded(Exception):
+    """استنفدت المحادثة حصتها في النافذة الحالية"""
+
+# المحادثة التي يُحتسب عليها استهلاك مهمة الخيط الحالي حين تختلف عن محادثة الإرسال
+# (التنزيل المضمن يُرسل إلى محادثة الذاكرة لكن استهلاكه على المستخدم الذي طلبه)
+_usage_context = threading.local()
+
+def billing_chat(chat_id):
+    return getattr(_usage_context, 'chat_id', None) or chat_id
+
+class UsageLedger:
+    """استهلاك كل محادثة في دلاء من دقيقة واحدة (صف واحد لكل محادثة نشطة في الدقيقة)
+
+    التسجيل يتجمع في الذاكرة ويُكتب دفعة واحدة كل USAGE_FLUSH_SECONDS، والجدول
+    مشترك بين عمليات العمال عبر SQLite.
+    """
+
+    def __init__(self, path=USAGE_DB, flush_seconds=USAGE_FLUSH_SECONDS):
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS usage (chat_id INTEGER, minute INTEGER, bytes_down INTEGER DEFAULT 0,'
+            ' bytes_up INTEGER DEFAULT 0, cpu_ms INTEGER DEFAULT 0, jobs INTEGER DEFAULT 0,'
+            ' PRIMARY KEY (chat_id, minute)) WITHOUT ROWID')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS usage_minute ON usage (minute)')
+
+    def record(self, chat_id, bytes_down=0, bytes_up=0, cpu_seconds=0, jobs=0):
+        chat_id = billing_chat(chat_id)
+        if chat_id is None:
+            return
+        key = (chat_id, int(time.time() // 60))
+        with self._lock:
+            bucket = self._pending.setdefault(key, [0, 0, 0, 0])
+            bucket[0] += int(bytes_down)
+            bucket[1] += int(bytes_up)
+            bucket[2] += int(cpu_seconds * 1000)
+            bucket[3] += jobs
+            due = time.monotonic() - self._last_flush >= self.flush_seconds
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            if not pending:
+                return
+            try:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.executemany(
+                    'INSERT INTO usage (chat_id, minute, bytes_down, bytes_up, cpu_ms, jobs) VALUES (?, ?, ?, ?, ?, ?)'
+                    ' ON CONFLICT (chat_id, minute) DO UPDATE SET bytes_down = bytes_down + excluded.bytes_down,'
+                    ' bytes_up = bytes_up + excluded.bytes_up, cpu_ms = cpu_ms + excluded.cpu_ms,'
+                    ' jobs = jobs + excluded.jobs',
+                    [key + tuple(values) for key, values in pending.items()])
+                self._conn.execute('DELETE FROM usage WHERE minute < ?',
+                                   (int(time.time() // 60) - USAGE_RETENTION_DAYS * 1440,))
+                self._conn.execute('COMMIT')
+            except sqlite3.Error as e:
+                logger.error(f"خطأ في حفظ سجل الاستخدام: {e}")
+                try:
+                    self._conn.execute('ROLLBACK')
+                except sqlite3.Error:
+                    pass
+                # إعادة الدلاء غير المحفوظة إلى الذاكرة للمحاولة في المرة القادمة
+                for key, values in pending.items():
+                    bucket = self._pending.setdefault(key, [0, 0, 0, 0])
+                    for i, value in enumerate(values):
+                        bucket[i] += value
+
+    @staticmethod
+    def _row(row):
+        bytes_down, bytes_up, cpu_ms, jobs = (value or 0 for value in row)
+        return {'bytes_down': bytes_down, 'bytes_up': bytes_up, 'bytes': bytes_down + bytes_up,
+                'cpu_seconds': cpu_ms / 1000, 'jobs': jobs}
+
+    def usage(self, chat_id, minutes=QUOTA_WINDOW_MINUTES):
+        """مجموع استهلاك المحادثة في آخر minutes دقيقة"""
+        self.flush()
+        since = int(time.time() // 60) - minutes + 1
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT SUM(bytes_down), SUM(bytes_up), SUM(cpu_ms), SUM(jobs) FROM usage'
+                ' WHERE chat_id = ? AND minute >= ?', (chat_id, since)).fetchone()
+        return self._row(row)
+
+    def top(self, minutes=QUOTA_WINDOW_MINUTES, limit=10):
+        """أكثر المحادثات استهلاكاً للبيانات: [(chat_id، الاستهلاك)]"""
+        self.flush()
+        since = int(time.time() // 60) - minutes + 1
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT chat_id, SUM(bytes_down), SUM(bytes_up), SUM(cpu_ms), SUM(jobs) FROM usage'
+                ' WHERE minute >= ? GROUP BY chat_id'
+                ' ORDER BY SUM(bytes_down) + SUM(bytes_up) DESC, SUM(cpu_ms) DESC LIMIT ?',
+                (since, limit)).fetchall()
+        return [(row[0], self._row(row[1:])) for row in rows]
+
+    def retry_after(self, chat_id, resource, excess, minutes=QUOTA_WINDOW_MINUTES):
+        """ثوانٍ حتى تخرج من النافذة دلاء قديمة تكفي لتحرير excess من المورد"""
+        column = {'bytes': 'bytes_down + bytes_up', 'cpu_seconds': 'cpu_ms / 1000.0', 'jobs': 'jobs'}[resource]
+        since = int(time.time() // 60) - minutes + 1
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT minute, {column} FROM usage WHERE chat_id = ? AND minute >= ? ORDER BY minute',
+                (chat_id, since)).fetchall()
+        freed = 0
+        for minute, value in rows:
+            freed += value or 0
+            if freed >= excess:
+                return max(60, int((minute + minutes) * 60 - time.time()))
+        return minutes * 60
+
+usage_ledger = UsageLedger()
+
+def quota_limits():
+    return {'bytes': QUOTA_BYTES, 'cpu_seconds': QUOTA_CPU_SECONDS, 'jobs': QUOTA_JOBS}
+
+def check_quota(chat_id, extra_bytes=0, extra_jobs=0):
+    """رفع QuotaExceeded إذا كانت المحادثة ستتجاوز إحدى حصصها بهذه المهمة
+
+    الحجم المقدر لمهمة واحدة لا يُرفض وحده في نافذة فارغة، حتى لا يصبح
+    ملف أكبر من الحصة ممنوعاً إلى الأبد.
+    """
+    chat_id = billing_chat(chat_id)
+    if chat_id is None or chat_id in ADMIN_IDS or chat_id == CACHE_CHAT_ID:
+        return
+    used = usage_ledger.usage(chat_id)
+    extra = {'bytes': extra_bytes, 'cpu_seconds': 0, 'jobs': extra_jobs}
+    for resource, limit in quota_limits().items():
+        # عدد المهام يُفحص عند قبول مهمة جديدة فقط، لا في مراحلها اللاحقة
+        if not limit or (resource == 'jobs' and not extra_jobs):
+            continue
+        total = used[resource] + (extra[resource] if used[resource] else min(extra[resource], limit))
+        if used[resource] >= limit or total > limit:
+            QUOTA_REJECTIONS.inc(resource=resource)
+            seconds = usage_ledger.retry_after(chat_id, resource, total - limit)
+            raise QuotaExceeded(f"🚫 تجاوزت حد {QUOTA_LABELS[resource]} المسموح - "
+                                f"يمكنك المحاولة بعد {max(1, seconds // 60)} دقيقة")
+
+# ========== أدوات التشخيص للمشرفين ==========
+PROFILE_MAX_SECONDS = int(os.environ.get('PROFILE_MAX_SECONDS', 60))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))  # ثوانٍ بين العينات
+TRACEMALLOC_FRAMES = int(os.environ.get('TRACEMALLOC_FRAMES', 1))
+if os.environ.get('TRACEMALLOC_AT_START') == '1':
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+
+# خيط ينتهي مكدسه بأحد هذه الإطارات ينتظر قفلاً أو شبكة ولا يستهلك المعالج
+IDLE_FRAMES = {
+    ('threading.py', 'wait'), ('threading.py', '_wait_for_tstate_lock'), ('queue.py', 'get'),
+    ('selectors.py', 'select'), ('socket.py', 'readinto'), ('socket.py', 'accept'), ('ssl.py', 'read'),
+    ('socketserver.py', 'serve_forever'), ('subprocess.py', '_try_wait'), ('connection.py', '_recv'),
+}
+
+_profile_lock = threading.Lock()
+_last_snapshot = None
+
+def _frame_label(frame, with_line=True):
+    code = frame.f_code
+    location = f"{os.path.basename(code.co_filename)}:{frame.f_lineno}" if with_line else os.path.basename(code.co_filename)
+    return f"{location} {code.co_name}"
+
+def thread_dump(max_frames=8):
+    """كل الخيوط مع المهمة والمرحلة الجارية فيها وآخر إطارات المكدس"""
+    frames = sys._current_frames()
+    threads = sorted(threading.enumerate(), key=lambda t: t.name)
+    lines = [f"threads: {len(threads)}, jobs in flight: {int(JOBS_IN_FLIGHT.value())}", ""]
+    for thread in threads:
+        lines.append(f"--- {thread.name} (ident={thread.ident}{', daemon' if thread.daemon else ''})")
+        for trace in list(_thread_traces.get(thread.ident, ())):
+            lines.append(f"    job {trace.job_id} kind={trace.kind} chat={trace.chat_id} stage={trace.stage or '-'} "
+                         f"elapsed={time.perf_counter() - trace.started:.1f}s")
+        frame = frames.get(thread.ident)
+        if frame is not None:
+            for entry in traceback.extract_stack(frame)[-max_frames:]:
+                lines.append(f"      {os.path.basename(entry.filename)}:{entry.lineno} {entry.name}")
+    return '\n'.join(lines)
+
+def memory_top(limit=15, action=None):
+    """أكبر التخصيصات حسب السطر، مع النمو منذ اللقطة السابقة لكشف التسربات
+
+    التتبع يبطئ التخصيص، لذا يبدأ عند أول طلب (أو TRACEMALLOC_AT_START=1)
+    ويُوقف بـ action='stop'.
+    """
+    global _last_snapshot
+    if action == 'stop':
+        tracemalloc.stop()
+        _last_snapshot = None
+        return "تم إيقاف تتبع الذاكرة"
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        return "بدأ تتبع الذاكرة - أعد الطلب بعد قليل لعرض أكبر التخصيصات"
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"traced: {current / (1024 * 1024):.1f} MB (peak {peak / (1024 * 1024):.1f} MB)", "", "top allocations:"]
+    for stat in snapshot.statistics('lineno')[:limit]:
+        frame = stat.traceback[0]
+        lines.append(f"{stat.size / 1024:>10.1f} KiB {stat.count:>8} blocks  {frame.filename}:{frame.lineno}")
+    if _last_snapshot is not None:
+        lines += ["", "growth since last snapshot:"]
+        for stat in snapshot.compare_to(_last_snapshot, 'lineno')[:limit]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size_diff / 1024:>+10.1f} KiB {stat.count_diff:>+8} blocks  {frame.filename}:{frame.lineno}")
+    _last_snapshot = snapshot
+    return '\n'.join(lines)
+
+def sample_profile(seconds=10, interval=PROFILE_INTERVAL, limit=20):
+    """تحليل أداء بأخذ عينات من مكدسات كل الخيوط دون إعادة تشغيل أو أدوات خارجية
+
+    الوقت الذاتي هو الإطار الأخير في المكدس، والتراكمي أي ظهور للدالة فيه.
+    عمليات FFmpeg الفرعية لا تظهر هنا (انظر process_resources).
+    """
+    seconds = max(1.0, min(float(seconds), PROFILE_MAX_SECONDS))
+    if not _profile_lock.acquire(blocking=False):
+        return "يوجد تحليل أداء جارٍ بالفعل"
+    try:
+        me = threading.get_ident()
+        own = collections.Counter()
+        cumulative = collections.Counter()
+        samples = idle = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                samples += 1
+                if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+                    idle += 1
+                    continue
+                own[_frame_label(frame)] += 1
+                seen = set()
+                while frame is not None:
+                    label = _frame_label(frame, with_line=False)
+                    if label not in seen:
+                        seen.add(label)
+                        cumulative[label] += 1
+                    frame = frame.f_back
+            time.sleep(interval)
+    finally:
+        _profile_lock.release()
+
+    busy = samples - idle
+    lines = [f"{seconds:.0f}s, {samples} thread samples, {busy} busy / {idle} waiting", "", "self (busy samples):"]
+    for label, count in own.most_common(limit):
+        lines.append(f"{100 * count / max(1, busy):>6.1f}%  {label}")
+    lines += ["", "cumulative:"]
+    for label, count in cumulative.most_common(limit):
+        lines.append(f"{100 * count / max(1, busy):>6.1f}%  {label}")
+    return '\n'.join(lines)
+
+def process_resources(limit=10):
+    """الملفات المفتوحة والاتصالات والعمليات الفرعية للبوت"""
+    process = psutil.Process()
+    with process.oneshot():
+        open_files = process.open_files()
+        connections = getattr(process, 'net_connections', process.connections)()
+        fds = process.num_fds() if hasattr(process, 'num_fds') else '-'
+        lines = [f"pid {process.pid}: threads={process.num_threads()} fds={fds} "
+                 f"rss={process.memory_info().rss / (1024 * 1024):.1f} MB",
+                 f"open files: {len(open_files)}, connections: {len(connections)}", ""]
+    # تجميع الملفات حسب المجلد يكشف التسرب (مثلاً مجلدات مهام لا تُغلق ملفاتها)
+    by_dir = collections.Counter(os.path.dirname(f.path) for f in open_files)
+    lines.append("open files by directory:")
+    lines += [f"{count:>6}  {directory}" for directory, count in by_dir.most_common(limit)]
+    children = process.children(recursive=True)
+    lines += ["", f"child processes: {len(children)}"]
+    for child in children:
+        try:
+            with child.oneshot():
+                cpu = child.cpu_times()
+                lines.append(f"  {child.pid} {child.name()} {child.status()} "
+                             f"age={time.time() - child.create_time():.0f}s cpu={cpu.user + cpu.system:.1f}s "
+                             f"rss={child.memory_info().rss / (1024 * 1024):.1f} MB  {' '.join(child.cmdline())[:120]}")
+        except psutil.Error:
+            continue
+    return '\n'.join(lines)
+
+# التقارير المتاحة في /debug للمشرفين وفي /debug/<name> على خادم المقاييس
+DEBUG_REPORTS = {
+    'threads': lambda params: thread_dump(),
+    'memory': lambda params: memory_top(action=params.get('action')),
+    'profile': lambda params: sample_profile(params.get('seconds', 10)),
+    'resources': lambda params: process_resources(),
+}
+
+# ========== اكتشاف قدرات FFmpeg ==========
+# يتم تثبيت FFmpeg أثناء البناء (nixpacks.toml) وليس عند كل تشغيل،
+# ونتائج الفحص تُخزن في ملف صغير خارج المجلد المؤقت حتى لا يحذفها التنظيف
+CAPABILITIES_FILE = os.environ.get('CAPABILITIES_FILE', '/tmp/telegram_bot_capabilities.json')
+CAPABILITIES_VERSION = 1
+
+FFMPEG_FALLBACK_DIRS = ['/usr/bin', '/usr/local/bin', '/app/bin', '/opt/bin']
+
+def _find_binary(name):
+    """البحث عن ملف تنفيذي في PATH ثم في المسارات البديلة"""
+    path = shutil.which(name)
+    if path:
+        return path
+    for directory in FFMPEG_FALLBACK_DIRS:
+        candidate = os.path.join(directory, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+def _binary_fingerprint(path):
+    """بصمة رخيصة للملف التنفيذي (الحجم ووقت التعديل) دون تشغيله"""
+    try:
+        stat = os.stat(path)
+        return [stat.st_size, int(stat.st_mtime)]
+    except OSError:
+        return None
+
+def probe_ffmpeg_capabilities():
+    """تشغيل FFmpeg لاكتشاف المسار والإصدار والمرمزات المتاحة"""
+    ffmpeg_path = _find_binary('ffmpeg')
+    capabilities = {
+        'schema': CAPABILITIES_VERSION,
+        'ffmpeg': ffmpeg_path,
+        'ffprobe': _find_binary('ffprobe'),
+        'fingerprint': _binary_fingerprint(ffmpeg_path) if ffmpeg_path else None,
+        'version': None,
+        'encoders': [],
+    }
+    if not ffmpeg_path:
+        return capabilities
+    try:
+        result = subprocess.run([ffmpeg_path, '-version'], capture_output=True, text=True, timeout=10)
+        if result.returncode == 0 and result.stdout:
+            capabilities['version'] = result.stdout.splitlines()[0]
+        result = subprocess.run([ffmpeg_path, '-hide_banner', '-encoders'], capture_output=True, text=True, timeout=10)
+        if result.returncode == 0:
+            listing = result.stdout.split('------', 1)[-1]
+            capabilities['encoders'] = sorted(
+                line.split()[1] for line in listing.splitlines() if len(line.split()) > 1)
+    except Exception as e:
+        logger.error(f"خطأ في فحص FFmpeg: {e}")
+    return capabilities
+
+def _capabilities_still_valid(capabilities):
+    """التحقق السريع من أن الملف المخزن ما زال يطابق البيئة الحالية"""
+    if capabilities.get('schema') != CAPABILITIES_VERSION:
         return False
+    ffmpeg_path = capabilities.get('ffmpeg')
+    if not ffmpeg_path:
+        # لم يكن FFmpeg موجوداً سابقاً؛ نعيد الفحص فقط إذا ظهر الآن
+        return _find_binary('ffmpeg') is None
+    if not capabilities.get('version'):
+        # فحص فاشل (انتهاء مهلة مثلاً) لا يُعتمد عليه حتى لا يبقى FFmpeg معطلاً
+        return False
+    return _binary_fingerprint(ffmpeg_path) == capabilities.get('fingerprint')
+
+def load_capabilities(force_probe=False):
+    """تحميل قدرات FFmpeg من الملف المخزن أو إعادة اكتشافها عند تغيرها"""
+    if not force_probe:
+        try:
+            with open(CAPABILITIES_FILE, 'r', encoding='utf-8') as f:
+                capabilities = json.load(f)
+            if _capabilities_still_valid(capabilities):
+                return capabilities
+        except (OSError, ValueError):
+            pass
+
+    capabilities = probe_ffmpeg_capabilities()
+    try:
+        tmp_path = CAPABILITIES_FILE + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(capabilities, f)
+        os.replace(tmp_path, CAPABILITIES_FILE)
+    except OSError as e:
+        logger.error(f"تعذر حفظ ملف القدرات: {e}")
+    return capabilities
+
+def setup_environment():
+    """إعداد البيئة والتحقق من FFmpeg باستخدام القدرات المخزنة"""
+    capabilities = load_capabilities()
+    ffmpeg_path = capabilities.get('ffmpeg')
+    if ffmpeg_path and capabilities.get('version'):
+        ffmpeg_dir = os.path.dirname(ffmpeg_path)
+        if ffmpeg_dir not in os.environ.get("PATH", "").split(os.pathsep):
+            os.environ["PATH"] = ffmpeg_dir + os.pathsep + os.environ.get("PATH", "")
+        print(f"✅ FFmpeg متاح: {capabilities['version']}")
+        return capabilities
+    print("⚠️ FFmpeg غير موجود، سيتم استخدام الميزات الأساسية فقط")
+    return capabilities
+
+FFMPEG_CAPABILITIES = setup_environment()
+FFMPEG_AVAILABLE = bool(FFMPEG_CAPABILITIES.get('ffmpeg') and FFMPEG_CAPABILITIES.get('version'))
+FFMPEG_ENCODERS = set(FFMPEG_CAPABILITIES.get('encoders', []))
+
+# ========== خدمة معالجة الصور ==========
+# الدوال التي تعمل داخل عمليات العمال في image_jobs.py (وحدة بلا آثار جانبية عند الاستيراد)
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', os.cpu_count() or 1))
+IMAGE_JOB_TIMEOUT = int(os.environ.get('IMAGE_JOB_TIMEOUT', 60))
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 40000000))
+IMAGE_WORKER_MAX_TASKS = int(os.environ.get('IMAGE_WORKER_MAX_TASKS', 200))  # 0 = بلا إعادة تدوير
+IMAGE_TARGET_BYTES = int(os.environ.get('IMAGE_TARGET_BYTES', 0))  # 0 = جودة ثابتة بدلاً من حجم مستهدف
+IMAGE_MAX_SIDE = int(os.environ.get('IMAGE_MAX_SIDE', 0))  # 0 = الأبعاد الأصلية
+IMAGE_WORKER_SCRIPT = image_jobs.__file__
+
+def parse_image_options(text):
+    """خيارات المحول من تعليق الصورة: webp|jpg، 500kb|2mb (حجم مستهدف)، 1280 (أطول ضلع)، q80 (جودة)"""
+    options = {'format': 'jpg', 'max_side': IMAGE_MAX_SIDE, 'target_bytes': IMAGE_TARGET_BYTES,
+               'quality': IMAGE_DEFAULT_QUALITY}
+    for token in (text or '').lower().replace(',', ' ').split():
+        size = re.fullmatch(r'(\d+(?:\.\d+)?)(kb|k|mb|m)', token)
+        if token in IMAGE_OUTPUT_FORMATS or token == 'jpeg':
+            options['format'] = 'jpg' if token == 'jpeg' else token
+        elif size:
+            unit = 1024 * 1024 if size.group(2).startswith('m') else 1024
+            options['target_bytes'] = int(float(size.group(1)) * unit)
+        elif re.fullmatch(r'\d+(px)?', token):
+            options['max_side'] = int(token.rstrip('px'))
+        elif re.fullmatch(r'q\d+', token):
+            options['quality'] = max(IMAGE_MIN_QUALITY, min(IMAGE_MAX_QUALITY, int(token[1:])))
+        else:
+            raise ValueError(f"خيار غير معروف: {token}")
+    if options['target_bytes'] and options['target_bytes'] < 10 * 1024:
+        raise ValueError("الحجم المستهدف صغير جداً (الحد الأدنى 10kb)")
+    if options['max_side'] and options['max_side'] < 16:
+        raise ValueError("أطول ضلع صغير جداً")
+    return options
+
+class ImageWorker:
+    """عملية معالجة صور واحدة يمكن إنهاؤها وحدها دون التأثير على بقية المهام
+
+    العملية تشغّل image_jobs.py مباشرة: لا تعيد استيراد bot.py (البوت وخيوطه
+    وقواعد البيانات والسجلات) كما يفعل multiprocessing مع spawn، ولا ترث خيوط
+    البوت كما مع fork.
+    """
+
+    def __init__(self):
+        # نفس مسارات الاستيراد حتى تجد العملية الفرعية الوحدات التي يجدها البوت
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+        self.process = subprocess.Popen([sys.executable, IMAGE_WORKER_SCRIPT], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, env=env)
+        self.tasks = 0
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def call(self, job, args, timeout):
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            self.process.kill()
+
+        timer = threading.Timer(timeout, expire)
+        timer.start()
+        try:
+            pickle.dump((job, args), self.process.stdin)
+            self.process.stdin.flush()
+            ok, value = pickle.load(self.process.stdout)
+        except (EOFError, OSError, pickle.UnpicklingError):
+            if expired.is_set():
+                raise concurrent.futures.TimeoutError()
+            raise EOFError()
+        finally:
+            timer.cancel()
+        self.tasks += 1
+        if not ok:
+            raise ImageProcessingError(value)
+        return value
+
+    def stop(self):
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+        if self.alive():
+            self.process.terminate()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+class ImageProcessingService:
+    """تشغيل تحويلات Pillow في عمليات منفصلة حتى لا تحجب خيوط البوت
+
+    كل مهمة تُنفذ في عامل محجوز لها، فانتهاء مهلة مهمة يُنهي عاملها فقط.
+    run تحجز الخيط المستدعي حتى تنتهي المهمة، لذا تُستدعى من خيوط المهام
+    (dispatch_job) لا من معالجات الرسائل.
+    """
+
+    def __init__(self, max_workers=IMAGE_WORKERS, timeout=IMAGE_JOB_TIMEOUT, max_pixels=IMAGE_MAX_PIXELS,
+                 max_tasks=IMAGE_WORKER_MAX_TASKS):
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.max_pixels = max_pixels
+        self.max_tasks = max_tasks
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._busy = set()
+
+    def _checkout(self):
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.alive():
+                    self._busy.add(worker)
+                    return worker
+                worker.stop()
+        worker = ImageWorker()
+        with self._lock:
+            self._busy.add(worker)
+        return worker
+
+    def _checkin(self, worker, healthy):
+        with self._lock:
+            self._busy.discard(worker)
+            # إعادة تدوير العامل بعد عدد من المهام تحد من تراكم ذاكرة Pillow
+            if healthy and (not self.max_tasks or worker.tasks < self.max_tasks):
+                self._idle.append(worker)
+                return
+        worker.stop()
+
+    def start(self):
+        """تهيئة العمليات مسبقاً قبل بدء الاستطلاع"""
+        workers = [ImageWorker() for _ in range(self.max_workers)]
+        for worker in workers:
+            try:
+                worker.call(image_jobs.warmup, (), timeout=30)
+            except Exception as e:
+                logger.error(f"فشل تهيئة عامل معالجة الصور: {e}")
+                worker.stop()
+                continue
+            with self._lock:
+                self._idle.append(worker)
+        logger.info(f"🖼️ خدمة معالجة الصور جاهزة ({len(self._idle)} عملية)")
+
+    def run(self, job, src_path, dst_path, *args):
+        """تنفيذ مهمة معالجة وإرجاع نتيجتها (مسار الملف الناتج عادةً)"""
+        with self._slots:
+            worker = self._checkout()
+            healthy = False
+            try:
+                result = worker.call(job, (src_path, dst_path, self.max_pixels) + args, self.timeout)
+                healthy = True
+                return result
+            except ImageProcessingError:
+                healthy = True
+                raise
+            except concurrent.futures.TimeoutError:
+                logger.error(f"انتهت مهلة معالجة الصورة: {src_path}")
+                raise ImageProcessingError("انتهت مهلة معالجة الصورة")
+            except (EOFError, OSError):
+                logger.error("توقفت عملية معالجة الصور بشكل غير متوقع")
+                raise ImageProcessingError("توقفت عملية المعالجة بشكل غير متوقع")
+            finally:
+                self._checkin(worker, healthy)
+
+    def shutdown(self):
+        with self._lock:
+            workers = self._idle + list(self._busy)
+            self._idle, self._busy = [], set()
+        for worker in workers:
+            worker.stop()
+
+image_service = ImageProcessingService()
+
+# ========== منفذ عمليات FFmpeg ==========
+FFMPEG_MAX_PROCESSES = int(os.environ.get('FFMPEG_MAX_PROCESSES', max(1, (os.cpu_count() or 1) // 2)))
+FFMPEG_THREADS = int(os.environ.get('FFMPEG_THREADS', max(1, (os.cpu_count() or 1) // FFMPEG_MAX_PROCESSES)))
+
+# لكل نوع مهمة: (ترتيب الخدمة في الطابور، قيمة nice للعملية)
+TRANSCODE_PRIORITIES = {
+    'interactive': (0, 0),
+    'audio': (1, 5),
+    'video': (2, 10),
+    'background': (3, 15),
+}
+
+class TranscodeCancelled(Exception):
+    """تم إلغاء مهمة التحويل من قبل المستخدم"""
+
+class TranscodeJob:
+    """مهمة FFmpeg واحدة قيد الانتظار أو التشغيل"""
+
+    def __init__(self, chat_id, job_type):
+        self.chat_id = chat_id
+        self.job_type = job_type
+        self.process = None
+        self.cancelled = False
+        self.timed_out = False
+        self.progress = 0.0
+        self.cpu_seconds = 0.0
+
+    def cancel(self):
+        self.cancelled = True
+        if self.process and self.process.poll() is None:
+            try:
+                self.process.terminate()
+            except Exception:
+                pass
+
+class TranscodeExecutor:
+    """نقطة مركزية لتشغيل FFmpeg مع حد للعمليات المتزامنة وأولويات وإلغاء"""
+
+    def __init__(self, max_processes=FFMPEG_MAX_PROCESSES, threads=FFMPEG_THREADS):
+        self.max_processes = max(1, max_processes)
+        self.threads = max(1, threads)
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = []
+        self._seq = itertools.count()
+        self._jobs = {}
+
+    @property
+    def active_count(self):
+        return self._active
+
+    @property
+    def waiting_count(self):
+        return len(self._waiting)
+
+    def track(self, job):
+        """تسجيل مهمة باسم المحادثة حتى يمكن إلغاؤها"""
+        with self._cond:
+            self._jobs.setdefault(job.chat_id, set()).add(job)
+
+    def untrack(self, job):
+        with self._cond:
+            jobs = self._jobs.get(job.chat_id)
+            if jobs is not None:
+                jobs.discard(job)
+                if not jobs:
+                    del self._jobs[job.chat_id]
+
+    def _acquire(self, job):
+        """انتظار مكان شاغر بحسب أولوية نوع المهمة"""
+        priority = TRANSCODE_PRIORITIES.get(job.job_type, TRANSCODE_PRIORITIES['background'])[0]
+        ticket = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            while not job.cancelled and (self._active >= self.max_processes or self._waiting[0] != ticket):
+                self._cond.wait()
+            if job.cancelled:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise TranscodeCancelled("تم إلغاء المهمة")
+            heapq.heappop(self._waiting)
+            self._active += 1
+
+    def _release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def acquire_slot(self, chat_id=None, job_type='video'):
+        """حجز مكان لعملية FFmpeg يشغلها طرف آخر (مثل معالجات yt-dlp اللاحقة)"""
+        job = TranscodeJob(chat_id, job_type)
+        self.track(job)
+        try:
+            self._acquire(job)
+        except TranscodeCancelled:
+            self.untrack(job)
+            raise
+        return job
+
+    def release_slot(self, job):
+        self.untrack(job)
+        self._release()
+
+    def cancel_chat(self, chat_id):
+        """إلغاء جميع مهام FFmpeg الخاصة بمحادثة معينة"""
+        with self._cond:
+            jobs = list(self._jobs.get(chat_id, ()))
+            for job in jobs:
+                job.cancel()
+            self._cond.notify_all()
+        return len(jobs)
+
+    def build_command(self, args):
+        """إضافة خيارات التقدم وعدد الخيوط إلى أمر FFmpeg (المخرج هو آخر وسيط)"""
+        return (['ffmpeg', '-hide_banner', '-nostdin', '-nostats', '-progress', 'pipe:1']
+                + list(args[:-1]) + ['-threads', str(self.threads), args[-1]])
+
+    def run(self, args, chat_id=None, job_type='interactive', duration=None, on_progress=None, timeout=None):
+        """تشغيل FFmpeg وانتظار انتهائه مع تتبع التقدم من -progress"""
+        job = TranscodeJob(chat_id, job_type)
+        self.track(job)
+        try:
+            self._acquire(job)
+            try:
+                return self._execute(job, self.build_command(args), duration, on_progress, timeout)
+            finally:
+                self._release()
+                usage_ledger.record(chat_id, cpu_seconds=job.cpu_seconds)
+        finally:
+            self.untrack(job)
+
+    def _execute(self, job, cmd, duration, on_progress, timeout):
+        job.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        nice = TRANSCODE_PRIORITIES.get(job.job_type, TRANSCODE_PRIORITIES['background'])[1]
+        try:
+            ps_process = psutil.Process(job.process.pid)
+        except Exception:
+            ps_process = None
+        if nice and os.name == 'posix' and ps_process is not None:
+            try:
+                ps_process.nice(nice)
+            except Exception:
+                pass
+
+        def sample_cpu():
+            # وقت المعالج لا يُقرأ بعد انتهاء العملية، فنأخذه مع كل تقرير تقدم
+            if ps_process is not None:
+                try:
+                    times = ps_process.cpu_times()
+                    job.cpu_seconds = times.user + times.system
+                except Exception:
+                    pass
+
+        # قراءة stderr في خيط منفصل لتجنب امتلاء الأنبوب
+        stderr_tail = []
+        def drain_stderr():
+            for line in job.process.stderr:
+                stderr_tail.append(line)
+                del stderr_tail[:-50]
+        stderr_thread = threading.Thread(target=drain_stderr, daemon=True)
+        stderr_thread.start()
+
+        timer = None
+        if timeout:
+            def on_timeout():
+                job.timed_out = True
+                job.cancel()
+            timer = threading.Timer(timeout, on_timeout)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            for line in job.process.stdout:
+                key, _, value = line.strip().partition('=')
+                if key == 'out_time_us' and duration and value.isdigit():
+                    job.progress = min(1.0, int(value) / 1000000 / duration)
+                    if on_progress:
+                        on_progress(job.progress)
+                elif key == 'progress':
+                    sample_cpu()
+                    if value == 'end':
+                        job.progress = 1.0
+            sample_cpu()
+            returncode = job.process.wait()
+            stderr_thread.join(timeout=5)
+        finally:
+            if timer:
+                timer.cancel()
+            if job.process.poll() is None:
+                job.process.kill()
+
+        if job.timed_out:
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        if job.cancelled:
+            raise TranscodeCancelled("تم إلغاء المهمة")
+        return subprocess.CompletedProcess(cmd, returncode, '', ''.join(stderr_tail))
+
+transcode_executor = TranscodeExecutor()
+
+class YdlTranscodeGate:
+    """ربط معالجات yt-dlp اللاحقة بمنفذ FFmpeg المركزي"""
+
+    def __init__(self, chat_id, job_type):
+        self.chat_id = chat_id
+        self.job_type = job_type
+        self._slot = None
+        # رمز يسمح لأمر /cancel بإيقاف التنزيل نفسه أيضاً
+        self._token = TranscodeJob(chat_id, job_type)
+        transcode_executor.track(self._token)
+        self._pp_started = None
+        self.postprocess_seconds = 0.0
+        self.downloaded_bytes = 0
+
+    def postprocessor_hook(self, d):
+        status = d.get('status')
+        if status == 'started':
+            self._pp_started = time.perf_counter()
+        elif status == 'finished' and self._pp_started is not None:
+            self.postprocess_seconds += time.perf_counter() - self._pp_started
+            self._pp_started = None
+        if not str(d.get('postprocessor', '')).startswith('FFmpeg'):
+            return
+        if status == 'started' and self._slot is None:
+            self._slot = transcode_executor.acquire_slot(self.chat_id, self.job_type)
+        elif status == 'finished':
+            self.release()
+
+    def progress_hook(self, d):
+        if self._token.cancelled:
+            raise TranscodeCancelled("تم إلغاء المهمة")
+        if d.get('status') == 'finished':
+            self.downloaded_bytes += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+
+    def observe_stages(self, elapsed, status='ok'):
+        """تقسيم زمن ydl.download بين مرحلتي التنزيل والمعالجة اللاحقة"""
+        postprocess = self.postprocess_seconds
+        record_stage('download', max(0.0, elapsed - postprocess), status, bytes=self.downloaded_bytes or None)
+        if postprocess:
+            record_stage('postprocess', postprocess, status)
+        if self.downloaded_bytes:
+            BYTES_TOTAL.inc(self.downloaded_bytes, direction='download')
+        # FFmpeg هنا يشغله yt-dlp فيُحتسب زمن المعالجة اللاحقة تقريباً لوقت المعالج
+        usage_ledger.record(self.chat_id, bytes_down=self.downloaded_bytes, cpu_seconds=postprocess)
+        self.postprocess_seconds = 0.0
+        self.downloaded_bytes = 0
 
-FFMPEG_AVAILABLE = setup_environment()
+    @contextlib.contextmanager
+    def external_ffmpeg(self, work_dir):
+        """FFmpeg يشغّله yt-dlp أثناء التنزيل نفسه (تنزيل المقاطع)
+
+        يُحجز له مكان في المنفذ مثل المعالجات اللاحقة، وعند /cancel تُنهى
+        عمليات FFmpeg الفرعية التي تكتب في مجلد المهمة (المجلد خاص بها).
+        """
+        if self._slot is None:
+            self._slot = transcode_executor.acquire_slot(self.chat_id, self.job_type)
+        slot = self._slot
+        done = threading.Event()
+
+        def watch():
+            while not done.wait(0.5):
+                if not (slot.cancelled or self._token.cancelled):
+                    continue
+                for child in psutil.Process().children(recursive=True):
+                    try:
+                        if any(work_dir in part for part in child.cmdline()):
+                            child.terminate()
+                    except psutil.Error:
+                        pass
+                return
+
+        threading.Thread(target=watch, daemon=True).start()
+        try:
+            yield
+        finally:
+            done.set()
+            self.release()
+            if slot.cancelled or self._token.cancelled:
+                raise TranscodeCancelled("تم إلغاء المهمة")
+
+    def release(self):
+        if self._slot is not None:
+            transcode_executor.release_slot(self._slot)
+            self._slot = None
+
+    def close(self):
+        self.release()
+        transcode_executor.untrack(self._token)
 
 # ========== نظام التنظيف التلقائي ==========
 class AutoCleanup:
@@ -179,8 +1397,8 @@ class AutoCleanup:
             self.cleanup_thread.join(timeout=5)
         logger.info("🛑 إيقاف التنظيف التلقائي")
     
-    def cleanup_temp_files(self, max_age_minutes=30):
-        """تنظيف الملفات المؤقتة"""
+    def cleanup_temp_files(self, max_age_minutes=30, keep=()):
+        """تنظيف الملفات المؤقتة (keep: مجلدات مهام محفوظة للاستئناف لا تُحذف)"""
         try:
             current_time = time.time()
             deleted_files = 0
@@ -205,6 +1423,18 @@ class AutoCleanup:
                             total_size += file_size
                     except Exception as e:
                         logger.error(f"خطأ في حذف {filename}: {e}")
+                elif os.path.isdir(file_path) and filename.startswith('job_') and filename not in keep:
+                    # مجلدات المهام: العمر بحسب أحدث ملف بداخلها حتى لا نحذف تنزيلاً جارياً
+                    try:
+                        latest = max([os.path.getmtime(file_path)] + [
+                            os.path.getmtime(os.path.join(file_path, name)) for name in os.listdir(file_path)])
+                        cloud_max_age = 30 if CLOUD_DEPLOYMENT else max_age_minutes
+                        if (current_time - latest) / 60 > cloud_max_age:
+                            total_size += _directory_size(file_path)
+                            shutil.rmtree(file_path, ignore_errors=True)
+                            deleted_files += 1
+                    except Exception as e:
+                        logger.error(f"خطأ في حذف {filename}: {e}")
             
             if deleted_files > 0:
                 size_mb = total_size / (1024 * 1024)
@@ -306,26 +1536,59 @@ def format_duration(duration):
     except:
         return "غير معروف"
 
+CLIP_MAX_SECONDS = int(os.environ.get('CLIP_MAX_SECONDS', 900))
+
+def parse_timestamp(text):
+    """'1:20' أو '01:02:03' أو '80' إلى ثوانٍ"""
+    seconds = 0
+    for part in text.strip().split(':'):
+        if not part.isdigit():
+            raise ValueError(f"وقت غير صالح: {text}")
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+def parse_clip_range(text):
+    """'1:20-2:05' إلى (80, 125) مع التحقق من الطول"""
+    if text.count('-') != 1:
+        raise ValueError("الصيغة المطلوبة: البداية-النهاية مثل 1:20-2:05")
+    start, end = (parse_timestamp(part) for part in text.split('-'))
+    if end <= start:
+        raise ValueError("وقت النهاية يجب أن يكون بعد وقت البداية")
+    if end - start > CLIP_MAX_SECONDS:
+        raise ValueError(f"الحد الأقصى لطول المقطع {CLIP_MAX_SECONDS // 60} دقيقة")
+    return start, end
+
+class ClipRangeError(ValueError):
+    """المقطع المطلوب خارج مدة الفيديو (لا فائدة من إعادة المحاولة)"""
+
+def fit_clip_to_duration(clip, duration):
+    """قص نهاية المقطع إلى مدة الفيديو، ورفض المقطع الذي يبدأ بعد نهايته"""
+    start, end = clip
+    if not duration:
+        return start, end
+    if start >= duration:
+        raise ClipRangeError(f"بداية المقطع ({format_duration(start)}) بعد نهاية الفيديو ({format_duration(duration)})")
+    return start, min(end, int(duration))
+
 def test_url_with_ytdlp(url):
-    """اختبار ما إذا كان الرابط يمكن الوصول إليه باستخدام yt-dlp"""
+    """اختبار ما إذا كان الرابط يمكن الوصول إليه باستخدام yt-dlp
+
+    يعيد (True, None) عند النجاح أو (False, تصنيف الخطأ) عند الفشل.
+    """
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': False,
-            'extract_flat': True,
-            'socket_timeout': 15,
-            'skip_download': True,
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with ydl_pool.checkout('probe') as ydl:
             info = ydl.extract_info(url, download=False)
-            return info is not None
+            return info is not None, None
     except Exception as e:
         logger.error(f"فشل اختبار الرابط لـ {url}: {e}")
-        return False
+        return False, classify_download_error(e)
 
 # ========== إعدادات yt-dlp المحسنة ==========
-def get_ydl_opts(download_type='video', is_fast=False):
+def job_outtmpl(output_dir):
+    # داخل مجلد المهمة يكفي المعرف؛ العنوان يُعرض من info عند الإرسال
+    return os.path.join(output_dir, '%(id)s.%(ext)s')
+
+def get_ydl_opts(download_type='video', is_fast=False, output_dir=None):
     """الحصول على خيارات yt-dlp بناءً على نوع التنزيل مع تحسينات السحابة"""
     
     # وكلاء مستخدم عشوائيون لتجنب الحظر
@@ -338,7 +1601,7 @@ def get_ydl_opts(download_type='video', is_fast=False):
     ]
     
     base_opts = {
-        'outtmpl': os.path.join(TEMP_DIR, '%(title).100s.%(ext)s'),
+        'outtmpl': job_outtmpl(output_dir) if output_dir else os.path.join(TEMP_DIR, '%(title).100s.%(ext)s'),
         'retries': 10,  # زيادة عدد المحاولات
         'fragment_retries': 10,
         'skip_unavailable_fragments': True,
@@ -346,6 +1609,8 @@ def get_ydl_opts(download_type='video', is_fast=False):
         'quiet': True,
         'socket_timeout': 60,  # زيادة وقت الانتظار
         'noplaylist': True,
+        'continuedl': True,  # استكمال ملفات .part بدلاً من البدء من جديد
+        'retry_sleep_functions': {'http': _ytdlp_retry_sleep, 'fragment': _ytdlp_retry_sleep},
         
         # إضافة رؤوس HTTP لتجنب الحظر
         'http_headers': {
@@ -357,15 +1622,14 @@ def get_ydl_opts(download_type='video', is_fast=False):
         },
     }
     
+    if FFMPEG_AVAILABLE:
+        base_opts['postprocessor_args'] = {'ffmpeg': ['-threads', str(transcode_executor.threads)]}
+    
     if download_type == 'audio':
         if FFMPEG_AVAILABLE:
+            # ننزل المصدر كما هو ونحوله محلياً حسب ملف تعريف الصوت (انظر transcode_audio)
             base_opts.update({
                 'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
             })
         else:
             # خيارات بديلة عندما لا يكون FFmpeg متاحاً
@@ -383,93 +1647,1071 @@ def get_ydl_opts(download_type='video', is_fast=False):
     
     return base_opts
 
-# ========== نظام التنزيل المحسن ==========
-def download_media(url, chat_id, download_type='video', is_fast=False):
-    """تنزيل الوسائط مع معالجة الأخطاء الشاملة وتحسينات السحابة"""
-    max_retries = 3  # زيادة عدد المحاولات
-    for attempt in range(max_retries):
+# ========== مجمع نسخ YoutubeDL ==========
+YDL_POOL_SIZE = int(os.environ.get('YDL_POOL_SIZE', 4))  # النسخ الخاملة لكل ملف تعريف
+YDL_POOL_MAX_USES = int(os.environ.get('YDL_POOL_MAX_USES', 50))  # ثم تُستبدل النسخة
+
+# خيارات الفحص والبحث: استخراج مسطح دون تنزيل
+FLAT_YDL_OPTS = {
+    'quiet': True,
+    'no_warnings': False,
+    'extract_flat': True,
+    'socket_timeout': 15,
+    'skip_download': True,
+}
+
+def ydl_profile_opts(profile):
+    """خيارات yt-dlp الثابتة لكل ملف تعريف في المجمع"""
+    if profile in ('probe', 'search'):
+        return dict(FLAT_YDL_OPTS)
+    return get_ydl_opts('audio' if profile == 'audio' else 'video', is_fast=profile == 'fast')
+
+class YoutubeDLPool:
+    """نسخ YoutubeDL جاهزة لكل ملف تعريف (video/fast/audio/probe/search)
+
+    إنشاء YoutubeDL يكلف تسجيل وحدات الاستخراج وتحليل الخيارات وتهيئة الجلسة
+    والكوكيز؛ هنا تُنشأ النسخة مرة واحدة وتُعار لمهمة واحدة في كل مرة. ما تغيّره
+    المهمة (outtmpl والخطافات وأي خيار آخر) يُعاد إلى قيمته عند الإرجاع، والنسخة
+    التي فشلت مهمتها بخطأ تُغلق ولا تعود إلى المجمع.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, max_idle=YDL_POOL_SIZE, max_uses=YDL_POOL_MAX_USES):
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self._idle = collections.defaultdict(list)  # profile -> [(ydl, uses)]
+        self._lock = threading.Lock()
+        self.created = 0
+
+    def _create(self, profile):
+        ydl = yt_dlp.YoutubeDL(ydl_profile_opts(profile))
+        with self._lock:
+            self.created += 1
+        return ydl
+
+    @staticmethod
+    def _close(ydl):
         try:
-            bot.send_message(chat_id, f"🔄 جاري المعالجة (المحاولة {attempt + 1}/{max_retries})...")
-            
-            ydl_opts = get_ydl_opts(download_type, is_fast)
+            close = getattr(ydl, 'close', None)
+            if close:
+                close()
+        except Exception as e:
+            logger.error(f"خطأ في إغلاق نسخة yt-dlp: {e}")
+
+    @staticmethod
+    def _set_hooks(ydl, progress_hooks, postprocessor_hooks):
+        ydl._progress_hooks = list(progress_hooks)
+        ydl._postprocessor_hooks = list(postprocessor_hooks)
+        # المعالجات اللاحقة المضافة مسبقاً نسخت خطافات التنزيل عند إنشائها
+        for pps in getattr(ydl, '_pps', {}).values():
+            for pp in pps:
+                pp._progress_hooks = list(postprocessor_hooks)
+
+    @contextlib.contextmanager
+    def checkout(self, profile, progress_hooks=None, postprocessor_hooks=None, **overrides):
+        with self._lock:
+            idle = self._idle[profile]
+            ydl, uses = idle.pop() if idle else (None, 0)
+        if ydl is None:
+            ydl = self._create(profile)
+
+        if 'outtmpl' in overrides and isinstance(overrides['outtmpl'], str):
+            # yt-dlp يحول outtmpl إلى قاموس عند الإنشاء ويقرأه بهذه الصيغة
+            overrides['outtmpl'] = {'default': overrides['outtmpl']}
+        saved_params = {key: ydl.params.get(key, self._MISSING) for key in overrides}
+        saved_hooks = (list(ydl._progress_hooks), list(ydl._postprocessor_hooks))
+        ydl.params.update(overrides)
+        if progress_hooks is not None or postprocessor_hooks is not None:
+            self._set_hooks(ydl, progress_hooks if progress_hooks is not None else saved_hooks[0],
+                            postprocessor_hooks if postprocessor_hooks is not None else saved_hooks[1])
+
+        healthy = False
+        try:
+            yield ydl
+            healthy = True
+        finally:
+            for key, value in saved_params.items():
+                if value is self._MISSING:
+                    ydl.params.pop(key, None)
+                else:
+                    ydl.params[key] = value
+            self._set_hooks(ydl, *saved_hooks)
+            if hasattr(ydl, '_download_retcode'):
+                ydl._download_retcode = 0
+            uses += 1
+            keep = False
+            if healthy and uses < self.max_uses:
+                with self._lock:
+                    if len(self._idle[profile]) < self.max_idle:
+                        self._idle[profile].append((ydl, uses))
+                        keep = True
+            if not keep:
+                self._close(ydl)
+
+    def warm(self, profiles=('video', 'fast', 'audio', 'probe', 'search')):
+        """إنشاء نسخة واحدة لكل ملف تعريف مسبقاً"""
+        for profile in profiles:
+            with self._lock:
+                if self._idle[profile]:
+                    continue
+            try:
+                ydl = self._create(profile)
+            except Exception as e:
+                logger.error(f"فشل تجهيز نسخة yt-dlp ({profile}): {e}")
+                continue
+            with self._lock:
+                self._idle[profile].append((ydl, 0))
+
+    def warm_up(self, delay=10):
+        """تجهيز النسخ في الخلفية بعد تحميل yt_dlp"""
+        def run():
+            time.sleep(delay)
+            self.warm()
+        threading.Thread(target=run, daemon=True).start()
+
+    def idle_count(self):
+        with self._lock:
+            return {profile: len(items) for profile, items in self._idle.items()}
+
+    def close(self):
+        with self._lock:
+            items = [ydl for idle in self._idle.values() for ydl, _ in idle]
+            self._idle.clear()
+        for ydl in items:
+            self._close(ydl)
+
+ydl_pool = YoutubeDLPool()
+
+metrics.gauge('bot_ydl_pool_idle', 'نسخ YoutubeDL الجاهزة لكل ملف تعريف',
+              lambda: {(('profile', name),): count for name, count in ydl_pool.idle_count().items()})
+
+# ========== نقل الملفات عبر Telegram ==========
+MB = 1024 * 1024
+# حدود Bot API العامة: 50 ميجابايت للرفع و20 ميجابايت لتنزيل ملفات المستخدمين
+UPLOAD_LIMIT = (2000 if LOCAL_BOT_API else 50) * MB
+DOWNLOAD_LIMIT = (2000 if LOCAL_BOT_API else 20) * MB
+UPLOAD_BASE_TIMEOUT = int(os.environ.get('UPLOAD_BASE_TIMEOUT', 60))
+UPLOAD_MIN_BANDWIDTH = int(os.environ.get('UPLOAD_MIN_BANDWIDTH', 256 * 1024))  # بايت/ثانية
+UPLOAD_MAX_TIMEOUT = int(os.environ.get('UPLOAD_MAX_TIMEOUT', 3600))
+
+def upload_timeout(size):
+    """مهلة الرفع بحسب حجم الملف بافتراض حد أدنى لسرعة الاتصال"""
+    return int(min(UPLOAD_MAX_TIMEOUT, UPLOAD_BASE_TIMEOUT + size / UPLOAD_MIN_BANDWIDTH))
+
+def send_media_file(chat_id, file_path, method, thumbnail=None, **kwargs):
+    """إرسال ملف بطريقة bot.send_* المحددة؛ في الوضع المحلي يُمرَّر المسار بدلاً من البايتات"""
+    send = getattr(bot, method)
+    size = os.path.getsize(file_path)
+    timeout = upload_timeout(size)
+    with contextlib.ExitStack() as stack:
+        if thumbnail:
+            # الصور المصغرة تُرفع دائماً كملف جديد
+            kwargs['thumbnail'] = stack.enter_context(open(thumbnail, 'rb'))
+        if LOCAL_BOT_API:
+            sent = send(chat_id, f"file://{os.path.abspath(file_path)}", timeout=timeout, **kwargs)
+        else:
+            media_file = stack.enter_context(open(file_path, 'rb'))
+            sent = send(chat_id, media_file, timeout=timeout, **kwargs)
+    usage_ledger.record(chat_id, bytes_up=size)
+    return sent
+
+def is_rejected_by_telegram(error):
+    """رفض من Telegram (نوع ملف غير مقبول...) وليس خطأ شبكة أو انتهاء مهلة"""
+    return isinstance(error, telebot.apihelper.ApiTelegramException)
+
+def fetch_telegram_file(file_id, dest_path, chat_id=None):
+    """تنزيل ملف أرسله المستخدم إلى مسار محلي دون تحميله كاملاً في الذاكرة"""
+    file_info = bot.get_file(file_id)
+    if LOCAL_BOT_API and os.path.isabs(file_info.file_path):
+        # الخادم المحلي يعيد مساراً على نفس القرص
+        shutil.copyfile(file_info.file_path, dest_path)
+        usage_ledger.record(chat_id, bytes_down=os.path.getsize(dest_path))
+        return dest_path
+    file_url = (telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(
+        API_TOKEN, file_info.file_path)
+    with requests.get(file_url, stream=True, timeout=(10, upload_timeout(file_info.file_size or 0))) as response:
+        response.raise_for_status()
+        with open(dest_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=256 * 1024):
+                f.write(chunk)
+    usage_ledger.record(chat_id, bytes_down=os.path.getsize(dest_path))
+    return dest_path
+
+# ========== تجهيز الفيديو للتشغيل الفوري ==========
+THUMBNAIL_MAX_SIDE = 320
+# حقول probe_media التي تُمرر إلى send_video
+VIDEO_SEND_FIELDS = ('duration', 'width', 'height')
+
+def probe_media(file_path):
+    """قراءة المدة والأبعاد من ffprobe"""
+    ffprobe = FFMPEG_CAPABILITIES.get('ffprobe')
+    if not ffprobe:
+        return {}
+    result = subprocess.run(
+        [ffprobe, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', file_path],
+        capture_output=True, text=True, timeout=30)
+    if result.returncode != 0:
+        return {}
+    data = json.loads(result.stdout or '{}')
+    media = {}
+    duration = data.get('format', {}).get('duration')
+    if duration:
+        media['duration'] = int(float(duration))
+    for stream in data.get('streams', []):
+        if stream.get('codec_type') == 'video' and stream.get('width') and 'width' not in media:
+            media['width'] = int(stream['width'])
+            media['height'] = int(stream['height'])
+        elif stream.get('codec_type') == 'audio' and 'audio_codec' not in media:
+            media['audio_codec'] = stream.get('codec_name')
+    return media
+
+def mp4_needs_faststart(file_path):
+    """هل يأتي صندوق moov بعد mdat؟ (يجب تنزيل الملف كاملاً قبل التشغيل)"""
+    with open(file_path, 'rb') as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, box = struct.unpack('>I4s', header)
+            if box == b'moov':
+                return False
+            if box == b'mdat':
+                return True
+            if size == 1:
+                size = struct.unpack('>Q', f.read(8))[0]
+                f.seek(size - 16, 1)
+            elif size == 0:
+                return False
+            else:
+                f.seek(size - 8, 1)
+
+def ensure_faststart(file_path, chat_id=None):
+    """نقل moov إلى بداية الملف بإعادة التغليف دون إعادة ترميز"""
+    if not file_path.endswith('.mp4') or not mp4_needs_faststart(file_path):
+        return False
+    remuxed_path = file_path[:-4] + '.faststart.mp4'
+    result = transcode_executor.run(
+        ['-i', file_path, '-map', '0', '-c', 'copy', '-movflags', '+faststart', '-y', remuxed_path],
+        chat_id=chat_id, job_type='video', timeout=300)
+    if result.returncode != 0 or not os.path.exists(remuxed_path):
+        if os.path.exists(remuxed_path):
+            os.unlink(remuxed_path)
+        raise Exception(f"فشل نقل moov: {result.stderr[-200:]}")
+    os.replace(remuxed_path, file_path)
+    return True
+
+def generate_thumbnail(file_path, duration=None, chat_id=None):
+    """صورة مصغرة JPEG صغيرة من إطار قريب من بداية الفيديو"""
+    thumbnail_path = os.path.splitext(file_path)[0] + '.thumb.jpg'
+    offset = min(5, duration / 10) if duration else 0
+    # Telegram يشترط ألا يتجاوز العرض ولا الارتفاع 320: تصغير داخل المربع دون تكبير ثم أبعاد زوجية
+    side = THUMBNAIL_MAX_SIDE
+    scale = (f"scale=w='min({side},iw)':h='min({side},ih)':force_original_aspect_ratio=decrease,"
+             f"scale=trunc(iw/2)*2:trunc(ih/2)*2")
+    result = transcode_executor.run(
+        ['-ss', f'{offset:.2f}', '-i', file_path, '-frames:v', '1',
+         '-vf', scale, '-q:v', '5', '-y', thumbnail_path],
+        chat_id=chat_id, job_type='video', timeout=60)
+    if result.returncode != 0 or not os.path.exists(thumbnail_path):
+        return None
+    return thumbnail_path
+
+def prepare_video_for_streaming(file_path, chat_id=None):
+    """مرحلة ما بعد التنزيل: faststart ثم البيانات الوصفية والصورة المصغرة لـ send_video"""
+    if not FFMPEG_AVAILABLE:
+        return {}
+    ensure_faststart(file_path, chat_id)
+    metadata = probe_media(file_path)
+    # probe_media تعيد حقولاً أخرى (مثل audio_codec) لا يقبلها send_video
+    extra = {key: metadata[key] for key in VIDEO_SEND_FIELDS if metadata.get(key)}
+    thumbnail_path = generate_thumbnail(file_path, metadata.get('duration'), chat_id)
+    if thumbnail_path:
+        extra['thumbnail'] = thumbnail_path
+    return extra
+
+# ========== مخزن الوسائط حسب المحتوى ==========
+MEDIA_STORE_DIR = os.environ.get('MEDIA_STORE_DIR', '/tmp/telegram_bot_store')
+MEDIA_STORE_MAX_BYTES = int(os.environ.get('MEDIA_STORE_MAX_BYTES', 2 * 1024 * MB))
+
+# حقول معلومات yt-dlp التي نحتاجها عند إعادة استخدام ملف مخزن
+STORED_INFO_FIELDS = ('id', 'title', 'duration', 'ext', 'extractor_key', 'webpage_url', 'filesize_approx')
+
+def job_work_dir():
+    """مجلد خاص بالمهمة الحالية داخل المجلد المؤقت (الأسماء لا تتصادم بين المهام)"""
+    job_id = getattr(_trace_context, 'job_id', None)
+    if job_id is None:
+        trace = current_trace()
+        job_id = trace.job_id if trace else uuid.uuid4().hex[:12]
+    work_dir = os.path.join(TEMP_DIR, f"job_{job_id}")
+    os.makedirs(work_dir, exist_ok=True)
+    return work_dir
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # أنظمة ملفات مختلفة أو لا تدعم الروابط الصلبة
+        shutil.copy2(src, dst)
+
+class MediaStore:
+    """مخزن ملفات بأسماء sha256 مع فهرس SQLite وإخلاء LRU بحد أقصى للحجم
+
+    عدد مرات استخدام الملف هو عدد روابطه الصلبة (st_nlink): كل نسخة مسحوبة إلى
+    مجلد مهمة تزيده بواحد وحذفها بعد الرفع ينقصه، والملف لا يُخلى ما دام مستخدماً.
+    """
+
+    def __init__(self, root=MEDIA_STORE_DIR, max_bytes=MEDIA_STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.blobs_dir = os.path.join(root, 'blobs')
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root, 'index.db'), timeout=30,
+                                     check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, ext TEXT, size INTEGER, last_access REAL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, hash TEXT, info TEXT)')
+
+    def _blob_path(self, digest, ext):
+        return os.path.join(self.blobs_dir, f"{digest}.{ext}" if ext else digest)
+
+    @staticmethod
+    def file_digest(file_path):
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        """(مسار الملف المخزن، المعلومات) أو None"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT b.hash, b.ext, k.info FROM keys k JOIN blobs b ON b.hash = k.hash WHERE k.key = ?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            blob_path = self._blob_path(row[0], row[1])
+            if not os.path.exists(blob_path):
+                self._conn.execute('DELETE FROM keys WHERE hash = ?', (row[0],))
+                self._conn.execute('DELETE FROM blobs WHERE hash = ?', (row[0],))
+                return None
+            self._conn.execute('UPDATE blobs SET last_access = ? WHERE hash = ?', (time.time(), row[0]))
+        return blob_path, json.loads(row[2] or '{}')
+
+    def put(self, keys, file_path, info=None):
+        """إضافة ملف إلى المخزن (الملفات المتطابقة تُخزن مرة واحدة) وربطه بالمفاتيح"""
+        digest = self.file_digest(file_path)
+        ext = os.path.splitext(file_path)[1].lstrip('.')
+        blob_path = self._blob_path(digest, ext)
+        stored_info = json.dumps({field: (info or {}).get(field) for field in STORED_INFO_FIELDS}, ensure_ascii=False)
+        with self._lock:
+            if not os.path.exists(blob_path):
+                _link_or_copy(file_path, blob_path)
+            self._conn.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)',
+                               (digest, ext, os.path.getsize(blob_path), time.time()))
+            for key in keys:
+                self._conn.execute('INSERT OR REPLACE INTO keys VALUES (?, ?, ?)', (key, digest, stored_info))
+        self.evict()
+        return blob_path
+
+    def checkout(self, blob_path, dest_dir, filename):
+        """ربط صلب للملف المخزن داخل مجلد المهمة دون نسخ البيانات"""
+        dest_path = os.path.join(dest_dir, filename)
+        if os.path.exists(dest_path):
+            os.unlink(dest_path)
+        _link_or_copy(blob_path, dest_path)
+        return dest_path
+
+    def total_size(self):
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def evict(self):
+        """حذف الأقل استخداماً مؤخراً حتى يعود الحجم تحت الحد، مع تجاوز الملفات المستخدمة"""
+        with self._lock:
+            total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+            evicted = 0
+            for digest, ext, size in self._conn.execute(
+                    'SELECT hash, ext, size FROM blobs ORDER BY last_access').fetchall():
+                if total <= self.max_bytes:
+                    break
+                blob_path = self._blob_path(digest, ext)
+                try:
+                    if os.stat(blob_path).st_nlink > 1:
+                        continue
+                    os.unlink(blob_path)
+                except FileNotFoundError:
+                    pass
+                self._conn.execute('DELETE FROM keys WHERE hash = ?', (digest,))
+                self._conn.execute('DELETE FROM blobs WHERE hash = ?', (digest,))
+                total -= size
+                evicted += 1
+            return evicted
+
+media_store = MediaStore()
+
+metrics.gauge('bot_media_store_bytes', 'حجم مخزن الوسائط', media_store.total_size)
+
+def media_variant(download_type, is_fast=False, audio_profile=None, clip=None):
+    """نوع الناتج جزء من المفتاح: نفس الرابط ينتج ملفات مختلفة للصوت والفيديو السريع والمقاطع"""
+    if download_type == 'audio':
+        variant = f'audio_{audio_profile}' if audio_profile else 'audio_raw'
+    else:
+        variant = 'fast' if is_fast else download_type
+    if clip:
+        variant += f'@{clip[0]}-{clip[1]}'
+    return variant
+
+def media_keys(variant, url=None, info=None):
+    """مفاتيح المخزن: الرابط كما أرسله المستخدم ومعرف المحتوى بعد الاستخراج"""
+    keys = []
+    if url:
+        keys.append(f"{variant}:url:{url.strip()}")
+    if info and info.get('id'):
+        keys.append(f"{variant}:id:{info.get('extractor_key', '')}:{info['id']}")
+    return keys
+
+def find_downloaded_file(work_dir):
+    """الملف الناتج في مجلد المهمة (دون الملفات الجزئية والمؤقتة)"""
+    candidates = [
+        os.path.join(work_dir, name) for name in os.listdir(work_dir)
+        if not name.endswith(('.part', '.ytdl', '.thumb.jpg')) and '.part-Frag' not in name
+    ]
+    candidates = [path for path in candidates if os.path.isfile(path)]
+    return max(candidates, key=os.path.getsize) if candidates else None
+
+def checkout_cached_media(variant, work_dir, url=None, info=None):
+    """سحب ملف من المخزن إلى مجلد المهمة إن وجد: (info, file_path) أو (None, None)"""
+    for key in media_keys(variant, url, info):
+        cached = media_store.lookup(key)
+        if cached:
+            blob_path, stored_info = cached
+            merged_info = dict(stored_info, **(info or {}))
+            ext = os.path.splitext(blob_path)[1]
+            filename = f"{clean_filename(merged_info.get('title') or 'media')[:100]}{ext}"
+            CACHE_HITS.inc(cache='media')
+            return merged_info, media_store.checkout(blob_path, work_dir, filename)
+    return None, None
+
+# ========== ذاكرة معرفات ملفات Telegram ==========
+FILE_ID_CACHE_DB = os.environ.get('FILE_ID_CACHE_DB', '/tmp/telegram_bot_file_ids.db')
+# محادثة تُرفع إليها ملفات الوضع المضمن عند عدم وجودها (قناة خاصة مثلاً)؛ بدونها لا ينزّل الوضع المضمن روابط جديدة
+CACHE_CHAT_ID = int(os.environ['CACHE_CHAT_ID']) if os.environ.get('CACHE_CHAT_ID') else None
+
+# نوع الوسائط في رسالة Telegram -> طريقة الإرسال بالمعرف
+FILE_ID_KINDS = ('video', 'audio', 'voice', 'document')
+
+class FileIdCache:
+    """معرفات الملفات المرفوعة سابقاً: إعادة إرسالها لا تحتاج تنزيلاً ولا رفعاً
+
+    المفاتيح نفسها مفاتيح مخزن الوسائط (النوع + الرابط أو معرف المحتوى)، مع
+    الرابط والعنوان لعرض النتائج في الوضع المضمن.
+    """
+
+    def __init__(self, path=FILE_ID_CACHE_DB):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS file_ids (key TEXT PRIMARY KEY, kind TEXT, file_id TEXT,'
+            ' variant TEXT, url TEXT, title TEXT, duration INTEGER, created REAL, hits INTEGER DEFAULT 0)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS file_ids_url ON file_ids (url)')
+
+    def put(self, keys, kind, file_id, variant, url=None, info=None):
+        info = info or {}
+        with self._lock:
+            for key in keys:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO file_ids (key, kind, file_id, variant, url, title, duration, created)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (key, kind, file_id, variant, url, info.get('title'), info.get('duration'), time.time()))
+
+    def lookup(self, keys):
+        """أول مدخل لأي من المفاتيح: قاموس (kind, file_id, title...) أو None"""
+        with self._lock:
+            for key in keys:
+                row = self._conn.execute(
+                    'SELECT kind, file_id, variant, url, title, duration FROM file_ids WHERE key = ?', (key,)).fetchone()
+                if row:
+                    self._conn.execute('UPDATE file_ids SET hits = hits + 1 WHERE key = ?', (key,))
+                    return dict(zip(('kind', 'file_id', 'variant', 'url', 'title', 'duration'), row))
+        return None
+
+    def for_url(self, url):
+        """كل الأنواع المخزنة لرابط (فيديو، سريع، صوت...)"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT kind, file_id, variant, url, title, duration FROM file_ids'
+                ' WHERE url = ? GROUP BY variant ORDER BY hits DESC', (url.strip(),)).fetchall()
+        return [dict(zip(('kind', 'file_id', 'variant', 'url', 'title', 'duration'), row)) for row in rows]
+
+    def search(self, text, limit=10):
+        # % و _ في نص المستخدم حروف عادية وليست أنماط LIKE
+        pattern = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT kind, file_id, variant, url, title, duration FROM file_ids'
+                " WHERE title LIKE ? ESCAPE '\\' GROUP BY file_id ORDER BY hits DESC LIMIT ?",
+                (f'%{pattern}%', limit)).fetchall()
+        return [dict(zip(('kind', 'file_id', 'variant', 'url', 'title', 'duration'), row)) for row in rows]
+
+    def forget(self, file_id):
+        with self._lock:
+            self._conn.execute('DELETE FROM file_ids WHERE file_id = ?', (file_id,))
+
+file_id_cache = FileIdCache()
+
+def sent_file_id(message):
+    """(النوع، file_id) للملف في رسالة أرسلها البوت"""
+    for kind in FILE_ID_KINDS:
+        media = getattr(message, kind, None)
+        if media is not None:
+            return kind, media.file_id
+    return None, None
+
+def remember_upload(message, variant, url, info):
+    kind, file_id = sent_file_id(message)
+    if file_id:
+        try:
+            file_id_cache.put(media_keys(variant, url, info), kind, file_id, variant, url.strip(), info)
+        except Exception as e:
+            logger.error(f"خطأ في حفظ معرف الملف: {e}")
+
+def send_cached_file_id(chat_id, cached, caption=None):
+    """إعادة إرسال ملف مرفوع سابقاً بمعرفه؛ يعيد False إن رفضه Telegram (ويحذفه من الذاكرة)"""
+    try:
+        getattr(bot, f"send_{cached['kind']}")(chat_id, cached['file_id'], caption=caption)
+        return True
+    except telebot.apihelper.ApiTelegramException as e:
+        logger.error(f"معرف ملف غير صالح: {e}")
+        file_id_cache.forget(cached['file_id'])
+        return False
+
+# ========== ملفات تعريف الصوت ==========
+AUDIO_PROFILES = {
+    'voice': {'label': '🎙️ Opus 64k - للكلام (الأصغر)', 'ext': 'ogg', 'encoder': 'libopus',
+              'args': ['-c:a', 'libopus', '-b:a', '64k', '-ac', '1', '-application', 'voip'], 'method': 'send_voice'},
+    'mp3_128': {'label': '🎵 MP3 128k - حجم صغير', 'ext': 'mp3', 'encoder': 'libmp3lame',
+                'args': ['-c:a', 'libmp3lame', '-b:a', '128k'], 'method': 'send_audio'},
+    'mp3_192': {'label': '🎵 MP3 192k - متوازن', 'ext': 'mp3', 'encoder': 'libmp3lame',
+                'args': ['-c:a', 'libmp3lame', '-b:a', '192k'], 'method': 'send_audio'},
+    'mp3_320': {'label': '🎧 MP3 320k - أعلى جودة', 'ext': 'mp3', 'encoder': 'libmp3lame',
+                'args': ['-c:a', 'libmp3lame', '-b:a', '320k'], 'method': 'send_audio'},
+    'm4a': {'label': '📦 M4A - الصوت الأصلي دون إعادة ترميز', 'ext': 'm4a', 'encoder': 'aac',
+            'args': ['-c:a', 'copy'], 'method': 'send_audio'},
+}
+DEFAULT_AUDIO_PROFILE = os.environ.get('DEFAULT_AUDIO_PROFILE', 'mp3_192')
+# المصدر المنزل قبل التحويل يُخزن مرة واحدة ويخدم كل ملفات التعريف
+AUDIO_SOURCE_VARIANT = 'audio_src'
+
+def available_audio_profiles():
+    if not FFMPEG_AVAILABLE:
+        return []
+    if not FFMPEG_ENCODERS:
+        # قائمة المُرمّزات غير معروفة (فشل الفحص) - نفترض البناء الكامل
+        return list(AUDIO_PROFILES)
+    return [name for name, profile in AUDIO_PROFILES.items() if profile['encoder'] in FFMPEG_ENCODERS]
+
+def resolve_audio_profile(name=None):
+    """ملف التعريف المطلوب إن كان مدعوماً وإلا الافتراضي؛ None عند غياب FFmpeg"""
+    profiles = available_audio_profiles()
+    if not profiles:
+        return None
+    for candidate in (name, DEFAULT_AUDIO_PROFILE):
+        if candidate in profiles:
+            return candidate
+    return profiles[0]
+
+def audio_profile_for(chat_id):
+    return user_sessions.get(chat_id, {}).get('audio_profile', DEFAULT_AUDIO_PROFILE)
+
+def transcode_audio(source_path, profile, chat_id=None, duration=None, job_type='audio',
+                    on_progress=None, timeout=None):
+    """تحويل المصدر إلى ملف تعريف الصوت عبر منفذ FFmpeg"""
+    spec = AUDIO_PROFILES[profile]
+    output_path = f"{os.path.splitext(source_path)[0]}.{profile}.{spec['ext']}"
+    codec_args = spec['args']
+    if codec_args == ['-c:a', 'copy'] and probe_media(source_path).get('audio_codec') != 'aac':
+        # النسخ إلى M4A يصلح لـ AAC فقط؛ غيره (opus/vorbis) يُرمّز
+        codec_args = ['-c:a', 'aac', '-b:a', '192k']
+    result = transcode_executor.run(
+        ['-i', source_path, '-vn', '-map_metadata', '0'] + codec_args + ['-y', output_path],
+        chat_id=chat_id, job_type=job_type, duration=duration, on_progress=on_progress, timeout=timeout)
+    if result.returncode != 0 or not os.path.exists(output_path):
+        error_msg = result.stderr[-200:] if result.stderr else "فشل التحويل"
+        raise Exception(f"فشل تحويل الصوت: {error_msg}")
+    return output_path
+
+# ========== سياسة إعادة المحاولة ==========
+DOWNLOAD_MAX_ATTEMPTS = int(os.environ.get('DOWNLOAD_MAX_ATTEMPTS', 3))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 2))
+RETRY_THROTTLE_DELAY = float(os.environ.get('RETRY_THROTTLE_DELAY', 10))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 60))
+
+# أخطاء لن تنجح إعادة المحاولة فيها مهما تكررت
+PERMANENT_ERROR_PATTERNS = (
+    'Private video', 'Video unavailable', 'This video is unavailable', 'Sign in to confirm your age',
+    'Sign in', 'Unsupported URL', 'No video formats', 'is not available', 'has been removed',
+    'copyright', 'members-only', 'HTTP Error 404', 'HTTP Error 410', 'File is empty',
+)
+
+# أخطاء تدل على أن المنصة تحد من الطلبات
+THROTTLING_ERROR_PATTERNS = (
+    'HTTP Error 429', 'Too Many Requests', 'rate-limit', 'rate limit', 'HTTP Error 403',
+    'not a bot', 'temporarily blocked',
+)
+
+def classify_download_error(error):
+    """تصنيف خطأ yt-dlp إلى permanent أو throttling أو transient"""
+    message = str(error)
+    lowered = message.lower()
+    if any(pattern.lower() in lowered for pattern in THROTTLING_ERROR_PATTERNS):
+        return 'throttling'
+    if any(pattern.lower() in lowered for pattern in PERMANENT_ERROR_PATTERNS):
+        return 'permanent'
+    return 'transient'
+
+def retry_delay(attempt, error_class='transient'):
+    """تأخير أسي مع تشويش عشوائي (نصف ثابت ونصف عشوائي)"""
+    base = RETRY_THROTTLE_DELAY if error_class == 'throttling' else RETRY_BASE_DELAY
+    delay = min(RETRY_MAX_DELAY, base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def _ytdlp_retry_sleep(n):
+    """نفس سياسة التأخير لإعادة المحاولات الداخلية في yt-dlp (بالثواني)
+
+    يستدعيها RetryManager بالشكل sleep_func(n=رقم المحاولة السابقة بدءاً من 0).
+    """
+    return min(retry_delay(n), 10)
+
+# ========== قواطع الدوائر والتزامن التكيفي لكل منصة ==========
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', 20))
+BREAKER_MIN_REQUESTS = int(os.environ.get('BREAKER_MIN_REQUESTS', 5))
+BREAKER_ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', 0.5))
+BREAKER_COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', 120))
+PLATFORM_MIN_CONCURRENCY = int(os.environ.get('PLATFORM_MIN_CONCURRENCY', 1))
+PLATFORM_MAX_CONCURRENCY = int(os.environ.get('PLATFORM_MAX_CONCURRENCY', 8))
+PLATFORM_TARGET_LATENCY = float(os.environ.get('PLATFORM_TARGET_LATENCY', 10))
+
+PLATFORM_DOMAINS = {
+    'youtube': ('youtube.com', 'youtu.be', 'youtube-nocookie.com'),
+    'instagram': ('instagram.com',),
+    'facebook': ('facebook.com', 'fb.com', 'fb.watch'),
+    'tiktok': ('tiktok.com',),
+    'twitter': ('twitter.com', 'x.com'),
+    'reddit': ('reddit.com', 'redd.it'),
+}
+
+def platform_for_url(url):
+    """اسم المنصة لرابط معين (النطاقات الفرعية تتبع منصتها)"""
+    if not url.startswith(('http://', 'https://')):
+        url = 'https://' + url
+    domain = urllib.parse.urlparse(url).netloc.lower().split(':')[0]
+    for platform, domains in PLATFORM_DOMAINS.items():
+        if any(domain == d or domain.endswith('.' + d) for d in domains):
+            return platform
+    return domain[4:] if domain.startswith('www.') else domain
+
+class CircuitBreaker:
+    """قاطع دائرة: يفتح عند ارتفاع نسبة الأخطاء ثم يختبر بطلب واحد بعد فترة التهدئة"""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self._outcomes = collections.deque(maxlen=BREAKER_WINDOW)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """هل يُسمح بطلب جديد لهذه المنصة؟"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() - self._opened_at < BREAKER_COOLDOWN:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record(self, outcome):
+        """تسجيل نتيجة طلب: success أو failure أو neutral (خطأ لا يخص صحة المنصة)"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = False
+                if outcome == 'success':
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                    logger.info(f"✅ إغلاق قاطع الدائرة للمنصة {self.name}")
+                elif outcome == 'failure':
+                    self._trip()
+                return
+            if outcome == 'neutral':
+                return
+            self._outcomes.append(outcome == 'success')
+            failures = self._outcomes.count(False)
+            if (self.state == self.CLOSED and len(self._outcomes) >= BREAKER_MIN_REQUESTS
+                    and failures / len(self._outcomes) >= BREAKER_ERROR_RATE):
+                self._trip()
+
+    def _trip(self):
+        self.state = self.OPEN
+        self._opened_at = time.time()
+        logger.error(f"⛔ فتح قاطع الدائرة للمنصة {self.name}")
+
+    def retry_after(self):
+        """الثواني المتبقية قبل السماح بطلب اختبار"""
+        return max(0, int(BREAKER_COOLDOWN - (time.time() - self._opened_at)))
+
+class AdaptiveLimiter:
+    """حد تزامن لكل منصة يتكيف بطريقة AIMD: زيادة جمعية عند النجاح وتنصيف عند الخطأ"""
+
+    def __init__(self, name, initial=None):
+        self.name = name
+        self.limit = float(initial or max(PLATFORM_MIN_CONCURRENCY, PLATFORM_MAX_CONCURRENCY // 2))
+        self.active = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.active < int(self.limit), timeout=timeout):
+                return False
+            self.active += 1
+            return True
+
+    def release(self, outcome, latency=None):
+        with self._cond:
+            self.active -= 1
+            if outcome == 'failure' or (latency is not None and latency > PLATFORM_TARGET_LATENCY):
+                self.limit = max(PLATFORM_MIN_CONCURRENCY, self.limit / 2)
+            elif outcome == 'success':
+                self.limit = min(PLATFORM_MAX_CONCURRENCY, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+class PlatformGuard:
+    """سجل قواطع الدوائر وحدود التزامن لكل منصة"""
+
+    def __init__(self):
+        self._breakers = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, platform):
+        with self._lock:
+            if platform not in self._breakers:
+                self._breakers[platform] = CircuitBreaker(platform)
+            return self._breakers[platform]
+
+    def limiter(self, platform):
+        with self._lock:
+            if platform not in self._limiters:
+                self._limiters[platform] = AdaptiveLimiter(platform)
+            return self._limiters[platform]
+
+    def open_platforms(self):
+        with self._lock:
+            return [name for name, breaker in self._breakers.items() if breaker.state != CircuitBreaker.CLOSED]
+
+    def limits(self):
+        with self._lock:
+            return {name: limiter.limit for name, limiter in self._limiters.items()}
+
+platform_guard = PlatformGuard()
+
+metrics.gauge('bot_platform_breaker_open', 'قواطع الدوائر غير المغلقة لكل منصة',
+              lambda: {(('platform', name),): 1 for name in platform_guard.open_platforms()})
+metrics.gauge('bot_platform_concurrency_limit', 'حد التزامن التكيفي لكل منصة',
+              lambda: {(('platform', name),): round(limit, 2) for name, limit in platform_guard.limits().items()})
+
+def platform_outcome(error_kind):
+    """تحويل تصنيف الخطأ إلى نتيجة لقاطع الدائرة"""
+    return 'neutral' if error_kind == 'permanent' else 'failure'
+
+# ========== جدولة التنزيلات (الأقصر أولاً) ==========
+DOWNLOAD_SLOTS = int(os.environ.get('DOWNLOAD_SLOTS', 4))
+LARGE_LANE_SLOTS = int(os.environ.get('LARGE_LANE_SLOTS', max(1, DOWNLOAD_SLOTS // 2)))
+SMALL_JOB_SECONDS = int(os.environ.get('SMALL_JOB_SECONDS', 600))  # مدة المقطع
+SMALL_JOB_BYTES = int(os.environ.get('SMALL_JOB_BYTES', 100 * MB))
+ESTIMATED_BANDWIDTH = int(os.environ.get('ESTIMATED_BANDWIDTH', 5 * MB))  # بايت/ثانية لتقدير زمن التنزيل
+SCHEDULER_AGING = float(os.environ.get('SCHEDULER_AGING', 1.0))  # ثوانٍ تُخصم من التقدير لكل ثانية انتظار
+
+# معدل البت التقريبي (kbps) عندما لا يذكر المستخرج الحجم
+DEFAULT_BITRATES = {'fast': 600, 'audio': 160, 'video': 2500}
+DOWNLOAD_LANES = ('fast', 'audio', 'small', 'large')
+
+def estimate_download_bytes(info, download_type='video', is_fast=False):
+    """تقدير حجم التنزيل من info: الأحجام المعلنة للصيغ المختارة أو المدة × معدل البت"""
+    formats = info.get('requested_formats') or [info]
+    total = 0
+    for fmt in formats:
+        size = fmt.get('filesize') or fmt.get('filesize_approx')
+        if not size:
+            total = 0
+            break
+        total += size
+    if total:
+        return int(total)
+    kind = 'audio' if download_type == 'audio' else ('fast' if is_fast else 'video')
+    bitrate = info.get('tbr') or DEFAULT_BITRATES[kind]
+    return int((info.get('duration') or 0) * bitrate * 1000 / 8)
+
+def classify_download_lane(info, download_type='video', is_fast=False):
+    """(المسار، الحجم المقدر) للمهمة"""
+    estimated_bytes = estimate_download_bytes(info, download_type, is_fast)
+    if is_fast and download_type != 'audio':
+        return 'fast', estimated_bytes
+    if download_type == 'audio':
+        return 'audio', estimated_bytes
+    duration = info.get('duration') or 0
+    if duration <= SMALL_JOB_SECONDS and estimated_bytes <= SMALL_JOB_BYTES:
+        return 'small', estimated_bytes
+    return 'large', estimated_bytes
+
+class DownloadTicket:
+    def __init__(self, chat_id, lane, estimated_bytes, seq):
+        self.chat_id = chat_id
+        self.lane = lane
+        self.estimated_seconds = estimated_bytes / ESTIMATED_BANDWIDTH
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.cancelled = False
+
+    def priority(self, now):
+        # الأقصر أولاً، والانتظار يخفض القيمة حتى لا تُحرم المهام الطويلة
+        return (self.estimated_seconds - SCHEDULER_AGING * (now - self.enqueued), self.seq)
+
+class DownloadScheduler:
+    """حد لعدد التنزيلات المتزامنة يختار من المنتظرين الأقصر زمناً مقدراً
+
+    المهام الكبيرة لا تشغل أكثر من LARGE_LANE_SLOTS مكاناً، فيبقى دائماً مكان
+    للمقاطع القصيرة والتنزيل السريع والصوت.
+    """
+
+    def __init__(self, slots=DOWNLOAD_SLOTS, large_slots=LARGE_LANE_SLOTS):
+        self.slots = max(1, slots)
+        self.lane_limits = {'large': max(1, min(large_slots, self.slots))}
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting = []
+        self._running = collections.Counter()
+
+    def _eligible(self, ticket):
+        return self._running[ticket.lane] < self.lane_limits.get(ticket.lane, self.slots)
+
+    def _is_next(self, ticket):
+        if sum(self._running.values()) >= self.slots or not self._eligible(ticket):
+            return False
+        now = time.monotonic()
+        best = min((t for t in self._waiting if self._eligible(t)), key=lambda t: t.priority(now))
+        return best is ticket
+
+    @contextlib.contextmanager
+    def slot(self, chat_id, info, download_type='video', is_fast=False):
+        lane, estimated_bytes = classify_download_lane(info, download_type, is_fast)
+        # الحصة تُفحص بالحجم المقدر قبل حجز مكان يحتاجه غيره
+        check_quota(chat_id, extra_bytes=estimated_bytes)
+        ticket = DownloadTicket(chat_id, lane, estimated_bytes, next(self._seq))
+        with stage_timer('queue', lane=lane) as span:
+            with self._cond:
+                self._waiting.append(ticket)
+                must_wait = not self._is_next(ticket)
+            if must_wait:
+                try:
+                    bot.send_message(chat_id, "⏳ في طابور التنزيل - المقاطع القصيرة تُنفذ أولاً...")
+                except Exception:
+                    pass
+            with self._cond:
+                try:
+                    # المهلة تعيد حساب أولوية الانتظار دورياً
+                    while not ticket.cancelled and not self._is_next(ticket):
+                        self._cond.wait(1.0)
+                finally:
+                    self._waiting.remove(ticket)
+                    self._cond.notify_all()
+                if ticket.cancelled:
+                    raise TranscodeCancelled("تم إلغاء المهمة")
+                self._running[lane] += 1
+            span['waited_ms'] = round((time.monotonic() - ticket.enqueued) * 1000)
+        try:
+            yield lane
+        finally:
+            with self._cond:
+                self._running[lane] -= 1
+                self._cond.notify_all()
+
+    def cancel_chat(self, chat_id):
+        with self._cond:
+            tickets = [t for t in self._waiting if t.chat_id == chat_id]
+            for ticket in tickets:
+                ticket.cancelled = True
+            self._cond.notify_all()
+        return len(tickets)
+
+    def waiting_by_lane(self):
+        with self._cond:
+            counts = {lane: 0 for lane in DOWNLOAD_LANES}
+            for ticket in self._waiting:
+                counts[ticket.lane] += 1
+            return counts
+
+    def running_count(self):
+        with self._cond:
+            return sum(self._running.values())
+
+download_scheduler = DownloadScheduler()
+
+# ========== نظام التنزيل المحسن ==========
+def download_media(url, chat_id, download_type='video', is_fast=False, work_dir=None, variant=None, clip=None):
+    """تنزيل الوسائط مع معالجة الأخطاء الشاملة وتحسينات السحابة
+
+    clip: (بداية، نهاية) بالثواني لتنزيل هذا الجزء فقط؛ yt-dlp يطلب المقاطع
+    اللازمة فقط ويقص بالنسخ المباشر عند أقرب إطار مفتاحي دون إعادة ترميز.
+    """
+    work_dir = work_dir or job_work_dir()
+    overrides = {}
+    if clip:
+        overrides['download_ranges'] = yt_dlp.utils.download_range_func(None, [tuple(clip)])
+        overrides['force_keyframes_at_cuts'] = False
+    gate = YdlTranscodeGate(chat_id, 'audio' if download_type == 'audio' else 'video')
+    try:
+        max_retries = DOWNLOAD_MAX_ATTEMPTS
+        # نحتفظ بنتيجة الاستخراج بين المحاولات حتى لا نكررها إلا عند الحاجة
+        info = None
+        for attempt in range(max_retries):
+            try:
+                bot.send_message(chat_id, f"🔄 جاري المعالجة (المحاولة {attempt + 1}/{max_retries})...")
             
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                # الحصول على معلومات الفيديو أولاً
-                info = ydl.extract_info(url, download=False)
-                if not info:
-                    raise Exception("لا يمكن الحصول على معلومات الفيديو")
-                
-                title = clean_filename(info.get('title', 'غير معروف'))
-                duration = info.get('duration', 0)
-                
-                if duration > 1800:  # أكثر من 30 دقيقة
-                    bot.send_message(chat_id, "⚠️ فيديو طويل - قد يستغرق هذا بعض الوقت")
-                
-                bot.send_message(chat_id, f"📥 جاري التنزيل: {title}")
-                
-                # بدء التنزيل
-                ydl.download([url])
-                
-                # العثور على الملف الذي تم تنزيله
-                file_pattern = os.path.join(TEMP_DIR, f"{title}.*")
-                files = glob.glob(file_pattern)
+                profile = 'audio' if download_type == 'audio' else ('fast' if is_fast else 'video')
+                with ydl_pool.checkout(profile, outtmpl=job_outtmpl(work_dir),
+                                       progress_hooks=[gate.progress_hook],
+                                       postprocessor_hooks=[gate.postprocessor_hook], **overrides) as ydl:
+                    if info is None:
+                        # الحصول على معلومات الفيديو أولاً
+                        with stage_timer('extract'):
+                            info = ydl.extract_info(url, download=False)
+                        if not info:
+                            raise Exception("لا يمكن الحصول على معلومات الفيديو")
+                    
+                        title = clean_filename(info.get('title', 'غير معروف'))
+                        duration = info.get('duration') or 0
+                        if clip:
+                            clip = fit_clip_to_duration(clip, duration)
+                    
+                        # رابط مختلف لنفس المحتوى (youtu.be، معاملات إضافية...) قد يكون مخزناً
+                        if variant:
+                            cached_info, cached_path = checkout_cached_media(variant, work_dir, info=info)
+                            if cached_path:
+                                return cached_info, cached_path
+                            CACHE_MISSES.inc(cache='media')
+                    
+                        if duration > 1800:  # أكثر من 30 دقيقة
+                            bot.send_message(chat_id, "⚠️ فيديو طويل - قد يستغرق هذا بعض الوقت")
+                    
+                        bot.send_message(chat_id, f"📥 جاري التنزيل: {title}")
+                    
+                    # بدء التنزيل من المعلومات المستخرجة دون استخراج ثانٍ، بعد دور المهمة في الجدولة
+                    # المقطع يُجدول بطوله هو لا بطول الفيديو الكامل
+                    schedule_info = info if not clip else {
+                        'duration': clip[1] - clip[0], 'tbr': info.get('tbr')}
+                    with download_scheduler.slot(chat_id, schedule_info, download_type, is_fast):
+                        download_started = time.perf_counter()
+                        download_status = 'error'
+                        try:
+                            # المقطع ينزّله FFmpeg الذي يشغّله yt-dlp (FFmpegFD)، فيُحجز له مكان في المنفذ
+                            with gate.external_ffmpeg(work_dir) if clip else contextlib.nullcontext():
+                                ydl.process_ie_result(info, download=True)
+                            download_status = 'ok'
+                        finally:
+                            gate.observe_stages(time.perf_counter() - download_started, download_status)
                 
-                if files:
-                    file_path = files[0]
+                    # العثور على الملف الذي تم تنزيله في مجلد المهمة
+                    file_path = find_downloaded_file(work_dir)
+                    if file_path is None:
+                        raise Exception("الملف الذي تم تنزيله غير موجود")
                     # التحقق من أن الملف ليس فارغاً
                     if os.path.getsize(file_path) > 1024:  # 1KB كحد أدنى
                         return info, file_path
-                    else:
-                        os.unlink(file_path)  # حذف الملف الفارغ
-                        raise Exception("الملف الذي تم تنزيله فارغ")
-                else:
-                    # الاحتياطي: الحصول على أحدث ملف في المجلد المؤقت
-                    all_files = glob.glob(os.path.join(TEMP_DIR, "*"))
-                    if all_files:
-                        latest_file = max(all_files, key=os.path.getctime)
-                        if os.path.getsize(latest_file) > 1024:
-                            return info, latest_file
-                        else:
-                            raise Exception("أحدث ملف فارغ")
-                    else:
-                        raise Exception("الملف الذي تم تنزيله غير موجود")
+                    os.unlink(file_path)  # حذف الملف الفارغ
+                    raise Exception("الملف الذي تم تنزيله فارغ")
                     
-        except Exception as e:
-            error_msg = str(e)
-            logger.error(f"فشلت محاولة التنزيل {attempt + 1}: {error_msg}")
+            except (TranscodeCancelled, QuotaExceeded, ClipRangeError):
+                raise
+            except Exception as e:
+                gate.release()
+                error_msg = str(e)
+                error_class = classify_download_error(e)
+                logger.error(f"فشلت محاولة التنزيل {attempt + 1} ({error_class}): {error_msg}")
+                trace = current_trace()
+                if trace is not None:
+                    trace.retries = attempt + 1
+                    trace.emit('attempt_failed', attempt=attempt + 1, error_class=type(e).__name__,
+                               error_kind=error_class)
+                
+                # الأخطاء الدائمة لا تستحق إعادة المحاولة
+                if error_class == 'permanent':
+                    raise
+                # عند تقييد المنصة قد تنتهي صلاحية الروابط الموقعة، فنعيد الاستخراج
+                if error_class == 'throttling':
+                    info = None
             
-            # التعامل مع الأخطاء المتعلقة بـ FFmpeg
-            if "ffprobe" in error_msg.lower() or "ffmpeg" in error_msg.lower():
-                bot.send_message(chat_id, "❌ خطأ في FFmpeg! جاري التنزيل بدون تحويل...")
-                ydl_opts = get_ydl_opts('audio', is_fast)
-                if 'postprocessors' in ydl_opts:
-                    del ydl_opts['postprocessors']
+                # التعامل مع الأخطاء المتعلقة بـ FFmpeg
+                if "ffprobe" in error_msg.lower() or "ffmpeg" in error_msg.lower():
+                    bot.send_message(chat_id, "❌ خطأ في FFmpeg! جاري التنزيل بدون تحويل...")
+                    ydl_opts = get_ydl_opts('audio', is_fast, output_dir=work_dir)
+                    if 'postprocessors' in ydl_opts:
+                        del ydl_opts['postprocessors']
                 
-                try:
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        ydl.download([url])
-                        files = glob.glob(os.path.join(TEMP_DIR, "*"))
-                        if files:
-                            latest_file = max(files, key=os.path.getctime)
-                            if os.path.getsize(latest_file) > 1024:
-                                return info, latest_file
-                except Exception as inner_e:
-                    logger.error(f"فشل التنزيل بدون FFmpeg: {inner_e}")
-                    if attempt < max_retries - 1:
-                        continue
-                    else:
-                        raise inner_e
+                    try:
+                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                            if info is None:
+                                info = ydl.extract_info(url, download=True)
+                            else:
+                                ydl.process_ie_result(info, download=True)
+                            file_path = find_downloaded_file(work_dir)
+                            if file_path and os.path.getsize(file_path) > 1024:
+                                return info, file_path
+                    except Exception as inner_e:
+                        logger.error(f"فشل التنزيل بدون FFmpeg: {inner_e}")
+                        if attempt < max_retries - 1:
+                            continue
+                        else:
+                            raise inner_e
                 
-            if attempt < max_retries - 1:
-                bot.send_message(chat_id, f"⚠️ جاري إعادة المحاولة... (المحاولة {attempt + 2}/{max_retries})")
-                time.sleep(3)  # زيادة وقت الانتظار بين المحاولات
-            else:
-                raise e
+                if attempt < max_retries - 1:
+                    delay = retry_delay(attempt, error_class)
+                    bot.send_message(chat_id, f"⚠️ جاري إعادة المحاولة بعد {delay:.0f} ثانية... (المحاولة {attempt + 2}/{max_retries})")
+                    time.sleep(delay)
+                else:
+                    raise e
     
-    return None, None
+        return None, None
+    finally:
+        gate.close()
+
+def process_download(chat_id, url, media_type, is_fast=False, audio_profile=None, clip=None, billed_to=None):
+    """معالجة التنزيل مع معالجة الأخطاء الشاملة
 
-def process_download(chat_id, url, media_type, is_fast=False):
-    """معالجة التنزيل مع معالجة الأخطاء الشاملة"""
+    billed_to: المحادثة التي تُحتسب عليها البيانات ووقت المعالجة إن اختلفت عن chat_id.
+    """
+    job_status = 'error'
+    _usage_context.chat_id = billed_to
+    JOBS_IN_FLIGHT.inc()
+    trace = start_job_trace(media_type, chat_id, url)
+    breaker = limiter = None
+    thumbnail_path = None
+    work_dir = None
+    outcome = 'neutral'
+    probe_latency = None
     try:
         bot.send_message(chat_id, "🔍 جاري التحقق من الرابط...")
         
@@ -479,33 +2721,91 @@ def process_download(chat_id, url, media_type, is_fast=False):
             send_welcome_by_id(chat_id)
             return
         
-        # اختبار إمكانية الوصول إلى الرابط
-        bot.send_message(chat_id, "🌐 جاري اختبار الاتصال...")
-        if not test_url_with_ytdlp(url):
-            bot.send_message(chat_id, "❌ لا يمكن الوصول إلى هذا الرابط أو المحتوى غير متاح")
-            send_welcome_by_id(chat_id)
-            return
+        audio_profile = resolve_audio_profile(audio_profile) if media_type == 'audio' else None
+        source_variant = AUDIO_SOURCE_VARIANT if audio_profile else None
+        variant = media_variant(media_type, is_fast, audio_profile, clip)
+        
+        # رُفع من قبل: إعادة الإرسال بالمعرف دون تنزيل أو رفع
+        cached = file_id_cache.lookup(media_keys(variant, url))
+        if cached:
+            caption = f"✅ اكتمل التنزيل!\n🎬 {cached['title'] or ''}"
+            if send_cached_file_id(chat_id, cached, caption):
+                CACHE_HITS.inc(cache='file_id')
+                job_status = 'ok'
+                return
+        
+        # الملف نفسه نُزّل من قبل: لا فحص ولا استخراج ولا تنزيل
+        work_dir = job_work_dir()
+        info, file_path = checkout_cached_media(variant, work_dir, url=url)
+        from_store = info is not None
+        source_cached = False
+        if not from_store and source_variant:
+            info, file_path = checkout_cached_media(source_variant, work_dir, url=url)
+            source_cached = info is not None
+        if from_store:
+            bot.send_message(chat_id, "⚡ الملف متوفر مسبقاً - جاري الإرسال...")
+        elif source_cached:
+            bot.send_message(chat_id, "⚡ المصدر متوفر مسبقاً - جاري التحويل...")
+        else:
+            # رفض فوري إذا كانت المنصة تعاني من أعطال متكررة
+            platform = platform_for_url(url)
+            breaker = platform_guard.breaker(platform)
+            if not breaker.allow():
+                job_status = 'rejected'
+                minutes = max(1, breaker.retry_after() // 60)
+                bot.send_message(chat_id, f"⛔ منصة {platform} تواجه مشاكل حالياً - يرجى المحاولة بعد {minutes} دقيقة")
+                breaker = None
+                return
+        
+            platform_limiter = platform_guard.limiter(platform)
+            if not platform_limiter.acquire(timeout=0):
+                bot.send_message(chat_id, "⏳ ضغط كبير على هذه المنصة - تم وضع طلبك في الانتظار...")
+                platform_limiter.acquire()
+            limiter = platform_limiter
+        
+            # اختبار إمكانية الوصول إلى الرابط
+            bot.send_message(chat_id, "🌐 جاري اختبار الاتصال...")
+            probe_started = time.perf_counter()
+            reachable, error_kind = test_url_with_ytdlp(url)
+            probe_latency = time.perf_counter() - probe_started
+            if not reachable:
+                outcome = platform_outcome(error_kind)
+                bot.send_message(chat_id, "❌ لا يمكن الوصول إلى هذا الرابط أو المحتوى غير متاح")
+                send_welcome_by_id(chat_id)
+                return
         
-        # تحديد نوع التنزيل
-        if media_type == 'audio':
-            action_msg = "🎵 جاري استخراج الصوت..."
-            download_type = 'audio'
+            # تحديد نوع التنزيل
+            if media_type == 'audio':
+                action_msg = "🎵 جاري استخراج الصوت..."
+                download_type = 'audio'
             
-            # إضافة معلومات حول حالة FFmpeg
-            if not FFMPEG_AVAILABLE:
-                action_msg += "\n\n⚠️ **ملاحظة:** FFmpeg غير متاح - سيتم التنزيل بالتنسيق الأصلي للصوت"
-        elif is_fast:
-            action_msg = "⚡ بدء التنزيل السريع..."
-            download_type = 'video'
-        else:
-            action_msg = "📥 بدء التنزيل..."
-            download_type = 'video'
+                # إضافة معلومات حول حالة FFmpeg
+                if not FFMPEG_AVAILABLE:
+                    action_msg += "\n\n⚠️ **ملاحظة:** FFmpeg غير متاح - سيتم التنزيل بالتنسيق الأصلي للصوت"
+            elif is_fast:
+                action_msg = "⚡ بدء التنزيل السريع..."
+                download_type = 'video'
+            else:
+                action_msg = "📥 بدء التنزيل..."
+                download_type = 'video'
+        
+            bot.send_message(chat_id, action_msg, parse_mode='Markdown')
+            bot.send_chat_action(chat_id, 'upload_video' if media_type != 'audio' else 'upload_audio')
         
-        bot.send_message(chat_id, action_msg, parse_mode='Markdown')
-        bot.send_chat_action(chat_id, 'upload_video' if media_type != 'audio' else 'upload_audio')
+            # تنزيل الوسائط
+            info, file_path = download_media(url, chat_id, download_type, is_fast, work_dir,
+                                             source_variant or variant, clip)
+            outcome = 'success' if info else 'failure'
         
-        # تنزيل الوسائط
-        info, file_path = download_media(url, chat_id, download_type, is_fast)
+        # تحويل الصوت محلياً إلى ملف التعريف المختار مع الاحتفاظ بالمصدر لبقية الملفات
+        if source_variant and not from_store and info and file_path and os.path.exists(file_path):
+            if not source_cached:
+                try:
+                    media_store.put(media_keys(source_variant, url, info), file_path, info)
+                except Exception as e:
+                    logger.error(f"خطأ في حفظ مصدر الصوت في المخزن: {e}")
+            with stage_timer('transcode', profile=audio_profile):
+                file_path = transcode_audio(file_path, audio_profile, chat_id, info.get('duration'))
         
         if info and file_path and os.path.exists(file_path):
             file_size = get_file_size(file_path)
@@ -523,31 +2823,75 @@ def process_download(chat_id, url, media_type, is_fast=False):
             
             caption = f"✅ اكتمل التنزيل!\n🎬 {title}\n📊 الحجم: {file_size}"
             
-            if media_type == 'audio' and not FFMPEG_AVAILABLE:
+            if clip:
+                clip_start, clip_end = fit_clip_to_duration(clip, info.get('duration'))
+                caption += f"\n✂️ المقطع: {format_duration(clip_start)} - {format_duration(clip_end)}"
+            if audio_profile:
+                caption += f"\n🎚️ {AUDIO_PROFILES[audio_profile]['label']}"
+            elif media_type == 'audio' and not FFMPEG_AVAILABLE:
                 caption += "\n⚠️ التنسيق الأصلي (FFmpeg غير متاح)"
             
             bot.send_message(chat_id, "📤 جاري رفع الملف...")
             
-            try:
-                if media_type == 'audio':
-                    with open(file_path, 'rb') as audio_file:
-                        if file_path.endswith(('.m4a', '.webm', '.opus')):
-                            bot.send_document(chat_id, audio_file, caption=caption, timeout=120)
-                        else:
-                            bot.send_audio(chat_id, audio_file, caption=caption, timeout=120, title=title[:64])
+            upload_size = os.path.getsize(file_path)
+            if upload_size > UPLOAD_LIMIT:
+                bot.send_message(chat_id, f"❌ الملف أكبر من حد الرفع ({get_file_size(file_path)} > {UPLOAD_LIMIT // MB} ميجابايت)")
+                os.unlink(file_path)
+                return
+            
+            # اختيار طريقة الإرسال مسبقاً حتى لا نحتاج لإعادة رفع الملف
+            if media_type == 'audio':
+                if audio_profile:
+                    method = AUDIO_PROFILES[audio_profile]['method']
+                    extra = {'title': title[:64]} if method == 'send_audio' else {}
+                elif file_path.endswith(('.m4a', '.webm', '.opus')):
+                    method, extra = 'send_document', {}
                 else:
-                    with open(file_path, 'rb') as video_file:
-                        bot.send_video(chat_id, video_file, caption=caption, timeout=120, supports_streaming=True)
-                        
-            except Exception as send_error:
-                logger.error(f"خطأ في الرفع: {send_error}")
-                # الاحتياطي: الإرسال كمستند
+                    method, extra = 'send_audio', {'title': title[:64]}
+            elif file_path.endswith('.mp4'):
+                method, extra = 'send_video', {'supports_streaming': True}
                 try:
-                    with open(file_path, 'rb') as doc_file:
-                        bot.send_document(chat_id, doc_file, caption=caption, timeout=120)
-                except Exception as doc_error:
-                    logger.error(f"خطأ في رفع المستند: {doc_error}")
-                    bot.send_message(chat_id, f"❌ فشل الرفع: {str(send_error)[:100]}")
+                    with stage_timer('prepare'):
+                        extra.update(prepare_video_for_streaming(file_path, chat_id))
+                except TranscodeCancelled:
+                    raise
+                except Exception as e:
+                    logger.error(f"خطأ في تجهيز الفيديو للبث: {e}")
+                thumbnail_path = extra.get('thumbnail')
+                upload_size = os.path.getsize(file_path)
+            else:
+                method, extra = 'send_document', {}
+            
+            # الحفظ بعد faststart حتى تُرسل النسخ اللاحقة جاهزة للبث
+            if not from_store:
+                try:
+                    with stage_timer('store', bytes=upload_size):
+                        media_store.put(media_keys(variant, url, info), file_path, info)
+                except Exception as e:
+                    logger.error(f"خطأ في حفظ الملف في المخزن: {e}")
+            
+            with stage_timer('upload', bytes=upload_size):
+                try:
+                    sent = send_media_file(chat_id, file_path, method, caption=caption, **extra)
+                    BYTES_TOTAL.inc(upload_size, direction='upload')
+                    job_status = 'ok'
+                    remember_upload(sent, variant, url, info)
+                            
+                except Exception as send_error:
+                    logger.error(f"خطأ في الرفع: {send_error}")
+                    # الاحتياطي: الإرسال كمستند فقط إذا رفض Telegram النوع؛
+                    # أخطاء الشبكة والمهلة لن تُحل بإعادة رفع نفس البايتات
+                    try:
+                        if method == 'send_document' or not is_rejected_by_telegram(send_error):
+                            raise send_error
+                        sent = send_media_file(chat_id, file_path, 'send_document', caption=caption)
+                        BYTES_TOTAL.inc(upload_size, direction='upload')
+                        job_status = 'ok'
+                        remember_upload(sent, variant, url, info)
+                    except Exception as doc_error:
+                        STAGE_ERRORS.inc(stage='upload')
+                        logger.error(f"خطأ في رفع المستند: {doc_error}")
+                        bot.send_message(chat_id, f"❌ فشل الرفع: {str(send_error)[:100]}")
             
             # تنظيف الملف الذي تم تنزيله
             try:
@@ -559,8 +2903,23 @@ def process_download(chat_id, url, media_type, is_fast=False):
         else:
             bot.send_message(chat_id, "❌ فشل التنزيل - لم يتم استلام أي محتوى")
             
+    except TranscodeCancelled:
+        job_status = 'cancelled'
+        bot.send_message(chat_id, "🛑 تم إلغاء التنزيل")
+    
+    except QuotaExceeded as e:
+        job_status = 'quota'
+        bot.send_message(chat_id, str(e))
+    
+    except ClipRangeError as e:
+        job_status = 'rejected'
+        bot.send_message(chat_id, f"❌ {e}")
+    
     except Exception as e:
         error_msg = str(e)
+        trace.error_class = type(e).__name__
+        if outcome == 'neutral':
+            outcome = platform_outcome(classify_download_error(e))
         logger.error(f"خطأ في معالجة التنزيل: {error_msg}")
         
         # رسائل خطأ سهلة الفهم
@@ -587,6 +2946,19 @@ def process_download(chat_id, url, media_type, is_fast=False):
             bot.send_message(chat_id, f"❌ خطأ: {error_display}")
     
     finally:
+        if limiter is not None:
+            limiter.release(outcome, probe_latency)
+        if breaker is not None:
+            breaker.record(outcome)
+        if thumbnail_path and os.path.exists(thumbnail_path):
+            os.unlink(thumbnail_path)
+        if work_dir:
+            # يحرر أيضاً الروابط الصلبة إلى المخزن فيصبح الملف قابلاً للإخلاء
+            shutil.rmtree(work_dir, ignore_errors=True)
+        JOBS_IN_FLIGHT.dec()
+        JOBS_TOTAL.inc(kind=media_type, status=job_status)
+        finish_job_trace(trace, job_status)
+        _usage_context.chat_id = None
         send_welcome_by_id(chat_id)
 
 # ========== نظام القائمة الرئيسية ==========
@@ -694,13 +3066,55 @@ def handle_url_input(message):
     
     user_states[chat_id] = 'processing'
     
-    # بدء التنزيل في thread منفصل
-    thread = threading.Thread(target=process_download, args=(chat_id, url, media_type, is_fast))
-    thread.daemon = True
-    thread.start()
+    # بدء التنزيل في thread منفصل أو لدى العامل المسؤول عن المحادثة
+    try:
+        started = dispatch_job('download', chat_id, url, media_type, is_fast, audio_profile_for(chat_id))
+    except QuotaExceeded as e:
+        bot.send_message(chat_id, str(e))
+        send_welcome_by_id(chat_id)
+        return
+    if not started:
+        bot.send_message(chat_id, "⏳ البوت قيد إعادة التشغيل - يرجى إرسال الرابط مجدداً بعد دقيقة")
+        send_welcome_by_id(chat_id)
+        return
     
     bot.send_message(chat_id, "🚀 بدء عملية التنزيل...")
 
+@bot.message_handler(commands=['clip'])
+def handle_clip_request(message):
+    """/clip URL 1:20-2:05 - تنزيل جزء محدد من الفيديو فقط"""
+    chat_id = message.chat.id
+    parts = message.text.split()
+    usage = ("✂️ **تنزيل مقطع من فيديو**\n\n"
+             "الاستخدام: `/clip الرابط 1:20-2:05`\n"
+             f"الحد الأقصى لطول المقطع: {CLIP_MAX_SECONDS // 60} دقيقة")
+    if len(parts) != 3:
+        bot.send_message(chat_id, usage, parse_mode='Markdown')
+        return
+    if not FFMPEG_AVAILABLE:
+        bot.send_message(chat_id, "❌ تنزيل المقاطع يتطلب FFmpeg - استخدم '📥 تنزيل عادي' للفيديو الكامل")
+        return
+    
+    url, clip_text = parts[1], parts[2]
+    try:
+        clip = parse_clip_range(clip_text)
+    except ValueError as e:
+        bot.send_message(chat_id, f"❌ {e}")
+        return
+    
+    user_states[chat_id] = 'processing'
+    try:
+        started = dispatch_job('download', chat_id, url, 'video', False, None, list(clip))
+    except QuotaExceeded as e:
+        bot.send_message(chat_id, str(e))
+        send_welcome_by_id(chat_id)
+        return
+    if not started:
+        bot.send_message(chat_id, "⏳ البوت قيد إعادة التشغيل - يرجى المحاولة بعد دقيقة")
+        send_welcome_by_id(chat_id)
+        return
+    bot.send_message(chat_id, f"✂️ بدء تنزيل المقطع {format_duration(clip[0])} - {format_duration(clip[1])}...")
+
 # ========== نظام تحويل الصيغ ==========
 @bot.message_handler(func=lambda message: message.text == '🔄 تحويل الصيغ')
 def handle_convert(message):
@@ -729,39 +3143,49 @@ def handle_image_to_pdf(message):
 
 @bot.message_handler(content_types=['photo'], func=lambda message: user_states.get(message.chat.id) == 'waiting_image_pdf')
 def process_image_to_pdf(message):
+    """التحقق من الصورة ثم تسليم التحويل لخيط مهمة حتى لا يُحجز خيط المعالجة"""
+    chat_id = message.chat.id
+    photo = message.photo[-1]
     try:
-        bot.send_message(message.chat.id, "⏳ جاري معالجة صورتك...")
-        
-        # الحصول على أعلى جودة للصورة
-        file_info = bot.get_file(message.photo[-1].file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
+        check_quota(chat_id, extra_bytes=photo.file_size or 0)
+        user_states[chat_id] = 'processing'
+        started = dispatch_job('image_pdf', chat_id, photo.file_id)
+    except QuotaExceeded as e:
+        bot.send_message(chat_id, str(e))
+        send_welcome_by_id(chat_id)
+        return
+    if not started:
+        bot.send_message(chat_id, "⏳ البوت قيد إعادة التشغيل - يرجى إرسال الصورة مجدداً بعد دقيقة")
+        send_welcome_by_id(chat_id)
+
+def convert_image_to_pdf(chat_id, file_id):
+    job_status = 'error'
+    trace = start_job_trace('image_pdf', chat_id)
+    try:
+        bot.send_message(chat_id, "⏳ جاري معالجة صورتك...")
         
-        # حفظ الصورة المؤقتة
+        # حفظ أعلى جودة للصورة في ملف مؤقت
         with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg', dir=TEMP_DIR) as temp_file:
-            temp_file.write(downloaded_file)
             temp_path = temp_file.name
+        fetch_telegram_file(file_id, temp_path, chat_id)
         
         pdf_path = None
         try:
-            # فتح ومعالجة الصورة
-            image = Image.open(temp_path)
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # إنشاء PDF
+            # إنشاء PDF في عملية منفصلة
             pdf_path = temp_path.replace('.jpg', '.pdf')
-            image.save(pdf_path, "PDF", resolution=100.0, quality=95)
+            with stage_timer('convert'):
+                image_service.run(image_jobs.image_to_pdf_job, temp_path, pdf_path)
             
             file_size = get_file_size(pdf_path)
             
             # إرسال PDF إلى المستخدم
-            with open(pdf_path, 'rb') as pdf_file:
-                bot.send_document(message.chat.id, pdf_file, 
-                                caption=f"✅ تم التحويل إلى PDF بنجاح!\n📊 حجم الملف: {file_size}")
+            send_media_file(chat_id, pdf_path, 'send_document',
+                            caption=f"✅ تم التحويل إلى PDF بنجاح!\n📊 حجم الملف: {file_size}")
+            job_status = 'ok'
             
         except Exception as e:
             logger.error(f"خطأ في تحويل PDF: {e}")
-            bot.send_message(message.chat.id, f"❌ فشل التحويل: {str(e)}")
+            bot.send_message(chat_id, f"❌ فشل التحويل: {str(e)}")
         
         finally:
             # تنظيف الملفات المؤقتة
@@ -774,10 +3198,12 @@ def process_image_to_pdf(message):
         
     except Exception as e:
         logger.error(f"خطأ في معالجة الصورة: {e}")
-        bot.send_message(message.chat.id, f"❌ خطأ في المعالجة: {str(e)}")
+        bot.send_message(chat_id, f"❌ خطأ في المعالجة: {str(e)}")
     
     finally:
-        send_welcome_by_id(message.chat.id)
+        JOBS_TOTAL.inc(kind='image_pdf', status=job_status)
+        finish_job_trace(trace, job_status)
+        send_welcome_by_id(chat_id)
 
 # تحويل الفيديو إلى MP3
 @bot.message_handler(func=lambda message: message.text == '🎵 فيديو إلى MP3')
@@ -791,137 +3217,215 @@ def handle_video_to_mp3(message):
         return
     
     user_states[message.chat.id] = 'waiting_video_mp3'
-    bot.send_message(message.chat.id, "🎬 أرسل ملف الفيديو لاستخراج الصوت منه (الحد الأقصى 50 ميجابايت)", 
+    bot.send_message(message.chat.id, f"🎬 أرسل ملف الفيديو لاستخراج الصوت منه (الحد الأقصى {DOWNLOAD_LIMIT // MB} ميجابايت)", 
                    reply_markup=types.ReplyKeyboardRemove())
 
 @bot.message_handler(content_types=['video'], func=lambda message: user_states.get(message.chat.id) == 'waiting_video_mp3')
 def process_video_to_mp3(message):
+    job_status = 'error'
+    trace = start_job_trace('video_mp3', message.chat.id)
     try:
-        # التحقق من حجم الملف
-        if message.video.file_size > 50 * 1024 * 1024:
-            bot.send_message(message.chat.id, "❌ الملف كبير جدًا! الحد الأقصى للحجم هو 50 ميجابايت")
+        # التحقق من حجم الملف قبل الحصة حتى لا تُحتسب مهمة مرفوضة
+        if (message.video.file_size or 0) > DOWNLOAD_LIMIT:
+            job_status = 'rejected'
+            bot.send_message(message.chat.id, f"❌ الملف كبير جدًا! الحد الأقصى للحجم هو {DOWNLOAD_LIMIT // MB} ميجابايت")
             send_welcome_by_id(message.chat.id)
             return
+        
+        # تحويل الفيديو يستهلك المعالج، فيُرفض مبكراً لمن استنفد حصته
+        check_quota(message.chat.id, extra_bytes=message.video.file_size or 0, extra_jobs=1)
+        usage_ledger.record(message.chat.id, jobs=1)
             
         bot.send_message(message.chat.id, "⏳ جاري استخراج الصوت من الفيديو...")
         
-        # تنزيل ملف الفيديو
-        file_info = bot.get_file(message.video.file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        
-        video_path = os.path.join(TEMP_DIR, f"video_{message.message_id}.mp4")
-        with open(video_path, 'wb') as f:
-            f.write(downloaded_file)
-        
-        audio_path = None
+        work_dir = job_work_dir()
+        profile = resolve_audio_profile(audio_profile_for(message.chat.id))
+        variant = media_variant('audio', audio_profile=profile)
+        # نفس الفيديو المعاد توجيهه له نفس file_unique_id فلا داعي لتنزيله وتحويله مجدداً
+        source_key = f"tg:{message.video.file_unique_id}"
         try:
-            # تحويل الفيديو إلى MP3 باستخدام FFmpeg
-            audio_path = os.path.join(TEMP_DIR, f"audio_{message.message_id}.mp3")
+            if profile is None:
+                raise Exception("لا يوجد مُرمّز صوت متاح في FFmpeg")
+            _, audio_path = checkout_cached_media(variant, work_dir, url=source_key)
+            if audio_path:
+                send_media_file(message.chat.id, audio_path, AUDIO_PROFILES[profile]['method'],
+                                caption=f"✅ تم استخراج الصوت بنجاح!\n📊 الحجم: {get_file_size(audio_path)}\n"
+                                        f"🎚️ {AUDIO_PROFILES[profile]['label']}")
+                job_status = 'ok'
+                return
+            CACHE_MISSES.inc(cache='media')
             
-            ffmpeg_cmd = [
-                'ffmpeg',
-                '-i', video_path,
-                '-vn',  # لا فيديو
-                '-acodec', 'libmp3lame',
-                '-ab', '192k',  # معدل البت الصوتي
-                '-ar', '44100',  # معدل العينة
-                '-y',  # الكتابة فوق المخرجات
-                audio_path
-            ]
+            # تنزيل ملف الفيديو
+            video_path = os.path.join(work_dir, f"video_{message.message_id}.mp4")
+            fetch_telegram_file(message.video.file_id, video_path, message.chat.id)
             
-            result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, timeout=120)  # زيادة المهلة
+            status_msg = bot.send_message(message.chat.id, "🎚️ التقدم: 0%")
+            last_update = [time.time()]
             
-            if result.returncode == 0 and os.path.exists(audio_path):
-                file_size = get_file_size(audio_path)
-                
-                # التحقق من أن الملف ليس فارغاً
-                if os.path.getsize(audio_path) < 1024:
-                    raise Exception("ملف الصوت الناتج فارغ")
-                
-                # إرسال MP3 إلى المستخدم
-                with open(audio_path, 'rb') as audio_file:
-                    bot.send_audio(message.chat.id, audio_file, 
-                                 caption=f"✅ تم استخراج الصوت بنجاح!\n📊 الحجم: {file_size}")
-            else:
-                error_msg = result.stderr[:200] if result.stderr else "فشل التحويل"
-                raise Exception(f"فشل استخراج الصوت: {error_msg}")
+            def report_progress(progress):
+                # تحديث رسالة التقدم كل 5 ثوانٍ على الأكثر
+                if time.time() - last_update[0] < 5:
+                    return
+                last_update[0] = time.time()
+                try:
+                    bot.edit_message_text(f"🎚️ التقدم: {int(progress * 100)}%", message.chat.id, status_msg.message_id)
+                except Exception:
+                    pass
+            
+            with stage_timer('transcode', profile=profile):
+                audio_path = transcode_audio(video_path, profile, message.chat.id, message.video.duration,
+                                             job_type='interactive', on_progress=report_progress,
+                                             timeout=120)  # زيادة المهلة
+            file_size = get_file_size(audio_path)
+            
+            # التحقق من أن الملف ليس فارغاً
+            if os.path.getsize(audio_path) < 1024:
+                raise Exception("ملف الصوت الناتج فارغ")
+            
+            try:
+                media_store.put(media_keys(variant, source_key), audio_path, {'title': 'audio'})
+            except Exception as e:
+                logger.error(f"خطأ في حفظ الملف في المخزن: {e}")
+            
+            # إرسال الصوت إلى المستخدم
+            send_media_file(message.chat.id, audio_path, AUDIO_PROFILES[profile]['method'],
+                            caption=f"✅ تم استخراج الصوت بنجاح!\n📊 الحجم: {file_size}\n"
+                                    f"🎚️ {AUDIO_PROFILES[profile]['label']}")
+            job_status = 'ok'
                 
         except subprocess.TimeoutExpired:
             bot.send_message(message.chat.id, "❌ انتهت مهلة التحويل - قد يكون الملف كبيرًا جدًا")
+        except TranscodeCancelled:
+            job_status = 'cancelled'
+            bot.send_message(message.chat.id, "🛑 تم إلغاء التحويل")
         except Exception as e:
             error_msg = str(e)
             logger.error(f"خطأ في استخراج MP3: {error_msg}")
             bot.send_message(message.chat.id, f"❌ فشل الاستخراج: {str(e)[:100]}")
         
         finally:
-            # تنظيف الملفات
-            for path in [video_path, audio_path]:
-                try:
-                    if path and os.path.exists(path):
-                        os.unlink(path)
-                except:
-                    pass
+            # تنظيف مجلد المهمة (الفيديو والصوت الناتج)
+            shutil.rmtree(work_dir, ignore_errors=True)
         
+    except QuotaExceeded as e:
+        job_status = 'quota'
+        bot.send_message(message.chat.id, str(e))
+    
     except Exception as e:
         logger.error(f"خطأ في معالجة الفيديو: {e}")
         bot.send_message(message.chat.id, f"❌ خطأ في المعالجة: {str(e)}")
     
     finally:
+        JOBS_TOTAL.inc(kind='video_mp3', status=job_status)
+        finish_job_trace(trace, job_status)
         send_welcome_by_id(message.chat.id)
 
 # تحويل الصورة إلى JPG
 @bot.message_handler(func=lambda message: message.text == '🖼️ صورة إلى JPG')
 def handle_image_to_jpg(message):
     user_states[message.chat.id] = 'waiting_image_jpg'
-    bot.send_message(message.chat.id, "📤 أرسل الصورة لتحويلها إلى تنسيق JPG", 
-                   reply_markup=types.ReplyKeyboardRemove())
+    bot.send_message(message.chat.id,
+                     "📤 أرسل الصورة لتحويلها إلى تنسيق JPG\n\n"
+                     "💡 أرسلها كملف للحفاظ على الجودة الأصلية، ويمكنك إضافة تعليق بالخيارات:\n"
+                     "• webp - الإخراج بصيغة WebP\n"
+                     "• 500kb أو 2mb - حجم مستهدف\n"
+                     "• 1280 - أطول ضلع بالبكسل\n"
+                     "• q80 - جودة ثابتة",
+                     reply_markup=types.ReplyKeyboardRemove())
 
-@bot.message_handler(content_types=['photo'], func=lambda message: user_states.get(message.chat.id) == 'waiting_image_jpg')
+@bot.message_handler(content_types=['photo', 'document'],
+                     func=lambda message: user_states.get(message.chat.id) == 'waiting_image_jpg')
 def process_image_to_jpg(message):
+    """التحقق من الصورة وخياراتها ثم تسليم التحويل لخيط مهمة"""
+    chat_id = message.chat.id
+    # الملف الأصلي (مستند) أو أكبر نسخة من الصورة التي ضغطها Telegram
+    if message.content_type == 'document':
+        media = message.document
+        if not (media.mime_type or '').startswith('image/'):
+            bot.send_message(chat_id, "❌ الملف ليس صورة")
+            send_welcome_by_id(chat_id)
+            return
+    else:
+        media = message.photo[-1]
+    if (media.file_size or 0) > DOWNLOAD_LIMIT:
+        bot.send_message(chat_id, f"❌ الملف كبير جدًا! الحد الأقصى للحجم هو {DOWNLOAD_LIMIT // MB} ميجابايت")
+        send_welcome_by_id(chat_id)
+        return
     try:
-        bot.send_message(message.chat.id, "⏳ جاري تحويل الصورة إلى JPG...")
-        
-        file_info = bot.get_file(message.photo[-1].file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
+        options = parse_image_options(message.caption)
+    except ValueError as e:
+        bot.send_message(chat_id, f"❌ {e}")
+        send_welcome_by_id(chat_id)
+        return
+    try:
+        check_quota(chat_id, extra_bytes=media.file_size or 0)
+        user_states[chat_id] = 'processing'
+        started = dispatch_job('image_jpg', chat_id, media.file_id, options)
+    except QuotaExceeded as e:
+        bot.send_message(chat_id, str(e))
+        send_welcome_by_id(chat_id)
+        return
+    if not started:
+        bot.send_message(chat_id, "⏳ البوت قيد إعادة التشغيل - يرجى إرسال الصورة مجدداً بعد دقيقة")
+        send_welcome_by_id(chat_id)
+
+def convert_image(chat_id, file_id, options):
+    job_status = 'error'
+    trace = start_job_trace('image_jpg', chat_id)
+    temp_path = None
+    try:
+        bot.send_message(chat_id, "⏳ جاري تحويل الصورة...")
         
         with tempfile.NamedTemporaryFile(delete=False, suffix='.temp', dir=TEMP_DIR) as temp_file:
-            temp_file.write(downloaded_file)
             temp_path = temp_file.name
+        fetch_telegram_file(file_id, temp_path, chat_id)
         
-        jpg_path = None
+        output_path = None
         try:
-            # التحويل إلى JPG
-            image = Image.open(temp_path)
-            image = image.convert('RGB')
-            
-            jpg_path = os.path.join(TEMP_DIR, f"converted_{message.message_id}.jpg")
-            image.save(jpg_path, "JPEG", quality=95, optimize=True)
+            # التحويل في عملية منفصلة
+            extension = IMAGE_OUTPUT_FORMATS[options['format']][1]
+            output_path = os.path.splitext(temp_path)[0] + extension
+            with stage_timer('convert', format=options['format']) as span:
+                result = image_service.run(image_jobs.optimize_image_job, temp_path, output_path, options)
+                span['bytes'] = result['bytes']
             
-            file_size = get_file_size(jpg_path)
+            saved = result['source_bytes'] - result['bytes']
+            caption = (f"✅ تم التحويل إلى {options['format'].upper()} بنجاح!\n"
+                       f"📐 {result['width']}x{result['height']} | الجودة {result['quality']}\n"
+                       f"📊 من {get_file_size(temp_path)} إلى {get_file_size(output_path)}")
+            if saved > 0:
+                caption += f" (وفّرت {saved * 100 // result['source_bytes']}%)"
+            if not result['target_met']:
+                caption += f"\n⚠️ تعذر الوصول إلى الحجم المستهدف ({options['target_bytes'] // 1024} KB)"
             
-            # إرسال الصورة المحولة
-            with open(jpg_path, 'rb') as jpg_file:
-                bot.send_photo(message.chat.id, jpg_file, 
-                             caption=f"✅ تم التحويل إلى JPG بنجاح!\n📊 الحجم: {file_size}")
+            # كمستند وليس صورة: Telegram يعيد ضغط الصور فيضيع الحجم والجودة المختاران
+            send_media_file(chat_id, output_path, 'send_document', caption=caption)
+            job_status = 'ok'
             
         except Exception as e:
-            bot.send_message(message.chat.id, f"❌ خطأ في التحويل: {str(e)}")
+            bot.send_message(chat_id, f"❌ خطأ في التحويل: {str(e)}")
         
         finally:
-            # التنظيف
-            for path in [temp_path, jpg_path]:
+            if output_path and os.path.exists(output_path):
                 try:
-                    if path and os.path.exists(path):
-                        os.unlink(path)
+                    os.unlink(output_path)
                 except:
                     pass
         
     except Exception as e:
         logger.error(f"خطأ في تحويل JPG: {e}")
-        bot.send_message(message.chat.id, f"❌ خطأ في المعالجة: {str(e)}")
+        bot.send_message(chat_id, f"❌ خطأ في المعالجة: {str(e)}")
     
     finally:
-        send_welcome_by_id(message.chat.id)
+        # التنظيف
+        if temp_path and os.path.exists(temp_path):
+            try:
+                os.unlink(temp_path)
+            except:
+                pass
+        JOBS_TOTAL.inc(kind='image_jpg', status=job_status)
+        finish_job_trace(trace, job_status)
+        send_welcome_by_id(chat_id)
 
 # ========== نظام البحث عن الأغاني ==========
 @bot.message_handler(func=lambda message: message.text == '🔍 بحث أغنية')
@@ -941,83 +3445,84 @@ def search_by_lyrics(message):
         
         bot.send_message(message.chat.id, f"🔍 جاري البحث عن: '{lyrics}'")
         
-        thread = threading.Thread(target=perform_song_search, args=(message.chat.id, lyrics))
-        thread.daemon = True
-        thread.start()
+        if not dispatch_job('search', message.chat.id, lyrics, audio_profile_for(message.chat.id)):
+            bot.send_message(message.chat.id, "⏳ البوت قيد إعادة التشغيل - يرجى المحاولة بعد دقيقة")
+            send_welcome_by_id(message.chat.id)
+    
+    except QuotaExceeded as e:
+        bot.send_message(message.chat.id, str(e))
+        send_welcome_by_id(message.chat.id)
         
     except Exception as e:
         logger.error(f"خطأ في بدء البحث: {e}")
         bot.send_message(message.chat.id, "❌ فشل البحث. يرجى المحاولة مرة أخرى.")
         send_welcome_by_id(message.chat.id)
 
-def perform_song_search(chat_id, lyrics):
+def perform_song_search(chat_id, lyrics, audio_profile=None):
     """إجراء بحث الأغاني في thread خلفي"""
+    trace = start_job_trace('search', chat_id)
+    job_status = 'error'
     try:
         # إنشاء استعلام البحث
         search_query = f"{lyrics} official audio"
         
         bot.send_message(chat_id, "🎵 جاري البحث في YouTube...")
         
-        # استخدام خيارات yt-dlp أبسط للبحث
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': False,
-            'extract_flat': True,  # استخدام الاستخراج المسطح للبحث الأسرع
-            'socket_timeout': 15,
-            'skip_download': True,
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        # استخراج مسطح للبحث الأسرع بنسخة جاهزة من المجمع
+        with ydl_pool.checkout('search') as ydl:
             # البحث في YouTube باستخدام ytsearch
             search_url = f"ytsearch10:{search_query}"
-            info = ydl.extract_info(search_url, download=False)
-            
-            if not info or 'entries' not in info or not info['entries']:
-                bot.send_message(chat_id, "❌ لم يتم العثور على نتائج لبحثك")
-                return
-            
-            entries = info['entries']
-            valid_entries = []
-            
-            # معالجة نتائج البحث
-            for entry in entries:
-                if entry and entry.get('url'):
-                    title = entry.get('title', 'عنوان غير معروف')
-                    duration = entry.get('duration')
-                    duration_str = format_duration(duration)
-                    url = entry.get('url')
+            with stage_timer('search'):
+                info = ydl.extract_info(search_url, download=False)
+        
+        if not info or 'entries' not in info or not info['entries']:
+            bot.send_message(chat_id, "❌ لم يتم العثور على نتائج لبحثك")
+            return
+        
+        entries = info['entries']
+        valid_entries = []
+        
+        # معالجة نتائج البحث
+        for entry in entries:
+            if entry and entry.get('url'):
+                title = entry.get('title', 'عنوان غير معروف')
+                duration = entry.get('duration')
+                duration_str = format_duration(duration)
+                url = entry.get('url')
+                
+                # تصفية البث المباشر والفيديوهات الطويلة جدًا
+                if duration and duration > 36000:  # أطول من 10 ساعات
+                    continue
                     
-                    # تصفية البث المباشر والفيديوهات الطويلة جدًا
-                    if duration and duration > 36000:  # أطول من 10 ساعات
-                        continue
-                        
-                    valid_entries.append({
-                        'title': title,
-                        'url': url,
-                        'duration': duration_str
-                    })
-            
-            if not valid_entries:
-                bot.send_message(chat_id, "❌ لم يتم العثور على نتائج صالحة")
-                return
-            
-            # عرض أفضل النتائج
-            results_text = "🎵 **أفضل النتائج:**\n\n"
-            for i, entry in enumerate(valid_entries[:5], 1):
-                results_text += f"{i}. {entry['title']}\n"
-                results_text += f"   ⏱️ {entry['duration']}\n\n"
-            
-            results_text += "⬇️ جاري تنزيل أول نتيجة..."
-            bot.send_message(chat_id, results_text, parse_mode='Markdown')
-            
-            # تنزيل أول نتيجة
-            first_result = valid_entries[0]
-            bot.send_message(chat_id, f"🎵 جاري التنزيل: {first_result['title']}")
-            
-            # استخدام نظام التنزيل الموجود
-            process_download(chat_id, first_result['url'], 'audio', False)
+                valid_entries.append({
+                    'title': title,
+                    'url': url,
+                    'duration': duration_str
+                })
+        
+        if not valid_entries:
+            bot.send_message(chat_id, "❌ لم يتم العثور على نتائج صالحة")
+            return
+        
+        # عرض أفضل النتائج
+        results_text = "🎵 **أفضل النتائج:**\n\n"
+        for i, entry in enumerate(valid_entries[:5], 1):
+            results_text += f"{i}. {entry['title']}\n"
+            results_text += f"   ⏱️ {entry['duration']}\n\n"
+        
+        results_text += "⬇️ جاري تنزيل أول نتيجة..."
+        bot.send_message(chat_id, results_text, parse_mode='Markdown')
+        
+        # تنزيل أول نتيجة
+        first_result = valid_entries[0]
+        bot.send_message(chat_id, f"🎵 جاري التنزيل: {first_result['title']}")
+        
+        # استخدام نظام التنزيل الموجود
+        job_status = 'ok'
+        process_download(chat_id, first_result['url'], 'audio', False, audio_profile)
                 
     except Exception as e:
+        trace.error_class = type(e).__name__
         logger.error(f"خطأ في بحث الأغاني: {e}")
         error_msg = str(e)
         
@@ -1030,8 +3535,474 @@ def perform_song_search(chat_id, lyrics):
             bot.send_message(chat_id, f"❌ خطأ في البحث: {error_msg[:100]}")
             
     finally:
+        finish_job_trace(trace, job_status)
         send_welcome_by_id(chat_id)
 
+# ========== الوضع المضمن (inline) ==========
+INLINE_FETCH_COOLDOWN = 120  # ثوانٍ قبل إعادة طلب نفس الرابط
+INLINE_DEBOUNCE_SECONDS = float(os.environ.get('INLINE_DEBOUNCE_SECONDS', 1.5))  # انتظار توقف الكتابة
+_inline_pending = {}
+_inline_timers = {}  # المستخدم -> مؤقت آخر رابط كتبه
+_inline_lock = threading.Lock()
+
+def inline_result(cached):
+    """نتيجة مضمنة من ملف مرفوع سابقاً"""
+    result_id = hashlib.sha1(f"{cached['file_id']}:{cached['variant']}".encode('utf-8')).hexdigest()[:32]
+    title = (cached['title'] or 'media')[:64]
+    label = f"{title} ({cached['variant']})"
+    if cached['kind'] == 'video':
+        return types.InlineQueryResultCachedVideo(id=result_id, video_file_id=cached['file_id'], title=label)
+    if cached['kind'] == 'audio':
+        return types.InlineQueryResultCachedAudio(id=result_id, audio_file_id=cached['file_id'])
+    if cached['kind'] == 'voice':
+        return types.InlineQueryResultCachedVoice(id=result_id, voice_file_id=cached['file_id'], title=label)
+    return types.InlineQueryResultCachedDocument(id=result_id, document_file_id=cached['file_id'], title=label)
+
+def schedule_inline_fetch(url, user_id):
+    """جدولة تنزيل الرابط بعد توقف المستخدم عن الكتابة
+
+    الاستعلامات المضمنة تصل مع كل حرف، وكثير من بدايات الروابط تبدو صالحة؛
+    كل استعلام جديد يلغي مؤقت سابقه فلا يُطلب إلا آخر رابط. التنزيل يحتاج
+    CACHE_CHAT_ID حتى لا تصل رسائل التقدم إلى محادثة المستخدم.
+    """
+    if not CACHE_CHAT_ID:
+        return False
+    timer = threading.Timer(INLINE_DEBOUNCE_SECONDS, request_inline_fetch, args=(url, user_id))
+    timer.daemon = True
+    with _inline_lock:
+        previous = _inline_timers.get(user_id)
+        if previous is not None:
+            previous.cancel()
+        _inline_timers[user_id] = timer
+    timer.start()
+    return True
+
+def request_inline_fetch(url, user_id):
+    """تنزيل الرابط في الخلفية إلى محادثة الذاكرة حتى يصبح متاحاً في الاستعلام التالي"""
+    now = time.time()
+    with _inline_lock:
+        if _inline_timers.get(user_id) is threading.current_thread():
+            del _inline_timers[user_id]
+        if now - _inline_pending.get(url, 0) < INLINE_FETCH_COOLDOWN:
+            return False
+        _inline_pending[url] = now
+        for pending_url, started in list(_inline_pending.items()):
+            if now - started > INLINE_FETCH_COOLDOWN:
+                del _inline_pending[pending_url]
+    try:
+        # الحصة على المستخدم الذي طلب الرابط حتى لو رُفع الملف إلى محادثة الذاكرة
+        check_quota(user_id, extra_jobs=1)
+    except QuotaExceeded:
+        return False
+    # الرابط الذي لا يُستخرج يبقى في _inline_pending فلا يُعاد اختباره قبل انتهاء المهلة
+    ok, _ = test_url_with_ytdlp(url)
+    if not ok:
+        return False
+    usage_ledger.record(user_id, jobs=1)
+    return dispatch_job('download', CACHE_CHAT_ID, url, 'video', False, None, None, user_id)
+
+@bot.inline_handler(func=lambda query: True)
+def handle_inline_query(query):
+    """@bot <رابط أو بحث>: نتائج فورية من الملفات المرفوعة سابقاً"""
+    text = query.query.strip()
+    try:
+        if not text:
+            bot.answer_inline_query(query.id, [], cache_time=5, is_personal=True,
+                                    switch_pm_text="أرسل رابطاً أو كلمات للبحث", switch_pm_parameter='inline')
+            return
+        if is_valid_url(text):
+            results = file_id_cache.for_url(text)
+        else:
+            results = file_id_cache.search(text)
+        if results:
+            CACHE_HITS.inc(cache='inline')
+            bot.answer_inline_query(query.id, [inline_result(cached) for cached in results[:50]], cache_time=300)
+        elif is_valid_url(text):
+            CACHE_MISSES.inc(cache='inline')
+            if schedule_inline_fetch(text, query.from_user.id):
+                switch_pm_text = "⏳ جاري التجهيز - أعد المحاولة بعد قليل"
+            else:
+                switch_pm_text = "📥 أرسل الرابط في المحادثة لتنزيله"
+            bot.answer_inline_query(query.id, [], cache_time=5, is_personal=True,
+                                    switch_pm_text=switch_pm_text, switch_pm_parameter='inline')
+        else:
+            CACHE_MISSES.inc(cache='inline')
+            bot.answer_inline_query(query.id, [], cache_time=30)
+    except Exception as e:
+        logger.error(f"خطأ في الاستعلام المضمن: {e}")
+
+# ========== توزيع المهام وعمليات العمال ==========
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', 0))  # 0 = كل المهام في هذه العملية
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 4))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))  # مهمة توقف عاملها هذا العدد تُعتبر فاشلة
+JOB_PURGE_INTERVAL = 600  # ثوانٍ بين حذف المهام المنتهية القديمة
+JOB_QUEUE_DB = os.environ.get('JOB_QUEUE_DB', '/tmp/telegram_bot_jobs.db')
+
+# المهام التي يمكن تشغيلها في عملية عامل: الاسم -> الدالة (تستقبل chat_id ثم بقية الوسائط)
+JOB_HANDLERS = {
+    'download': process_download,
+    'search': perform_song_search,
+    'image_pdf': convert_image_to_pdf,
+    'image_jpg': convert_image,
+}
+
+def shard_for_chat(chat_id, shards=None):
+    """رقم العامل المسؤول عن المحادثة (ثابت لكل محادثة للحفاظ على الجلسة)"""
+    return zlib.crc32(str(chat_id).encode('utf-8')) % (shards or SHARD_WORKERS)
+
+def ffmpeg_process_share(shard=None, shards=None, total=FFMPEG_MAX_PROCESSES):
+    """نصيب هذه العملية من FFMPEG_MAX_PROCESSES عند تشغيل العمال
+
+    الحد موزع على عملية الاستقبال (shard=None) وعمليات العمال حتى لا يتضاعف
+    بعددها؛ الباقي من القسمة يذهب لأول العمليات. لكل عملية عملية واحدة على الأقل.
+    """
+    processes = (shards or SHARD_WORKERS) + 1
+    index = 0 if shard is None else shard + 1
+    return max(1, total // processes + (1 if index < total % processes else 0))
+
+class SqliteJobQueue:
+    """طابور مهام محلي في SQLite مشترك بين عملية الاستقبال والعمال"""
+
+    def __init__(self, path=JOB_QUEUE_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT, shard INTEGER, kind TEXT, chat_id INTEGER,'
+            " args TEXT, status TEXT DEFAULT 'queued', created REAL, started REAL, finished REAL,"
+            ' attempts INTEGER DEFAULT 0, notified INTEGER DEFAULT 0)')
+        # قواعد بيانات أنشأتها نسخة سابقة بلا هذين العمودين
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(jobs)')}
+        for column in ('attempts', 'notified'):
+            if column not in columns:
+                self._conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} INTEGER DEFAULT 0')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_shard_status ON jobs (shard, status, id)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS cancellations (chat_id INTEGER, shard INTEGER, created REAL)')
+
+    def put(self, kind, chat_id, args, shard):
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO jobs (shard, kind, chat_id, args, created) VALUES (?, ?, ?, ?, ?)',
+                (shard, kind, chat_id, json.dumps(list(args)), time.time()))
+            return cursor.lastrowid
+
+    def claim(self, shard):
+        """أخذ أقدم مهمة منتظرة لهذا العامل"""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    "SELECT id, kind, chat_id, args FROM jobs WHERE shard = ? AND status = 'queued' ORDER BY id LIMIT 1",
+                    (shard,)).fetchone()
+                if row:
+                    self._conn.execute("UPDATE jobs SET status = 'running', started = ?, attempts = attempts + 1 "
+                                       "WHERE id = ?", (time.time(), row[0]))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        if not row:
+            return None
+        return {'id': row[0], 'kind': row[1], 'chat_id': row[2], 'args': json.loads(row[3])}
+
+    def complete(self, job_id, status='done'):
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET status = ?, finished = ? WHERE id = ?', (status, time.time(), job_id))
+
+    def requeue_running(self, shard, max_attempts=JOB_MAX_ATTEMPTS):
+        """إعادة المهام التي كانت قيد التشغيل عند توقف العامل السابق
+
+        المهمة التي بدأت max_attempts مرة يُرجَّح أنها سبب توقف العامل، فتُعلَّم
+        فاشلة بدلاً من إعادتها إلى ما لا نهاية. يعيد (عدد المعادة، محادثات الفاشلة).
+        """
+        with self._lock:
+            failed = self._conn.execute(
+                "SELECT chat_id FROM jobs WHERE shard = ? AND status = 'running' AND attempts >= ?",
+                (shard, max_attempts)).fetchall()
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', finished = ? WHERE shard = ? AND status = 'running' AND attempts >= ?",
+                (time.time(), shard, max_attempts))
+            requeued = self._conn.execute(
+                "UPDATE jobs SET status = 'queued' WHERE shard = ? AND status = 'running'", (shard,)).rowcount
+        return requeued, [row[0] for row in failed]
+
+    def take_finished(self):
+        """المهام المنتهية التي لم تُبلَّغ بها عملية الاستقبال بعد (بأي ترتيب انتهت)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, chat_id FROM jobs WHERE notified = 0 AND status NOT IN ('queued', 'running') ORDER BY id"
+            ).fetchall()
+            self._conn.executemany('UPDATE jobs SET notified = 1 WHERE id = ?', [(row[0],) for row in rows])
+        return rows
+
+    def purge(self, older_than=3600):
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM jobs WHERE status NOT IN ('queued', 'running') AND notified = 1 AND finished < ?",
+                (time.time() - older_than,)).rowcount
+
+    def depth(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def request_cancel(self, chat_id, shard):
+        """إلغاء مهام المحادثة: المنتظرة تُلغى هنا والجارية يُبلَّغ بها العامل؛ يُرجع عدد المهام الملغاة"""
+        with self._lock:
+            now = time.time()
+            queued = self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished = ? WHERE chat_id = ? AND shard = ? AND status = 'queued'",
+                (now, chat_id, shard)).rowcount
+            running = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE chat_id = ? AND shard = ? AND status = 'running'",
+                (chat_id, shard)).fetchone()[0]
+            if running:
+                self._conn.execute('INSERT INTO cancellations VALUES (?, ?, ?)', (chat_id, shard, now))
+        return queued + running
+
+    def take_cancellations(self, shard):
+        with self._lock:
+            rows = self._conn.execute('SELECT chat_id FROM cancellations WHERE shard = ?', (shard,)).fetchall()
+            self._conn.execute('DELETE FROM cancellations WHERE shard = ?', (shard,))
+        return [row[0] for row in rows]
+
+job_queue = SqliteJobQueue() if SHARD_WORKERS > 0 else None
+
+if job_queue is not None:
+    metrics.gauge('bot_shard_queue_depth', 'عدد المهام المنتظرة في طابور العمال', job_queue.depth)
+
+# ========== الإيقاف الآمن واستئناف المهام ==========
+SHUTDOWN_DRAIN_SECONDS = int(os.environ.get('SHUTDOWN_DRAIN_SECONDS', 20))
+CHECKPOINT_FILE = os.environ.get('CHECKPOINT_FILE', '/tmp/telegram_bot_checkpoint.json')
+CHECKPOINT_MAX_AGE = int(os.environ.get('CHECKPOINT_MAX_AGE', 3600))  # ثوانٍ
+
+class JobLifecycle:
+    """تتبع المهام الجارية في هذه العملية لإيقافها بأمان واستئنافها بعد إعادة التشغيل
+
+    عند SIGTERM: يتوقف قبول المهام، ثم ننتظر المهام الجارية حتى المهلة، وما لم
+    ينتهِ يُحفظ (النوع والوسائط ومعرف المهمة) في CHECKPOINT_FILE. معرف المهمة
+    يحدد مجلدها في TEMP_DIR، فيستكمل yt-dlp ملفات .part عند الاستئناف.
+    """
+
+    def __init__(self, checkpoint_file=CHECKPOINT_FILE):
+        self.checkpoint_file = checkpoint_file
+        self.accepting = True
+        self.checkpointed = False
+        self._active = {}
+        self._cond = threading.Condition()
+
+    def start(self, kind, chat_id, args, job_id=None):
+        job = {'job_id': job_id or uuid.uuid4().hex[:12], 'kind': kind, 'chat_id': chat_id, 'args': list(args)}
+        with self._cond:
+            self._active[job['job_id']] = job
+        thread = threading.Thread(target=self._run, args=(job,))
+        thread.daemon = True
+        thread.start()
+        return job['job_id']
+
+    def _run(self, job):
+        _trace_context.job_id = job['job_id']
+        try:
+            JOB_HANDLERS[job['kind']](job['chat_id'], *job['args'])
+        except Exception as e:
+            logger.error(f"خطأ في تنفيذ المهمة {job['job_id']}: {e}")
+        finally:
+            with self._cond:
+                self._active.pop(job['job_id'], None)
+                self._cond.notify_all()
+                if self.checkpointed:
+                    # انتهت بعد الحفظ: لا داعي لاستئنافها
+                    self._write_checkpoint()
+
+    def active_count(self):
+        with self._cond:
+            return len(self._active)
+
+    def _write_checkpoint(self):
+        jobs = [dict(job, checkpointed=time.time()) for job in self._active.values()]
+        if not jobs:
+            if os.path.exists(self.checkpoint_file):
+                os.unlink(self.checkpoint_file)
+            return
+        temp_path = self.checkpoint_file + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(jobs, f, ensure_ascii=False)
+        os.replace(temp_path, self.checkpoint_file)
+
+    def shutdown(self, timeout=SHUTDOWN_DRAIN_SECONDS):
+        """إيقاف القبول ثم انتظار المهام حتى المهلة وحفظ الباقي؛ يعيد عدد المهام المحفوظة"""
+        self.accepting = False
+        with self._cond:
+            self._cond.wait_for(lambda: not self._active, timeout=timeout)
+            remaining = list(self._active.values())
+            if not remaining:
+                return 0
+            self._write_checkpoint()
+            self.checkpointed = True
+        for job in remaining:
+            try:
+                bot.send_message(job['chat_id'], "⏸️ البوت يعيد التشغيل - سيتم استئناف طلبك تلقائياً")
+            except Exception:
+                pass
+        logger.info(f"💾 تم حفظ {len(remaining)} مهمة للاستئناف")
+        return len(remaining)
+
+    def checkpointed_jobs(self):
+        try:
+            with open(self.checkpoint_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def checkpointed_dirs(self):
+        return {f"job_{job['job_id']}" for job in self.checkpointed_jobs()}
+
+    def resume(self):
+        """إعادة تشغيل المهام المحفوظة من التشغيل السابق بنفس معرفاتها"""
+        jobs = self.checkpointed_jobs()
+        if os.path.exists(self.checkpoint_file):
+            os.unlink(self.checkpoint_file)
+        resumed = 0
+        for job in jobs:
+            if job.get('kind') not in JOB_HANDLERS or time.time() - job.get('checkpointed', 0) > CHECKPOINT_MAX_AGE:
+                continue
+            chat_id = job['chat_id']
+            if job_queue is not None:
+                job_queue.put(job['kind'], chat_id, job['args'], shard_for_chat(chat_id))
+            else:
+                self.start(job['kind'], chat_id, job['args'], job['job_id'])
+            user_states[chat_id] = 'processing'
+            resumed += 1
+            try:
+                bot.send_message(chat_id, "▶️ جاري استئناف طلبك بعد إعادة التشغيل...")
+            except Exception:
+                pass
+        return resumed
+
+lifecycle = JobLifecycle()
+
+metrics.gauge('bot_active_jobs', 'المهام الجارية في هذه العملية', lifecycle.active_count)
+
+def dispatch_job(kind, chat_id, *args):
+    """تشغيل مهمة في خيط محلي أو إرسالها إلى العامل المسؤول عن المحادثة
+
+    يعيد False دون تشغيل شيء إذا كان البوت في طور الإيقاف، ويرفع QuotaExceeded
+    إذا استنفدت المحادثة حصتها.
+    """
+    if not lifecycle.accepting:
+        return False
+    check_quota(chat_id, extra_jobs=1)
+    usage_ledger.record(chat_id, jobs=1)
+    if job_queue is not None and WORKER_SHARD is None:
+        job_queue.put(kind, chat_id, args, shard_for_chat(chat_id))
+        return True
+    lifecycle.start(kind, chat_id, args)
+    return True
+
+def handle_shutdown_signal(signum, frame):
+    """SIGTERM: إيقاف الاستطلاع والانتقال إلى finally في التنفيذ الرئيسي"""
+    if not lifecycle.accepting:
+        return
+    logger.info("🛑 تم استلام إشارة الإيقاف - إيقاف استقبال المهام")
+    lifecycle.accepting = False
+    bot.stop_polling()
+    raise SystemExit(0)
+
+def run_worker(shard):
+    """حلقة عملية العامل: تنفيذ مهام المحادثات التابعة لهذا الجزء"""
+    queue = job_queue or SqliteJobQueue()
+    requeued, failed = queue.requeue_running(shard)
+    for chat_id in failed:
+        logger.error(f"فشلت مهمة المحادثة {chat_id} بعد {JOB_MAX_ATTEMPTS} محاولات توقف فيها العامل")
+        try:
+            bot.send_message(chat_id, "❌ تعذر إكمال المهمة - يرجى المحاولة مرة أخرى")
+        except Exception as e:
+            logger.error(f"خطأ في إبلاغ المحادثة {chat_id}: {e}")
+    transcode_executor.max_processes = ffmpeg_process_share(shard)
+    logger.info(f"👷 بدء العامل {shard} ({WORKER_THREADS} خيوط، {transcode_executor.max_processes} عمليات FFmpeg، "
+                f"{requeued} مهمة مستعادة)")
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    def execute():
+        while not stopping.is_set():
+            job = queue.claim(shard)
+            if job is None:
+                time.sleep(0.5)
+                continue
+            # المهمة المستعادة تعود إلى نفس المجلد فيُستكمل التنزيل الجزئي
+            _trace_context.job_id = f"q{job['id']}"
+            status = 'done'
+            try:
+                JOB_HANDLERS[job['kind']](job['chat_id'], *job['args'])
+            except Exception as e:
+                status = 'failed'
+                logger.error(f"خطأ في تنفيذ المهمة {job['id']}: {e}")
+            finally:
+                queue.complete(job['id'], status)
+
+    threads = [threading.Thread(target=execute, daemon=True) for _ in range(WORKER_THREADS)]
+    for thread in threads:
+        thread.start()
+
+    while not stopping.is_set():
+        for chat_id in queue.take_cancellations(shard):
+            transcode_executor.cancel_chat(chat_id)
+            download_scheduler.cancel_chat(chat_id)
+        stopping.wait(1)
+
+    # إنهاء المهام الجارية حتى المهلة؛ ما لم ينتهِ يبقى 'running' ويُستعاد عند التشغيل التالي
+    deadline = time.time() + SHUTDOWN_DRAIN_SECONDS
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    usage_ledger.flush()
+    logger.info(f"👷 إيقاف العامل {shard}")
+
+def start_shard_workers():
+    """تشغيل عمليات العمال ومراقبتها وإعادة تشغيل ما يتوقف منها"""
+    def spawn(shard):
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', str(shard)])
+
+    transcode_executor.max_processes = ffmpeg_process_share()
+    if FFMPEG_MAX_PROCESSES < SHARD_WORKERS + 1:
+        logger.info(f"⚠️ FFMPEG_MAX_PROCESSES={FFMPEG_MAX_PROCESSES} أقل من عدد العمليات ({SHARD_WORKERS + 1})؛ "
+                    f"ستعمل عملية FFmpeg واحدة في كل منها")
+    workers = {shard: spawn(shard) for shard in range(SHARD_WORKERS)}
+
+    def supervise():
+        last_purge = time.time()
+        while lifecycle.accepting:
+            for shard, process in list(workers.items()):
+                if process.poll() is not None:
+                    logger.error(f"توقف العامل {shard} (رمز {process.returncode}) - إعادة التشغيل")
+                    workers[shard] = spawn(shard)
+            # إعادة حالة المحادثات التي انتهت مهامها إلى القائمة الرئيسية
+            for job_id, chat_id in job_queue.take_finished():
+                if user_states.get(chat_id) == 'processing':
+                    user_states[chat_id] = 'main'
+            if time.time() - last_purge > JOB_PURGE_INTERVAL:
+                last_purge = time.time()
+                job_queue.purge()
+            time.sleep(1)
+
+    threading.Thread(target=supervise, daemon=True).start()
+    logger.info(f"🧩 تم تشغيل {SHARD_WORKERS} عمليات عمال")
+    return workers
+
+def stop_shard_workers(workers, timeout=SHUTDOWN_DRAIN_SECONDS):
+    """إرسال SIGTERM للعمال وانتظارهم حتى المهلة ثم إنهاؤهم"""
+    for process in workers.values():
+        if process.poll() is None:
+            process.terminate()
+    deadline = time.time() + timeout + 5
+    for shard, process in workers.items():
+        try:
+            process.wait(max(0.1, deadline - time.time()))
+        except subprocess.TimeoutExpired:
+            logger.error(f"العامل {shard} لم يتوقف في المهلة - إنهاء قسري")
+            process.kill()
+
 # ========== الأوامر الإضافية ==========
 @bot.message_handler(func=lambda message: message.text == '🔙 القائمة الرئيسية')
 def handle_back(message):
@@ -1050,12 +4021,16 @@ def handle_help(message):
 🔄 **أدوات التحويل:**
 - 📷 صورة إلى PDF: تحويل الصور إلى مستندات PDF
 - 🎵 فيديو إلى MP3: استخراج الصوت من ملفات الفيديو
-- 🖼️ صورة إلى JPG: تحويل الصور إلى تنسيق JPG
+- 🖼️ صورة إلى JPG: ضغط الصور إلى JPG أو WebP بحجم أو أبعاد محددة
 
 🔍 **بحث الموسيقى:**
 - البحث بالكلمات أو عنوان الأغنية
 - التنزيل التلقائي لأفضل نتيجة
 
+🔗 **الوضع المضمن:**
+- اكتب معرف البوت ثم رابطاً أو عنواناً في أي محادثة
+- الملفات المرفوعة سابقاً تظهر فوراً، والجديدة تُجهز في الخلفية
+
 📋 **المنصات المدعومة:**
 - YouTube, Instagram, Facebook, TikTok
 - Twitter, Reddit, SoundCloud, Spotify  
@@ -1070,6 +4045,10 @@ def handle_help(message):
 /start - القائمة الرئيسية
 /status - حالة النظام  
 /clean - تنظيف الملفات المؤقتة
+/cancel - إلغاء المهمة الجارية
+/clip - تنزيل مقطع زمني من فيديو
+/audio\\_quality - اختيار جودة الصوت
+/usage - استهلاكك والحصة المتبقية
 /ffmpeg_help - دليل إعداد FFmpeg
 
 🚀 **جاهز للاستخدام! اختر أي خيار من القائمة الرئيسية.**
@@ -1088,6 +4067,28 @@ def check_status(message):
     # عد الملفات المؤقتة
     temp_files = len([f for f in os.listdir(TEMP_DIR) if os.path.isfile(os.path.join(TEMP_DIR, f))])
     
+    # ملخص المقاييس
+    stage_lines = []
+    for labels, (count, average) in sorted(STAGE_DURATION.summary().items()):
+        stage = dict(labels).get('stage', '?')
+        stage_lines.append(f"   • {stage}: {average:.1f} ث (×{count})")
+    stages_text = '\n'.join(stage_lines) or "   • لا توجد بيانات بعد"
+    
+    try:
+        rss_mb = psutil.Process().memory_info().rss / (1024 * 1024)
+        disk_free_gb = psutil.disk_usage(TEMP_DIR).free / (1024 ** 3)
+        resources_text = f"{rss_mb:.0f} MB ذاكرة | {disk_free_gb:.1f} GB حرة"
+    except Exception:
+        resources_text = "غير متاح"
+    
+    open_platforms = platform_guard.open_platforms()
+    platforms_text = ', '.join(open_platforms) if open_platforms else "✅ لا يوجد"
+    
+    jobs_ok = JOBS_TOTAL.value(kind='video', status='ok') + JOBS_TOTAL.value(kind='audio', status='ok')
+    jobs_failed = JOBS_TOTAL.value(kind='video', status='error') + JOBS_TOTAL.value(kind='audio', status='error')
+    downloaded_mb = BYTES_TOTAL.value(direction='download') / (1024 * 1024)
+    uploaded_mb = BYTES_TOTAL.value(direction='upload') / (1024 * 1024)
+    
     status_text = f"""
 🤖 **تقرير حالة النظام**
 
@@ -1098,8 +4099,14 @@ def check_status(message):
 👥 **الجلسات النشطة:** {len(user_states)}
 🧹 **التنظيف التلقائي:** ✅ نشط
 
-🔄 **جميع الأنظمة:** ✅ تعمل
-💡 **الحالة:** 🟢 تعمل بشكل مثالي
+📊 **المهام:** {jobs_ok} ناجحة | {jobs_failed} فاشلة | {int(JOBS_IN_FLIGHT.value())} جارية
+📦 **البيانات:** ⬇️ {downloaded_mb:.1f} MB | ⬆️ {uploaded_mb:.1f} MB
+🎞️ **FFmpeg:** {transcode_executor.active_count} نشطة | {transcode_executor.waiting_count} منتظرة
+📥 **التنزيلات:** {download_scheduler.running_count()} جارية | {sum(download_scheduler.waiting_by_lane().values())} منتظرة
+💾 **الموارد:** {resources_text}
+⛔ **منصات متوقفة مؤقتاً:** {platforms_text}
+⏱️ **متوسط زمن المراحل:**
+{stages_text}
 
 💡 **ملاحظة:** { "جميع الميزات متاحة" if FFMPEG_AVAILABLE else "بعض الميزات المتقدمة غير متاحة بسبب عدم توفر FFmpeg" }
 """
@@ -1115,6 +4122,111 @@ def clean_temp(message):
     else:
         bot.send_message(message.chat.id, "✅ لا توجد ملفات مؤقتة للتنظيف")
 
+@bot.message_handler(commands=['cancel'])
+def cancel_jobs(message):
+    """إلغاء مهام التحويل والتنزيل الجارية للمستخدم"""
+    cancelled = transcode_executor.cancel_chat(message.chat.id)
+    cancelled += download_scheduler.cancel_chat(message.chat.id)
+    if job_queue is not None:
+        # المهمة قد تعمل لدى عملية عامل
+        cancelled += job_queue.request_cancel(message.chat.id, shard_for_chat(message.chat.id))
+    if cancelled > 0:
+        bot.send_message(message.chat.id, "🛑 جاري إلغاء المهام الحالية...")
+    else:
+        bot.send_message(message.chat.id, "ℹ️ لا توجد مهام جارية لإلغائها")
+
+@bot.message_handler(commands=['audio_quality'])
+def set_audio_quality(message):
+    """اختيار ملف تعريف الصوت للتنزيلات والتحويلات القادمة"""
+    chat_id = message.chat.id
+    profiles = available_audio_profiles()
+    if not profiles:
+        bot.send_message(chat_id, "❌ اختيار الجودة يتطلب FFmpeg - يتم التنزيل بتنسيق الصوت الأصلي")
+        return
+    
+    parts = message.text.split()
+    if len(parts) > 1:
+        if parts[1] in profiles:
+            user_sessions.setdefault(chat_id, {})['audio_profile'] = parts[1]
+            bot.send_message(chat_id, f"✅ جودة الصوت: {AUDIO_PROFILES[parts[1]]['label']}")
+            return
+        bot.send_message(chat_id, f"❌ ملف تعريف غير معروف: {parts[1]}")
+    
+    current = resolve_audio_profile(audio_profile_for(chat_id))
+    lines = [f"{'✅' if name == current else '▫️'} {AUDIO_PROFILES[name]['label']}\n      /audio_quality {name}"
+             for name in profiles]
+    # بدون Markdown: أسماء الملفات تحتوي على _
+    bot.send_message(chat_id, "🎚️ جودة الصوت:\n\n" + '\n'.join(lines))
+
+@bot.message_handler(commands=['usage'])
+def show_usage(message):
+    """استهلاك المحادثة في النافذة الحالية مقارنة بالحصص"""
+    chat_id = message.chat.id
+    used = usage_ledger.usage(chat_id)
+    limits = quota_limits()
+    exempt = chat_id in ADMIN_IDS
+    
+    def limit_text(resource, value):
+        return " (بلا حد)" if exempt or not limits[resource] else f" / {value}"
+    
+    bot.send_message(chat_id,
+                     f"📈 **استهلاكك في آخر {QUOTA_WINDOW_MINUTES} دقيقة:**\n\n"
+                     f"📦 البيانات: {used['bytes'] / MB:.1f}{limit_text('bytes', limits['bytes'] // MB)} MB\n"
+                     f"⚙️ المعالجة: {used['cpu_seconds']:.0f}{limit_text('cpu_seconds', limits['cpu_seconds'])} ث\n"
+                     f"📊 المهام: {used['jobs']}{limit_text('jobs', limits['jobs'])}",
+                     parse_mode='Markdown')
+
+@bot.message_handler(commands=['top_usage'])
+def top_usage(message):
+    """/top_usage [دقائق] - أكثر المحادثات استهلاكاً (للمشرفين فقط)"""
+    if message.from_user.id not in ADMIN_IDS:
+        bot.send_message(message.chat.id, "⛔ هذا الأمر للمشرفين فقط")
+        return
+    parts = message.text.split()
+    minutes = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else QUOTA_WINDOW_MINUTES
+    rows = usage_ledger.top(minutes)
+    if not rows:
+        bot.send_message(message.chat.id, f"ℹ️ لا يوجد استهلاك في آخر {minutes} دقيقة")
+        return
+    lines = [f"{i}. {chat_id}: ⬇️ {used['bytes_down'] / MB:.1f} MB | ⬆️ {used['bytes_up'] / MB:.1f} MB | "
+             f"⚙️ {used['cpu_seconds']:.0f} ث | 📊 {used['jobs']}"
+             for i, (chat_id, used) in enumerate(rows, 1)]
+    # بدون Markdown: المعرفات السالبة والأرقام لا تحتاج تنسيقاً
+    bot.send_message(message.chat.id, f"🏆 أكثر المحادثات استهلاكاً (آخر {minutes} دقيقة):\n\n" + '\n'.join(lines))
+
+@bot.message_handler(commands=['debug'])
+def debug_report(message):
+    """/debug threads|memory [stop]|profile [ثوانٍ]|resources - تقارير التشخيص (للمشرفين فقط)"""
+    if message.from_user.id not in ADMIN_IDS:
+        bot.send_message(message.chat.id, "⛔ هذا الأمر للمشرفين فقط")
+        return
+    parts = message.text.split()
+    name = parts[1] if len(parts) > 1 else None
+    if name not in DEBUG_REPORTS:
+        bot.send_message(message.chat.id, "🩺 التقارير المتاحة:\n" + '\n'.join(f"/debug {n}" for n in DEBUG_REPORTS)
+                         + "\n\nمثال: /debug profile 15")
+        return
+    params = {}
+    if name == 'profile' and len(parts) > 2:
+        params['seconds'] = parts[2]
+    elif name == 'memory' and len(parts) > 2:
+        params['action'] = parts[2]
+    
+    def run():
+        try:
+            report = DEBUG_REPORTS[name](params)
+            # التقارير طويلة وتحتوي على رموز HTML، فتُرسل كملف نصي
+            bot.send_document(message.chat.id, report.encode('utf-8'), visible_file_name=f"debug_{name}.txt",
+                              caption=f"🩺 {name}")
+        except Exception as e:
+            logger.error(f"خطأ في تقرير التشخيص {name}: {e}")
+            bot.send_message(message.chat.id, f"❌ فشل التقرير: {str(e)[:100]}")
+    
+    if name == 'profile':
+        bot.send_message(message.chat.id, "⏳ جاري تحليل الأداء...")
+    # تحليل الأداء يستغرق ثوانٍ فلا يشغل خيط معالجة التحديثات
+    threading.Thread(target=run, daemon=True).start()
+
 @bot.message_handler(commands=['ffmpeg_help'])
 def ffmpeg_help(message):
     """دليل تثبيت FFmpeg"""
@@ -1153,6 +4265,14 @@ def handle_other_messages(message):
 
 # ========== التنفيذ الرئيسي ==========
 if __name__ == "__main__":
+    if WORKER_SHARD is not None:
+        # عملية عامل: لا تستقبل التحديثات وإنما تنفذ المهام من الطابور
+        try:
+            run_worker(WORKER_SHARD)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    
     print("=" * 60)
     
     if CLOUD_DEPLOYMENT:
@@ -1165,14 +4285,20 @@ if __name__ == "__main__":
     print("🤖 بدء تشغيل بوت متعدد الوظائف...")
     print("=" * 60)
     
-    # التنظيف الأولي
-    initial_cleanup = auto_cleanup.cleanup_temp_files()
+    # التنظيف الأولي (مع الإبقاء على مجلدات المهام المحفوظة للاستئناف)
+    initial_cleanup = auto_cleanup.cleanup_temp_files(keep=lifecycle.checkpointed_dirs())
     if initial_cleanup > 0:
         print(f"🧹 التنظيف الأولي: تمت إزالة {initial_cleanup} ملف")
     
     # بدء نظام التنظيف التلقائي
     auto_cleanup.start_auto_cleanup()
     
+    # تهيئة عمليات معالجة الصور قبل استقبال التحديثات
+    image_service.start()
+    
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
+    shard_processes = {}
+    
     try:
         # الحصول على معلومات البوت
         bot_info = bot.get_me()
@@ -1183,6 +4309,21 @@ if __name__ == "__main__":
         print("📊 النظام جاهز للطلبات...")
         print("=" * 60)
         
+        if METRICS_PORT:
+            start_metrics_server()
+        
+        if job_queue is not None:
+            shard_processes = start_shard_workers()
+        
+        resumed = lifecycle.resume()
+        if resumed:
+            print(f"▶️ تم استئناف {resumed} مهمة من التشغيل السابق")
+        
+        # تحميل الوحدات الثقيلة في الخلفية
+        if LAZY_WARMUP:
+            warm_up_heavy_modules()
+            ydl_pool.warm_up()
+        
         # بدء الاستطلاع
         bot.infinity_polling(timeout=60, long_polling_timeout=60)
         
@@ -1191,8 +4332,15 @@ if __name__ == "__main__":
         logger.error(f"تحطم البوت: {e}")
     finally:
         print("🛑 إيقاف البوت...")
+        checkpointed = lifecycle.shutdown()
+        if checkpointed:
+            print(f"💾 تم حفظ {checkpointed} مهمة للاستئناف بعد إعادة التشغيل")
+        stop_shard_workers(shard_processes)
         auto_cleanup.stop_auto_cleanup()
-        final_cleanup = auto_cleanup.cleanup_temp_files()
+        image_service.shutdown()
+        ydl_pool.close()
+        usage_ledger.flush()
+        final_cleanup = auto_cleanup.cleanup_temp_files(keep=lifecycle.checkpointed_dirs())
         if final_cleanup > 0:
             print(f"🧹 التنظيف النهائي: تمت إزالة {final_cleanup} ملف")
         print("✅ تم إيقاف البوت بنجاح")
@@ -0,0 +1,166 @@
+"""مهام معالجة الصور التي تعمل في عمليات منفصلة عن البوت
+
+الوحدة بلا آثار جانبية عند الاستيراد (لا بوت ولا قواعد بيانات ولا سجلات)،
+فعمليات العمال تشغّلها مباشرة بدلاً من إعادة استيراد bot.py:
+
+    python image_jobs.py
+
+يستقبل العامل (الدالة، الوسائط) عبر stdin ويعيد (نجاح، نتيجة أو رسالة خطأ)
+عبر stdout بصيغة pickle، مهمة بعد مهمة حتى يُغلق stdin.
+"""
+import io
+import os
+import pickle
+import sys
+
+from PIL import Image, ImageOps
+
+# إعدادات محول JPG الافتراضية؛ يمكن تغييرها لكل صورة عبر التعليق (مثل: webp 500kb 1280)
+IMAGE_DEFAULT_QUALITY = int(os.environ.get('IMAGE_DEFAULT_QUALITY', 85))
+IMAGE_MIN_QUALITY = int(os.environ.get('IMAGE_MIN_QUALITY', 30))
+IMAGE_MAX_QUALITY = int(os.environ.get('IMAGE_MAX_QUALITY', 95))
+
+# الصيغة -> (اسم Pillow، الامتداد)
+IMAGE_OUTPUT_FORMATS = {'jpg': ('JPEG', '.jpg'), 'webp': ('WEBP', '.webp')}
+
+class ImageProcessingError(Exception):
+    """خطأ في معالجة صورة داخل عملية العامل"""
+
+def open_image_guarded(path, max_pixels):
+    """فتح الصورة مع الحماية من قنابل فك الضغط"""
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    try:
+        image = Image.open(path)
+    except Image.DecompressionBombError:
+        raise ImageProcessingError("أبعاد الصورة أكبر من الحد المسموح")
+    width, height = image.size
+    if width * height > max_pixels:
+        image.close()
+        raise ImageProcessingError(f"أبعاد الصورة أكبر من الحد المسموح ({width}x{height})")
+    return image
+
+def warmup():
+    """تحميل Pillow وإضافاته داخل العملية الفرعية مسبقاً"""
+    Image.init()
+    return os.getpid()
+
+def image_to_pdf_job(src_path, dst_path, max_pixels):
+    """تحويل صورة إلى PDF (يعمل داخل عملية منفصلة)"""
+    with open_image_guarded(src_path, max_pixels) as image:
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.save(dst_path, "PDF", resolution=100.0, quality=95)
+    return dst_path
+
+def encode_image(image, image_format, quality, fast=False):
+    """ترميز الصورة في الذاكرة: JPEG تدريجي ومحسّن الجداول، أو WebP
+
+    fast: ترميز أسرع بحجم أكبر قليلاً، يُستخدم أثناء البحث عن الجودة فقط.
+    """
+    buffer = io.BytesIO()
+    if image_format == 'WEBP':
+        image.save(buffer, 'WEBP', quality=quality, method=0 if fast else 4)
+    else:
+        image.save(buffer, 'JPEG', quality=quality, optimize=not fast, progressive=not fast)
+    return buffer.getvalue()
+
+def fit_quality(image, image_format, target_bytes, min_quality, max_quality):
+    """بحث ثنائي عن أعلى جودة لا يتجاوز ناتجها target_bytes: (الجودة، البايتات) أو None
+
+    البحث بالترميز السريع، وحجمه حد أعلى لحجم الترميز النهائي بنفس الجودة.
+    """
+    best = None
+    low, high = min_quality, max_quality
+    while low <= high:
+        quality = (low + high) // 2
+        data = encode_image(image, image_format, quality, fast=True)
+        if len(data) <= target_bytes:
+            best = (quality, data)
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        return None
+    quality, data = best
+    final = encode_image(image, image_format, quality)
+    return (quality, final) if len(final) <= len(data) else best
+
+def optimize_image_job(src_path, dst_path, max_pixels, options):
+    """تحويل صورة وضغطها (يعمل داخل عملية منفصلة)
+
+    options: format ('jpg' أو 'webp')، max_side، target_bytes، quality.
+    عند تصغير JPEG يُفك ترميزه مباشرة بحجم مخفض (draft) فلا تُحمّل البكسلات
+    الكاملة. مع target_bytes يُبحث ثنائياً عن الجودة تحت الجودة المطلوبة إذا
+    تجاوز ناتجها الحجم، وإن لم تكفِ أقل جودة تُصغّر الأبعاد تدريجياً.
+    """
+    image_format = IMAGE_OUTPUT_FORMATS[options.get('format', 'jpg')][0]
+    max_side = options.get('max_side') or 0
+    target_bytes = options.get('target_bytes') or 0
+    with open_image_guarded(src_path, max_pixels) as source:
+        if max_side and source.format == 'JPEG':
+            source.draft('RGB', (max_side, max_side))
+        image = ImageOps.exif_transpose(source)
+        keep_alpha = image_format == 'WEBP' and ('A' in image.getbands() or 'transparency' in image.info)
+        if keep_alpha:
+            image = image.convert('RGBA')
+        elif image.mode in ('RGBA', 'LA', 'P'):
+            # تسطيح الشفافية على خلفية بيضاء بدلاً من الأسود
+            rgba = image.convert('RGBA')
+            image = Image.new('RGB', rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel('A'))
+        else:
+            image = image.convert('RGB')
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    target_met = True
+    quality = options.get('quality') or IMAGE_DEFAULT_QUALITY
+    data = encode_image(image, image_format, quality)
+    if target_bytes and len(data) > target_bytes:
+        # الجودة المطلوبة أكبر من الحجم المستهدف: البحث فيما دونها فقط
+        for _ in range(4):
+            fitted = fit_quality(image, image_format, target_bytes, IMAGE_MIN_QUALITY, quality - 1)
+            if fitted is not None:
+                quality, data = fitted
+                break
+            # أقل جودة لا تكفي: تصغير الأبعاد بنسبة الحجم الزائد
+            data = encode_image(image, image_format, IMAGE_MIN_QUALITY, fast=True)
+            scale = max(0.25, (target_bytes / len(data)) ** 0.5 * 0.9)
+            image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+        else:
+            quality = IMAGE_MIN_QUALITY
+            data = encode_image(image, image_format, quality)
+            target_met = len(data) <= target_bytes
+
+    with open(dst_path, 'wb') as f:
+        f.write(data)
+    return {'path': dst_path, 'format': image_format, 'quality': quality, 'width': image.width,
+            'height': image.height, 'bytes': len(data), 'source_bytes': os.path.getsize(src_path),
+            'target_met': target_met}
+
+def serve(reader, writer):
+    """حلقة العامل: تنفيذ المهام الواردة من reader وكتابة نتائجها إلى writer"""
+    while True:
+        try:
+            job, args = pickle.load(reader)
+        except EOFError:
+            return
+        try:
+            result = (True, job(*args))
+        except Exception as e:
+            # الخطأ يُرسل كنص حتى لا يعتمد على إمكانية تسلسل صنف الاستثناء
+            result = (False, str(e) if isinstance(e, ImageProcessingError) else f"{type(e).__name__}: {e}")
+        pickle.dump(result, writer)
+        writer.flush()
+
+def main():
+    reader, writer = sys.stdin.buffer, sys.stdout.buffer
+    # أي طباعة من Pillow أو المهام تذهب إلى stderr حتى لا تفسد قناة النتائج
+    sys.stdout = sys.stderr
+    serve(reader, writer)
+
+if __name__ == '__main__':
+    # التشغيل كسكربت ينشئ وحدة __main__؛ الاستيراد باسم image_jobs يجعل
+    # مراجع الدوال في pickle تشير إلى نفس الوحدة
+    import image_jobs
+    image_jobs.main()
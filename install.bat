@@ -18,7 +18,7 @@ echo ✅ Python مثبت
 echo.
 echo 📦 جاري تثبيت المكتبات...
 python -m pip install --upgrade pip
-python -m pip install pyTelegramBotAPI yt-dlp requests pillow
+python -m pip install -r requirements.txt
 
 echo.
 echo 🎵 جاري تثبيت FFmpeg...
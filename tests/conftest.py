@@ -0,0 +1,19 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# يجب ضبط البيئة قبل استيراد bot لأن إعداداته تُقرأ عند الاستيراد
+_state_dir = tempfile.mkdtemp(prefix='bot_tests_')
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+os.environ.setdefault('LAZY_WARMUP', '0')
+os.environ.setdefault('USAGE_DB', os.path.join(_state_dir, 'usage.db'))
+os.environ.setdefault('FILE_ID_CACHE_DB', os.path.join(_state_dir, 'file_ids.db'))
+os.environ.setdefault('JOB_QUEUE_DB', os.path.join(_state_dir, 'jobs.db'))
+os.environ.setdefault('MEDIA_STORE_DIR', os.path.join(_state_dir, 'store'))
+os.environ.setdefault('TRACE_FILE', os.path.join(_state_dir, 'traces.jsonl'))
+os.environ.setdefault('CAPABILITIES_FILE', os.path.join(_state_dir, 'capabilities.json'))
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -0,0 +1,19 @@
+"""مهام اختبار تُنفَّذ داخل عمليات عمال الصور (بلا استيراد bot)"""
+import os
+import sys
+import time
+
+
+def sleep_job(src_path, dst_path, max_pixels, seconds=30):
+    time.sleep(seconds)
+    with open(dst_path, 'wb') as f:
+        f.write(b'%PDF-1.4\n')
+    return dst_path
+
+
+def failing_job(src_path, dst_path, max_pixels):
+    raise ValueError("boom")
+
+
+def bot_loaded_job(src_path, dst_path, max_pixels):
+    return 'bot' in sys.modules or '__mp_main__' in sys.modules, os.getpid()
@@ -0,0 +1,12 @@
+import bot
+
+
+def test_failed_probe_is_not_reused(monkeypatch, tmp_path):
+    ffmpeg = tmp_path / 'ffmpeg'
+    ffmpeg.write_bytes(b'binary')
+    cached = {'schema': bot.CAPABILITIES_VERSION, 'ffmpeg': str(ffmpeg), 'version': None,
+              'fingerprint': bot._binary_fingerprint(str(ffmpeg))}
+    assert bot._capabilities_still_valid(cached) is False
+
+    cached['version'] = '6.1'
+    assert bot._capabilities_still_valid(cached) is True
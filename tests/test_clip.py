@@ -0,0 +1,41 @@
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import bot
+
+
+def test_clip_end_is_clamped_to_duration():
+    assert bot.fit_clip_to_duration((60, 200), 125.4) == (60, 125)
+    assert bot.fit_clip_to_duration((60, 90), None) == (60, 90)
+
+
+def test_clip_starting_after_the_end_is_rejected():
+    with pytest.raises(bot.ClipRangeError):
+        bot.fit_clip_to_duration((300, 320), 120)
+
+
+def test_clip_ffmpeg_runs_under_the_transcode_gate(tmp_path):
+    chat_id = 8101
+    work_dir = str(tmp_path / 'job')
+    gate = bot.YdlTranscodeGate(chat_id, 'video')
+    # عملية تمثل FFmpeg الذي يشغّله yt-dlp ويكتب في مجلد المهمة
+    child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)', work_dir])
+    active = []
+    try:
+        with pytest.raises(bot.TranscodeCancelled):
+            with gate.external_ffmpeg(work_dir):
+                active.append(bot.transcode_executor.active_count)
+                threading.Timer(0.2, bot.transcode_executor.cancel_chat, args=(chat_id,)).start()
+                child.wait(timeout=10)
+    finally:
+        gate.close()
+        if child.poll() is None:
+            child.kill()
+
+    assert active == [1]
+    assert child.returncode is not None
+    assert bot.transcode_executor.active_count == 0
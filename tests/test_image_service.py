@@ -0,0 +1,102 @@
+import functools
+import threading
+import time
+import types
+
+import pytest
+from PIL import Image
+
+import bot
+import image_jobs
+from image_helpers import bot_loaded_job, failing_job, sleep_job
+
+
+@pytest.fixture
+def service():
+    service = bot.ImageProcessingService(max_workers=2, timeout=2)
+    service.start()
+    yield service
+    service.shutdown()
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / 'src.png'
+    Image.new('RGB', (320, 240), 'red').save(path)
+    return str(path)
+
+
+def test_workers_do_not_import_the_bot(service, image_path, tmp_path):
+    loaded, pid = service.run(bot_loaded_job, image_path, str(tmp_path / 'x'))
+    assert loaded is False
+    assert pid in {worker.process.pid for worker in service._idle}
+
+
+def test_converts_image(service, image_path, tmp_path):
+    pdf_path = str(tmp_path / 'out.pdf')
+    assert service.run(image_jobs.image_to_pdf_job, image_path, pdf_path) == pdf_path
+
+
+def test_job_error_keeps_worker(service, image_path, tmp_path):
+    pids = {worker.process.pid for worker in service._idle}
+    with pytest.raises(bot.ImageProcessingError, match='boom'):
+        service.run(failing_job, image_path, str(tmp_path / 'x'))
+    assert {worker.process.pid for worker in service._idle} == pids
+
+
+def test_timeout_stops_only_its_worker(service, image_path, tmp_path):
+    errors = []
+
+    def slow():
+        try:
+            service.run(sleep_job, image_path, str(tmp_path / 'slow'))
+        except bot.ImageProcessingError as e:
+            errors.append(str(e))
+
+    thread = threading.Thread(target=slow)
+    thread.start()
+    time.sleep(0.5)
+    healthy = [worker.process.pid for worker in service._idle]
+    result = service.run(image_jobs.optimize_image_job, image_path, str(tmp_path / 'out.jpg'),
+                         bot.parse_image_options(''))
+    thread.join()
+
+    assert result['format'] == 'JPEG'
+    assert errors == ["انتهت مهلة معالجة الصورة"]
+    # العامل السليم بقي يعمل ولم تُنهَ معه بقية العمليات
+    assert [worker.process.pid for worker in service._idle] == healthy
+    assert all(worker.alive() for worker in service._idle)
+
+
+def test_handlers_return_before_conversions_finish(monkeypatch):
+    jobs, seconds = 4, 1.0
+    service = bot.ImageProcessingService(max_workers=jobs, timeout=30)
+    service.start()
+    documents = []
+    done = threading.Semaphore(0)
+
+    def fake_send(chat_id, file_path, method, **kwargs):
+        documents.append(chat_id)
+        done.release()
+
+    monkeypatch.setattr(bot, 'image_service', service)
+    monkeypatch.setattr(image_jobs, 'image_to_pdf_job', functools.partial(sleep_job, seconds=seconds))
+    monkeypatch.setattr(bot, 'fetch_telegram_file', lambda file_id, dest_path, chat_id=None: dest_path)
+    monkeypatch.setattr(bot, 'send_media_file', fake_send)
+    monkeypatch.setattr(bot.bot, 'send_message', lambda *args, **kwargs: None)
+    monkeypatch.setattr(bot, 'send_welcome_by_id', lambda chat_id: None)
+    try:
+        started = time.perf_counter()
+        for chat_id in range(7001, 7001 + jobs):
+            photo = types.SimpleNamespace(file_id=f'photo-{chat_id}', file_size=1000)
+            bot.process_image_to_pdf(types.SimpleNamespace(chat=types.SimpleNamespace(id=chat_id), photo=[photo]))
+        # المعالج يسلّم المهمة ويعود فوراً دون انتظار التحويل
+        assert time.perf_counter() - started < seconds / 2
+        for _ in range(jobs):
+            assert done.acquire(timeout=10)
+        elapsed = time.perf_counter() - started
+    finally:
+        service.shutdown()
+
+    assert sorted(documents) == list(range(7001, 7001 + jobs))
+    assert elapsed < seconds * 2
@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    dispatched = []
+    probed = []
+    monkeypatch.setattr(bot, 'CACHE_CHAT_ID', -100123)
+    monkeypatch.setattr(bot, 'INLINE_DEBOUNCE_SECONDS', 0.2)
+    monkeypatch.setattr(bot, '_inline_pending', {})
+    monkeypatch.setattr(bot, '_inline_timers', {})
+    monkeypatch.setattr(bot, 'test_url_with_ytdlp',
+                        lambda url: (probed.append(url) or url.endswith('dQw4w9WgXcQ'), None))
+    monkeypatch.setattr(bot, 'dispatch_job', lambda kind, chat_id, *args: dispatched.append((chat_id,) + args) or True)
+    return probed, dispatched
+
+
+def _wait_for_timers():
+    for timer in list(bot._inline_timers.values()):
+        timer.join(5)
+
+
+def test_typing_fetches_only_the_final_url(fetches):
+    probed, dispatched = fetches
+    url = 'https://youtu.be/dQw4w9WgXcQ'
+    for end in range(len('https://youtu.be/d'), len(url) + 1):
+        assert bot.schedule_inline_fetch(url[:end], 1)
+    _wait_for_timers()
+    time.sleep(0.1)
+
+    assert probed == [url]
+    assert dispatched == [(-100123, url, 'video', False, None, None, 1)]
+
+
+def test_url_failing_extraction_is_not_downloaded(fetches):
+    probed, dispatched = fetches
+    bot.schedule_inline_fetch('https://youtu.be/dQw4', 1)
+    _wait_for_timers()
+    time.sleep(0.1)
+    assert probed == ['https://youtu.be/dQw4']
+    assert dispatched == []
+
+
+def test_no_fetch_without_cache_chat(fetches, monkeypatch):
+    monkeypatch.setattr(bot, 'CACHE_CHAT_ID', None)
+    assert bot.schedule_inline_fetch('https://youtu.be/dQw4w9WgXcQ', 1) is False
+    assert bot._inline_timers == {}
+
+
+def test_search_treats_like_wildcards_literally(tmp_path):
+    cache = bot.FileIdCache(str(tmp_path / 'file_ids.db'))
+    cache.put(['video:a'], 'video', 'id-a', 'video', info={'title': 'Song one'})
+    cache.put(['video:b'], 'video', 'id-b', 'video', info={'title': '100% hits_2024'})
+
+    assert [row['file_id'] for row in cache.search('%')] == ['id-b']
+    assert [row['file_id'] for row in cache.search('_')] == ['id-b']
+    assert [row['file_id'] for row in cache.search('song')] == ['id-a']
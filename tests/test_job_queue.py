@@ -0,0 +1,61 @@
+import bot
+
+
+def test_ffmpeg_limit_is_split_across_processes():
+    shares = [bot.ffmpeg_process_share(shard, shards=3, total=10) for shard in (None, 0, 1, 2)]
+    assert sum(shares) == 10
+    assert max(shares) - min(shares) <= 1
+    assert bot.ffmpeg_process_share(2, shards=3, total=2) == 1
+
+
+def test_cancel_reports_only_real_jobs(tmp_path):
+    queue = bot.SqliteJobQueue(str(tmp_path / 'jobs.db'))
+    assert queue.request_cancel(42, 0) == 0
+    assert queue.take_cancellations(0) == []
+
+    queued = queue.put('download', 42, ['https://example.com/a'], 0)
+    running = queue.put('download', 42, ['https://example.com/b'], 0)
+    queue.put('download', 7, ['https://example.com/c'], 0)
+    assert queue.claim(0)['id'] == queued
+    # المهمة الأولى جارية والثانية ما زالت منتظرة
+    assert queue.request_cancel(42, 0) == 2
+    assert queue.take_cancellations(0) == [42]
+    assert queue.claim(0)['chat_id'] == 7
+    assert queue.claim(0) is None
+    assert running in [job_id for job_id, chat_id in queue.take_finished()]
+
+
+def test_finished_jobs_are_reported_in_any_order(tmp_path):
+    queue = bot.SqliteJobQueue(str(tmp_path / 'jobs.db'))
+    first = queue.put('download', 1, [], 0)
+    second = queue.put('download', 2, [], 0)
+    queue.claim(0)
+    queue.claim(0)
+    queue.complete(second)
+    assert queue.take_finished() == [(second, 2)]
+    # المهمة الأقدم انتهت بعد الأحدث ويجب ألا تضيع
+    queue.complete(first)
+    assert queue.take_finished() == [(first, 1)]
+    assert queue.take_finished() == []
+
+
+def test_purge_removes_old_reported_jobs(tmp_path):
+    queue = bot.SqliteJobQueue(str(tmp_path / 'jobs.db'))
+    done = queue.put('download', 1, [], 0)
+    queue.claim(0)
+    queue.complete(done)
+    assert queue.purge(older_than=-1) == 0
+    queue.take_finished()
+    assert queue.purge(older_than=-1) == 1
+
+
+def test_job_crashing_its_worker_fails_after_max_attempts(tmp_path):
+    queue = bot.SqliteJobQueue(str(tmp_path / 'jobs.db'))
+    job_id = queue.put('download', 5, [], 0)
+    for attempt in range(1, 4):
+        assert queue.claim(0)['id'] == job_id
+        # العامل توقف أثناء المهمة ثم أُعيد تشغيله
+        requeued, failed = queue.requeue_running(0, max_attempts=3)
+        assert (requeued, failed) == ((1, []) if attempt < 3 else (0, [5]))
+    assert queue.claim(0) is None
+    assert queue.take_finished() == [(job_id, 5)]
@@ -0,0 +1,63 @@
+import urllib.request
+
+import bot
+
+
+def test_every_registered_metric_renders():
+    bot.JOBS_TOTAL.inc(kind='video', status='done')
+    bot.STAGE_DURATION.observe(0.3, stage='download')
+
+    for metric in bot.metrics._metrics:
+        if getattr(metric, '_function', None) is not None:
+            # Gauge.samples يبتلع أخطاء الدالة، لذا تُستدعى هنا مباشرة لإظهارها
+            metric._function()
+        for name, labels, value in metric.samples():
+            assert all(len(pair) == 2 for pair in labels), name
+
+    text = bot.metrics.render()
+    for metric in bot.metrics._metrics:
+        assert f"# TYPE {metric.name} {metric.metric_type}" in text
+    assert 'bot_queue_depth{queue="transcode"}' in text
+    assert 'bot_jobs_total{kind="video",status="done"}' in text
+    assert 'bot_stage_duration_seconds_bucket{stage="download",le="0.5"} 1' in text
+
+
+def test_metrics_endpoint_scrape():
+    server = bot.start_metrics_server('127.0.0.1', 0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url, timeout=10) as response:
+            assert response.status == 200
+            body = response.read().decode('utf-8')
+    finally:
+        server.shutdown()
+    assert '# TYPE bot_queue_depth gauge' in body
+
+
+def _handler(address, headers=None):
+    handler = bot.MetricsRequestHandler.__new__(bot.MetricsRequestHandler)
+    handler.client_address = (address, 40000)
+    handler.headers = headers or {}
+    return handler
+
+
+def test_debug_reports_are_local_unless_token_matches(monkeypatch):
+    monkeypatch.setattr(bot, 'DEBUG_TOKEN', '')
+    assert _handler('127.0.0.1')._debug_allowed()
+    assert not _handler('10.0.0.5')._debug_allowed()
+    assert not _handler('10.0.0.5', {'X-Debug-Token': ''})._debug_allowed()
+
+    monkeypatch.setattr(bot, 'DEBUG_TOKEN', 's3cret')
+    assert _handler('10.0.0.5', {'X-Debug-Token': 's3cret'})._debug_allowed()
+    assert not _handler('10.0.0.5', {'X-Debug-Token': 'wrong'})._debug_allowed()
+
+
+def test_debug_endpoint_served_to_loopback():
+    server = bot.start_metrics_server('127.0.0.1', 0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/debug/threads"
+        with urllib.request.urlopen(url, timeout=10) as response:
+            assert response.status == 200
+            assert 'Thread' in response.read().decode('utf-8')
+    finally:
+        server.shutdown()
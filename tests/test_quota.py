@@ -0,0 +1,77 @@
+import types
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    sent = []
+    fetched = []
+    monkeypatch.setattr(bot.bot, 'send_message', lambda chat_id, text, **kwargs: sent.append(text))
+    monkeypatch.setattr(bot, 'send_welcome_by_id', lambda chat_id: None)
+    monkeypatch.setattr(bot, 'fetch_telegram_file', lambda *args: fetched.append(args))
+    return sent, fetched
+
+
+def _message(chat_id, content_type, media):
+    message = types.SimpleNamespace(chat=types.SimpleNamespace(id=chat_id), message_id=1,
+                                    content_type=content_type, caption=None)
+    if content_type == 'photo':
+        message.photo = [media]
+    elif content_type == 'video':
+        message.video = media
+    else:
+        message.document = media
+    return message
+
+
+@pytest.mark.parametrize('handler', [bot.process_image_to_pdf, bot.process_image_to_jpg])
+def test_image_jobs_respect_job_quota(chat, handler):
+    sent, fetched = chat
+    chat_id = 9001 if handler is bot.process_image_to_pdf else 9002
+    bot.usage_ledger.record(chat_id, jobs=bot.QUOTA_JOBS)
+    photo = types.SimpleNamespace(file_id='f', file_size=1000)
+
+    handler(_message(chat_id, 'photo', photo))
+
+    assert fetched == []
+    assert sent and sent[-1].startswith('🚫')
+    assert bot.usage_ledger.usage(chat_id)['jobs'] == bot.QUOTA_JOBS
+
+
+def test_rejected_input_is_not_counted(chat):
+    sent, fetched = chat
+    document = types.SimpleNamespace(file_id='f', file_size=1000, mime_type='application/zip')
+
+    bot.process_image_to_jpg(_message(9003, 'document', document))
+
+    assert sent == ["❌ الملف ليس صورة"]
+    assert bot.usage_ledger.usage(9003)['jobs'] == 0
+
+
+def test_oversized_video_is_not_counted(chat):
+    sent, fetched = chat
+    video = types.SimpleNamespace(file_id='f', file_unique_id='u', file_size=bot.DOWNLOAD_LIMIT + 1)
+
+    bot.process_video_to_mp3(_message(9004, 'video', video))
+
+    assert fetched == []
+    assert sent[-1].startswith("❌ الملف كبير جدًا")
+    assert bot.usage_ledger.usage(9004)['jobs'] == 0
+
+
+def test_inline_download_is_billed_to_requesting_user(chat, monkeypatch):
+    def fetch_into_cache_chat(url):
+        bot.usage_ledger.record(-100123, bytes_down=5000, cpu_seconds=2)
+        return False
+
+    monkeypatch.setattr(bot, 'is_valid_url', fetch_into_cache_chat)
+
+    bot.process_download(-100123, 'https://youtu.be/x', 'video', False, None, None, 9005)
+    bot.usage_ledger.record(-100123, bytes_down=1)
+
+    usage = bot.usage_ledger.usage(9005)
+    assert usage['bytes'] == 5000 and usage['cpu_seconds'] == 2
+    assert bot.usage_ledger.usage(-100123)['bytes'] == 1
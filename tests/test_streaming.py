@@ -0,0 +1,66 @@
+import subprocess
+
+import pytest
+
+import bot
+
+
+def test_thumbnail_filter_bounds_both_sides(monkeypatch, tmp_path):
+    calls = []
+
+    def fake_run(args, **kwargs):
+        calls.append(args)
+        open(args[-1], 'wb').close()
+        return subprocess.CompletedProcess(args, 0)
+
+    monkeypatch.setattr(bot.transcode_executor, 'run', fake_run)
+    thumbnail = bot.generate_thumbnail(str(tmp_path / 'clip.mp4'), duration=60)
+
+    assert thumbnail == str(tmp_path / 'clip.thumb.jpg')
+    video_filter = calls[0][calls[0].index('-vf') + 1]
+    assert "h='min(320,ih)'" in video_filter
+    assert 'force_original_aspect_ratio=decrease' in video_filter
+    assert video_filter.endswith('scale=trunc(iw/2)*2:trunc(ih/2)*2')
+
+
+@pytest.mark.skipif(not bot.FFMPEG_AVAILABLE, reason='FFmpeg غير مثبت')
+@pytest.mark.parametrize('size', ['1080x1920', '1920x1080', '1280x534'])
+def test_thumbnail_fits_telegram_limits(tmp_path, size):
+    from PIL import Image
+
+    video = str(tmp_path / 'clip.mp4')
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', f'testsrc=size={size}:duration=1',
+                    '-pix_fmt', 'yuv420p', '-y', video], check=True)
+    with Image.open(bot.generate_thumbnail(video, duration=1)) as image:
+        width, height = image.size
+    assert width <= 320 and height <= 320
+    assert width % 2 == 0 and height % 2 == 0
+
+
+def test_prepared_metadata_is_accepted_by_send_video(monkeypatch, tmp_path):
+    video = tmp_path / 'clip.mp4'
+    video.write_bytes(b'\0' * 64)
+    thumbnail = tmp_path / 'clip.thumb.jpg'
+    thumbnail.write_bytes(b'\xff\xd8\xff\xd9')
+    monkeypatch.setattr(bot, 'FFMPEG_AVAILABLE', True)
+    monkeypatch.setattr(bot, 'ensure_faststart', lambda file_path, chat_id=None: False)
+    monkeypatch.setattr(bot, 'probe_media', lambda file_path: {
+        'duration': 12, 'width': 1280, 'height': 720, 'audio_codec': 'aac'})
+    monkeypatch.setattr(bot, 'generate_thumbnail', lambda file_path, duration=None, chat_id=None: str(thumbnail))
+
+    requests = []
+
+    def fake_request(token, method_name, method='get', params=None, files=None):
+        requests.append((method_name, params, files))
+        return {'message_id': 1, 'date': 0, 'chat': {'id': 42, 'type': 'private'}}
+
+    monkeypatch.setattr(bot.telebot.apihelper, '_make_request', fake_request)
+    extra = {'supports_streaming': True}
+    extra.update(bot.prepare_video_for_streaming(str(video), 42))
+    bot.send_media_file(42, str(video), 'send_video', caption='clip', **extra)
+
+    method_name, params, files = requests[0]
+    assert method_name == 'sendVideo'
+    assert (params['duration'], params['width'], params['height']) == (12, 1280, 720)
+    assert 'thumbnail' in files and 'video' in files
+    assert 'audio_codec' not in params
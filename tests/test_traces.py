@@ -0,0 +1,30 @@
+import json
+
+import bot
+import trace_report
+
+
+def test_each_worker_gets_its_own_trace_file():
+    assert bot.process_trace_file('/tmp/traces.jsonl') == '/tmp/traces.jsonl'
+    assert bot.process_trace_file('/tmp/traces.jsonl', 2) == '/tmp/traces.w2.jsonl'
+
+
+def test_report_reads_all_process_files(tmp_path):
+    path = str(tmp_path / 'traces.jsonl')
+
+    def write(file_path, kind):
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'event': 'job_end', 'kind': kind, 'duration_ms': 10, 'status': 'ok'}) + '\n')
+
+    write(path, 'ingress')
+    write(bot.process_trace_file(path, 0), 'worker0')
+    write(bot.process_trace_file(path, 0) + '.1', 'worker0')
+    write(bot.process_trace_file(path, 1), 'worker1')
+
+    report = trace_report.aggregate(trace_report.read_events(path))
+    assert {kind: row['count'] for kind, row in report['jobs'].items()} == {'ingress': 1, 'worker0': 2, 'worker1': 1}
+
+
+def test_tests_do_not_write_shared_files():
+    assert not bot.TRACE_FILE.startswith('/tmp/bot_traces')
+    assert not bot.CAPABILITIES_FILE.startswith('/tmp/telegram_bot_capabilities')
@@ -0,0 +1,34 @@
+import pytest
+
+import bot
+
+yt_dlp = pytest.importorskip('yt_dlp')
+from yt_dlp.downloader.common import FileDownloader  # noqa: E402
+from yt_dlp.utils import RetryManager  # noqa: E402
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    calls = []
+    monkeypatch.setattr('yt_dlp.utils._utils.time.sleep', calls.append)
+    return calls
+
+
+def test_retry_manager_calls_sleep_with_keyword(sleeps):
+    warnings = []
+    RetryManager.report_retry(
+        OSError('reset'), 3, 10, sleep_func=bot._ytdlp_retry_sleep,
+        info=lambda msg: None, warn=warnings.append)
+    assert len(sleeps) == 1
+    assert 0 < sleeps[0] <= 10
+    assert warnings
+
+
+def test_downloader_uses_bot_retry_policy(sleeps):
+    params = bot.get_ydl_opts('video')
+    with yt_dlp.YoutubeDL(params) as ydl:
+        downloader = FileDownloader(ydl, params)
+        downloader.report_retry(OSError('reset'), 1, params['retries'])
+        downloader.report_retry(OSError('reset'), 2, params['fragment_retries'], frag_index=4)
+    assert len(sleeps) == 2
+    assert all(0 < delay <= 10 for delay in sleeps)
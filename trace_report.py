@@ -0,0 +1,119 @@
+"""تجميع ملفات التتبع (JSON lines) إلى نسب مئوية لزمن كل مرحلة
+
+الاستخدام:
+    python trace_report.py
+    python trace_report.py --file /tmp/bot_traces.jsonl --since 60 --json
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+DEFAULT_TRACE_FILE = os.environ.get('TRACE_FILE', '/tmp/bot_traces.jsonl')
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def trace_files(path):
+    """ملف العملية الرئيسية وملفات عمليات العمال (path بدون الامتداد + .wN + الامتداد)"""
+    stem, ext = os.path.splitext(path)
+    return [path] + sorted(glob.glob(f"{glob.escape(stem)}.w*{ext}"))
+
+
+def read_events(path, since=None):
+    """قراءة ملفات كل العمليات وملفاتها المدورة (path.1, path.2, ...) من الأقدم للأحدث"""
+    for trace_path in trace_files(path):
+        backups = []
+        for candidate in glob.glob(glob.escape(trace_path) + '.*'):
+            suffix = candidate.rsplit('.', 1)[-1]
+            if suffix.isdigit():
+                backups.append((int(suffix), candidate))
+        for file_path in [p for _, p in sorted(backups, reverse=True)] + [trace_path]:
+            if not os.path.exists(file_path):
+                continue
+            with open(file_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    if since is not None and event.get('ts', 0) < since:
+                        continue
+                    yield event
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 0.50),
+        'p90_ms': percentile(values, 0.90),
+        'p99_ms': percentile(values, 0.99),
+        'max_ms': values[-1] if values else 0,
+    }
+
+
+def aggregate(events):
+    stages = {}
+    jobs = {}
+    for event in events:
+        if event.get('event') == 'stage_end':
+            entry = stages.setdefault(event.get('stage', '?'), {'durations': [], 'errors': 0, 'bytes': 0})
+            entry['durations'].append(event.get('duration_ms', 0))
+            entry['bytes'] += event.get('bytes', 0) or 0
+            if event.get('status') != 'ok':
+                entry['errors'] += 1
+        elif event.get('event') == 'job_end':
+            entry = jobs.setdefault(event.get('kind', '?'), {'durations': [], 'statuses': {}, 'retries': 0})
+            entry['durations'].append(event.get('duration_ms', 0))
+            status = event.get('status', '?')
+            entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+            entry['retries'] += event.get('retries', 0) or 0
+
+    report = {'stages': {}, 'jobs': {}}
+    for stage, entry in stages.items():
+        report['stages'][stage] = dict(summarize(entry['durations']), errors=entry['errors'], bytes=entry['bytes'])
+    for kind, entry in jobs.items():
+        report['jobs'][kind] = dict(summarize(entry['durations']), statuses=entry['statuses'], retries=entry['retries'])
+    return report
+
+
+def print_table(title, rows, extra):
+    print(title)
+    print(f"  {'name':<14}{'count':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  {extra}")
+    for name, row in sorted(rows.items()):
+        print(f"  {name:<14}{row['count']:>7}{row['p50_ms']:>9}{row['p90_ms']:>9}{row['p99_ms']:>9}{row['max_ms']:>9}  "
+              f"{row[extra]}")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file', default=DEFAULT_TRACE_FILE, help='مسار ملف التتبع')
+    parser.add_argument('--since', type=float, default=None, help='آخر N دقيقة فقط')
+    parser.add_argument('--json', action='store_true', help='إخراج JSON بدلاً من الجدول')
+    args = parser.parse_args()
+
+    since = time.time() - args.since * 60 if args.since is not None else None
+    report = aggregate(read_events(args.file, since))
+
+    if args.json:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+        return
+    if not report['stages'] and not report['jobs']:
+        print("لا توجد أحداث تتبع")
+        return
+    print_table("المراحل (ms)", report['stages'], 'errors')
+    print_table("المهام (ms)", report['jobs'], 'statuses')
+
+
+if __name__ == '__main__':
+    main()